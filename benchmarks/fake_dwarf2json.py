@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""Stand-in for dwarf2json that writes FAKE_DWARF2JSON_SIZE bytes of ISF shaped JSON to stdout,
+the real tool needs a genuine vmlinux. Arguments are accepted and ignored"""
+import base64
+import os
+import sys
+
+
+def main():
+    size = int(os.environ.get('FAKE_DWARF2JSON_SIZE', 64 * 1024 * 1024))
+    banner = base64.b64encode(b'Linux version 5.4.0-1-generic (benchmark@localhost) #1 SMP\n\x00')
+    out = sys.stdout.buffer
+
+    out.write(b'{"metadata": {"format": "6.2.0"}, "user_types": {\n')
+    written = 0
+    number = 0
+    while written < size:
+        entry = (b'"struct_%d": {"size": %d, "fields": {"next": {"offset": 0, "type": '
+                 b'{"kind": "pointer", "subtype": {"kind": "struct", "name": "struct_%d"}}}}, "kind": "struct"},\n'
+                 % (number, number * 8, number + 1))
+        out.write(entry)
+        written += len(entry)
+        number += 1
+    out.write(b'"end": {"size": 0, "fields": {}, "kind": "struct"}},\n"symbols": {"linux_banner": {\n'
+              b'  "type": {"kind": "array", "count": 64, "subtype": {"kind": "base", "name": "char"}},\n'
+              b'  "address": 18446744071600000000,\n  "constant_data": "' + banner + b'"\n}}}\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+import gzip
+import hashlib
+import io
+import json
+import logging
+import lzma
+import os
+import shutil
+import struct
+import tarfile
+import zlib
+
+from pathlib import Path
+
+import zstandard
+
+from parsers.ranged import XZ_FOOTER_SIZE, XZ_HEADER_SIZE, encode_varint, read_varint
+
+
+logger = logging.getLogger(__name__)
+
+UNAME = '5.4.0-1-generic'
+# Bumped when the layout changes so trees built by an older version are not reused
+LAYOUT = 3
+REPO_NS = 'http://linux.duke.edu/metadata/common'
+# Fixture compression favours build time, decompression speed barely depends on the preset
+XZ_PRESET = 1
+ZSTD_LEVEL = 3
+# Split xz into blocks of this size as `xz --block-size` and threaded dpkg-deb do, so ranged reads can skip blocks
+XZ_BLOCK_SIZE = 1024 * 1024
+
+
+def vmlinux_data(size):
+    """Roughly as compressible as a real debug vmlinux, each 4KiB page is 1KiB random and 3KiB repeated"""
+    filler = (b'\x00' * 1024 + b'.debug_info\x00__ksymtab_\x00' * 120)[:3072]
+    data = bytearray()
+    while len(data) < size:
+        data += os.urandom(1024) + filler
+    return bytes(data[:size])
+
+
+def system_map_data(size):
+    lines = []
+    length = 0
+    address = 0xffffffff81000000
+    while length < size:
+        line = f'{address:016x} T symbol_{len(lines)}\n'
+        lines.append(line)
+        length += len(line)
+        address += 0x10
+    return ''.join(lines).encode()[:size]
+
+
+def xz_blocks(data, block_size=XZ_BLOCK_SIZE):
+    """A single xz stream with a new block every `block_size` bytes. The lzma module only writes one
+    block per stream, so each piece is compressed on its own and the blocks moved into one stream
+    under a combined index"""
+    if not data:
+        return lzma.compress(data, preset = XZ_PRESET)
+    blocks = b''
+    records = b''
+    count = 0
+    for start in range(0, len(data), block_size):
+        stream = lzma.compress(data[start:start + block_size], preset = XZ_PRESET)
+        index_size = (struct.unpack('<I', stream[-8:-4])[0] + 1) * 4
+        index = stream[-XZ_FOOTER_SIZE - index_size:-XZ_FOOTER_SIZE]
+        _, offset = read_varint(index, 1)
+        unpadded, offset = read_varint(index, offset)
+        uncompressed, _ = read_varint(index, offset)
+        blocks += stream[XZ_HEADER_SIZE:-XZ_FOOTER_SIZE - index_size]
+        records += encode_varint(unpadded) + encode_varint(uncompressed)
+        count += 1
+
+    header = stream[:XZ_HEADER_SIZE]
+    flags = header[6:8]
+    index = b'\x00' + encode_varint(count) + records
+    index += b'\x00' * (-len(index) % 4)
+    index += struct.pack('<I', zlib.crc32(index))
+    backward = struct.pack('<I', len(index) // 4 - 1)
+    footer = struct.pack('<I', zlib.crc32(backward + flags)) + backward + flags + b'YZ'
+    return header + blocks + index + footer
+
+
+def compress(data, compression):
+    if compression == 'xz':
+        return xz_blocks(data)
+    return zstandard.ZstdCompressor(level = ZSTD_LEVEL).compress(data)
+
+
+def tar_bytes(members, compression):
+    bio = io.BytesIO()
+    with tarfile.open(fileobj = bio, mode = 'w') as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return compress(bio.getvalue(), compression)
+
+
+def ar_bytes(members):
+    out = bytearray(b'!<arch>\n')
+    for name, data in members:
+        out += f'{name:<16}{0:<12}{0:<6}{0:<6}{"100644":<8}{len(data):<10}'.encode() + b'`\n'
+        out += data
+        if len(data) % 2:
+            out += b'\n'
+    return bytes(out)
+
+
+def deb_bytes(files, compression='xz'):
+    """A .deb/.ddeb with a control and data member, readable by python-debian and the streaming parser"""
+    return ar_bytes([
+        ('debian-binary', b'2.0\n'),
+        (f'control.tar.{compression}', tar_bytes([('./control', b'Package: linux-benchmark\n')], compression)),
+        (f'data.tar.{compression}', tar_bytes(files, compression))
+    ])
+
+
+def rpm_header(entries):
+    index = b''
+    store = b''
+    for tag, value in entries:
+        index += struct.pack('>iiii', tag, 6, len(store), 1)
+        store += value + b'\x00'
+    return b'\x8e\xad\xe8\x01\x00\x00\x00\x00' + struct.pack('>ii', len(entries), len(store)) + index + store
+
+
+def cpio_bytes(files):
+    out = bytearray()
+    for inode, (name, data) in enumerate(files + [('TRAILER!!!', b'')]):
+        encoded = name.encode() + b'\x00'
+        fields = [inode, 0o100644, 0, 0, 1, 0, len(data), 0, 0, 0, 0, len(encoded), 0]
+        out += b'070701' + ''.join(f'{value:08x}' for value in fields).encode() + encoded
+        out += b'\x00' * (-(110 + len(encoded)) % 4) + data + b'\x00' * (-len(data) % 4)
+    return bytes(out)
+
+
+def rpm_bytes(files, compression='xz'):
+    """A minimal rpm, lead, empty signature header, a main header naming the payload compressor and a cpio payload"""
+    lead = b'\xed\xab\xee\xdb' + b'\x00' * 92
+    signature = rpm_header([])
+    signature += b'\x00' * (-len(signature) % 8)
+    compressor = b'xz' if compression == 'xz' else b'zstd'
+    header = rpm_header([(1000, b'kernel'), (1124, b'cpio'), (1125, compressor)])
+    return lead + signature + header + compress(cpio_bytes(files), compression)
+
+
+def write(path, data):
+    path.parent.mkdir(parents = True, exist_ok = True)
+    path.write_bytes(data)
+    return path
+
+
+def link(source, path):
+    """Listing entries all point at the same fixture, hard links keep the tree small"""
+    path.parent.mkdir(parents = True, exist_ok = True)
+    if not path.exists():
+        os.link(source, path)
+
+
+def sha256(path):
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def amazon_repodata(path, name, packages):
+    entries = []
+    for href, version, release, package in packages:
+        entries.append(f'''<package type="rpm"><name>{name}</name><arch>x86_64</arch>
+<version epoch="0" ver="{version}" rel="{release}"/>
+<checksum type="sha256" pkgid="YES">{sha256(package)}</checksum>
+<size package="{package.stat().st_size}" installed="0" archive="0"/>
+<location href="{href}"/></package>''')
+    xml = f'<?xml version="1.0" encoding="UTF-8"?>\n<metadata xmlns="{REPO_NS}" packages="{len(entries)}">\n{"".join(entries)}\n</metadata>\n'
+    path.parent.mkdir(parents = True, exist_ok = True)
+    with gzip.open(path, 'wt') as f:
+        f.write(xml)
+
+
+def build(root, vmlinux_size, system_map_size, listing_kernels):
+    """Write the packages and the mirror tree served by `benchmarks.server` under `root`.
+    Returns a dict describing the fixtures, an existing tree built with the same settings is reused"""
+    root = Path(root)
+    settings = {"vmlinux_size": vmlinux_size, "system_map_size": system_map_size, "listing_kernels": listing_kernels,
+                "layout": LAYOUT}
+    stamp = root / 'fixtures.json'
+    if stamp.exists() and json.loads(stamp.read_text())['settings'] == settings:
+        logger.info(f'Reusing fixtures in {root}')
+        return json.loads(stamp.read_text())
+
+    logger.info(f'Building fixtures in {root}, vmlinux {vmlinux_size} bytes')
+    vmlinux = vmlinux_data(vmlinux_size)
+    system_map = system_map_data(system_map_size)
+    www = root / 'www'
+    packages = www / 'packages'
+    # Links from an older build would still point at the old packages
+    shutil.rmtree(www, ignore_errors = True)
+
+    deb_files = [(f'./boot/System.map-{UNAME}', system_map), (f'./boot/config-{UNAME}', b'CONFIG_X86_64=y\n')]
+    ddeb_files = [(f'./usr/lib/debug/boot/vmlinux-{UNAME}', vmlinux)]
+    rpm_map = [(f'./lib/modules/{UNAME}/System.map', system_map)]
+    rpm_vmlinux = [(f'./usr/lib/debug/lib/modules/{UNAME}/vmlinux', vmlinux)]
+
+    fixtures = {
+        "deb-xz": write(packages / 'kernel-xz.deb', deb_bytes(deb_files, 'xz')),
+        "deb-zst": write(packages / 'kernel-zst.deb', deb_bytes(deb_files, 'zst')),
+        "ddeb-xz": write(packages / 'debug-xz.ddeb', deb_bytes(ddeb_files, 'xz')),
+        "ddeb-zst": write(packages / 'debug-zst.ddeb', deb_bytes(ddeb_files, 'zst')),
+        "rpm-xz": write(packages / 'kernel-xz.rpm', rpm_bytes(rpm_map, 'xz')),
+        "rpm-zst": write(packages / 'kernel-zst.rpm', rpm_bytes(rpm_map, 'zst')),
+        "debug-rpm-xz": write(packages / 'debug-xz.rpm', rpm_bytes(rpm_vmlinux, 'xz')),
+        "debug-rpm-zst": write(packages / 'debug-zst.rpm', rpm_bytes(rpm_vmlinux, 'zst')),
+    }
+
+    amazon_kernels = []
+    amazon_debugs = []
+    for number in range(listing_kernels):
+        uname = f'5.4.0-{number + 1}-generic'
+        version = f'5.4.0-{number + 1}.{number + 1}'
+        link(fixtures['deb-xz'], www / f'ubuntu/security/linux-modules-{uname}_{version}_amd64.deb')
+        link(fixtures['ddeb-zst'], www / f'ubuntu/ddebs/linux-image-unsigned-{uname}-dbgsym_{version}_amd64.ddeb')
+
+        debian_uname = f'5.4.0-{number + 1}-amd64'
+        link(fixtures['deb-xz'], www / f'debian/linux-image-{debian_uname}-unsigned_{version}_amd64.deb')
+        link(fixtures['ddeb-xz'], www / f'debian/linux-image-{debian_uname}-dbg_{version}_amd64.deb')
+
+        release = 30 + number % 10
+        fedora_version = f'5.4.{number}-1.fc{release}.x86_64'
+        fedora = www / f'fedora/linux/releases/{release}/Everything/x86_64'
+        link(fixtures['rpm-xz'], fedora / f'os/Packages/k/kernel-core-{fedora_version}.rpm')
+        link(fixtures['debug-rpm-xz'], fedora / f'debug/tree/Packages/k/kernel-debuginfo-{fedora_version}.rpm')
+
+        amazon_release = f'{number + 1}.amzn2'
+        for name, packages_list, fixture in [('kernel', amazon_kernels, 'rpm-xz'),
+                                             ('kernel-debuginfo', amazon_debugs, 'debug-rpm-xz')]:
+            # Relative to the repo like the real repodata, which points a few levels up into the blobstore
+            path = f'amazon/blobstore/{name}-5.4.0-{amazon_release}.x86_64.rpm'
+            link(fixtures[fixture], www / path)
+            packages_list.append((f'../../../{path}', '5.4.0', amazon_release, fixtures[fixture]))
+
+        cbl_version = f'5.15.{number}-1.cm2.x86_64'
+        link(fixtures['rpm-zst'], www / f'cbl/cbl-mariner-2.0-prod-base-x86_64/kernel-{cbl_version}.rpm')
+        link(fixtures['debug-rpm-zst'], www / f'cbl/cbl-mariner-2.0-prod-base-debuginfo-x86_64/kernel-debuginfo-{cbl_version}.rpm')
+
+    for repo, name, packages_list in [('core', 'kernel', amazon_kernels), ('debuginfo', 'kernel-debuginfo', amazon_debugs)]:
+        amazon_repodata(www / f'amazon/{repo}/mirror/repodata/primary.xml.gz', name, packages_list)
+
+    description = {
+        "settings": settings,
+        "uname": UNAME,
+        "packages": {name: path.relative_to(www).as_posix() for name, path in fixtures.items()},
+        "sizes": {name: path.stat().st_size for name, path in fixtures.items()},
+        "www": str(www)
+    }
+    stamp.write_text(json.dumps(description, indent = 2))
+    return description
+
+
+def write_mirror_lists(www, base_url):
+    """mirror.list holds an absolute mirror address so it can only be written once the server port is known"""
+    for repo in ['core', 'debuginfo']:
+        write(Path(www) / f'amazon/{repo}/mirror.list', f'{base_url}/amazon/{repo}/mirror\n'.encode())
@@ -0,0 +1,153 @@
+"""Offline benchmarks for listing, package extraction and ISF creation.
+Synthetic packages and listing pages are served from a local mirror so no network access is needed"""
+import argparse
+import json
+import logging
+import subprocess
+import sys
+import tempfile
+
+from pathlib import Path
+
+from benchmarks import fixtures, server
+from benchmarks.stages import STAGES
+
+
+logger = logging.getLogger(__name__)
+
+ROOT = Path(__file__).resolve().parent.parent
+MB = 1024 * 1024
+
+
+def run_stage(config):
+    """Run a stage in a fresh interpreter so imports, caches and peak RSS do not carry over between stages"""
+    proc = subprocess.run([sys.executable, '-m', 'benchmarks.stages', json.dumps(config)],
+                          cwd = ROOT, stdout = subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{config['stage']} exited with {proc.returncode}")
+    return json.loads(proc.stdout.decode().strip().splitlines()[-1])
+
+
+def report(results):
+    print(f"{'stage':<28}{'MB':>10}{'items':>8}{'wall s':>10}{'MB/s':>10}{'RSS MB':>10}{'tool MB':>10}")
+    for stage, result in results.items():
+        size = result.get('bytes', 0) / MB
+        rate = f"{size / result['wall']:.1f}" if size else '-'
+        print(f"{stage:<28}{size:>10.1f}{result.get('items', '-'):>8}{result['wall']:>10.2f}{rate:>10}"
+              f"{result['rss'] / MB:>10.1f}{result['tool_rss'] / MB:>10.1f}")
+
+
+def main(args):
+    description = fixtures.build(args.fixture_dir,
+                                 int(args.vmlinux_size * MB),
+                                 int(args.system_map_size * MB),
+                                 args.listing_kernels)
+
+    mirror, base_url = server.serve(description['www'])
+    fixtures.write_mirror_lists(description['www'], base_url)
+
+    results = {}
+    with tempfile.TemporaryDirectory(dir = args.fixture_dir) as work_dir:
+        for stage in args.stages or STAGES:
+            config = {
+                "stage": stage,
+                "base_url": base_url,
+                "fixtures": description,
+                "work_dir": work_dir,
+                "isf_size": int(args.isf_size * MB),
+                "compress_threads": args.compress_threads,
+                "verbose": args.verbose
+            }
+            runs = []
+            for _ in range(args.repeat):
+                try:
+                    runs.append(run_stage(config))
+                except Exception as err:
+                    logger.error(f'{stage} failed: {err}')
+                    break
+            if runs:
+                # Best of the repeats, the others mostly measure noise from the rest of the machine
+                results[stage] = min(runs, key = lambda result: result['wall'])
+
+    mirror.shutdown()
+    report(results)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent = 2))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Benchmark listing, extraction and ISF creation against a local mirror")
+    parser.add_argument("--fixture-dir",
+                        dest = 'fixture_dir',
+                        default = str(Path(tempfile.gettempdir(), 'volatility_symbols_benchmarks')),
+                        help = "Directory for the generated packages, reused while the sizes are unchanged",
+                        required = False)
+
+    parser.add_argument("--vmlinux-size",
+                        dest = 'vmlinux_size',
+                        type = float,
+                        default = 64,
+                        help = "Size of the vmlinux in the debug packages in MB",
+                        required = False)
+
+    parser.add_argument("--system-map-size",
+                        dest = 'system_map_size',
+                        type = float,
+                        default = 4,
+                        help = "Size of the System.map in the kernel packages in MB",
+                        required = False)
+
+    parser.add_argument("--listing-kernels",
+                        dest = 'listing_kernels',
+                        type = int,
+                        default = 200,
+                        help = "Number of kernels in each fake listing page",
+                        required = False)
+
+    parser.add_argument("--isf-size",
+                        dest = 'isf_size',
+                        type = float,
+                        default = 64,
+                        help = "Size of the JSON written by the fake dwarf2json in MB",
+                        required = False)
+
+    parser.add_argument("--compress-threads",
+                        dest = 'compress_threads',
+                        type = int,
+                        help = "Number of xz compression threads for the isf stage",
+                        required = False)
+
+    parser.add_argument("--stages",
+                        dest = 'stages',
+                        nargs = '+',
+                        choices = STAGES,
+                        help = "Stages to run, defaults to all of them",
+                        required = False)
+
+    parser.add_argument("--repeat",
+                        dest = 'repeat',
+                        type = int,
+                        default = 1,
+                        help = "Run each stage this many times and report the fastest",
+                        required = False)
+
+    parser.add_argument("-o",
+                        "--output",
+                        dest = 'output',
+                        help = "Also write the results to this JSON file",
+                        required = False)
+
+    parser.add_argument("-v",
+                        "--verbose",
+                        dest = 'verbose',
+                        action = 'store_true',
+                        help = "Verbose Debug logging",
+                        required = False)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.INFO)
+
+    main(args)
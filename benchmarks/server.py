@@ -0,0 +1,107 @@
+import logging
+import os
+import re
+import sys
+import threading
+
+from email.utils import formatdate
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 1024 * 1024
+
+
+class MirrorHandler(SimpleHTTPRequestHandler):
+    """Serves a fixture tree like a package mirror, autoindex listings for directories,
+    ETag and Last-Modified on files and single byte ranges for resumed downloads"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_head(self):
+        self.remaining = None
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            # Directory listings and the trailing slash redirect are handled by the base class
+            return super().send_head()
+
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404, 'File not found')
+            return None
+
+        stat = os.fstat(f.fileno())
+        size = stat.st_size
+        etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+        start, end = 0, size - 1
+
+        match = RANGE_PATTERN.match(self.headers.get('Range', ''))
+        if_range = self.headers.get('If-Range')
+        if match and (if_range is None or if_range == etag) and any(match.groups()):
+            first, last = match.groups()
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(size - int(last), 0)
+            if start >= size:
+                f.close()
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', formatdate(stat.st_mtime, usegmt = True))
+        self.end_headers()
+
+        f.seek(start)
+        self.remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = self.remaining
+        if remaining is None:
+            return super().copyfile(source, outputfile)
+        while remaining > 0:
+            chunk = source.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            remaining -= len(chunk)
+        self.remaining = None
+
+
+class MirrorServer(ThreadingHTTPServer):
+
+    def handle_error(self, request, client_address):
+        # Clients hang up part way through a body once they have what they need
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def serve(root, host='127.0.0.1', port=0):
+    """Start a mirror for `root` on a background thread, returns the server and its base URL"""
+    server = MirrorServer((host, port), partial(MirrorHandler, directory = str(root)))
+    server.daemon_threads = True
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    base_url = f'http://{host}:{server.server_address[1]}'
+    logger.info(f'Serving {root} at {base_url}')
+    return server, base_url
@@ -0,0 +1,198 @@
+"""Runs one benchmark stage, started by `benchmarks.run` in its own process so peak RSS is per stage.
+Logs go to stderr and the result is printed to stdout as a single JSON object"""
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import isf_server
+import symbol_maker
+
+from distributions.ubuntu_base import UbuntuBase
+from distributions.debian_base import DebianBase
+from distributions.fedora_base import FedoraBase
+from distributions.amazon_base import AmazonBase
+from distributions.cbl_mariner_base import CBLMariner
+from parsers import debfiles, download, rpmfiles
+from utils import listing_cache, package_cache, transport
+from utils.metrics import max_rss
+from utils.banner_index import BannerIndex
+
+
+logger = logging.getLogger(__name__)
+
+DISTROS = ['ubuntu', 'debian', 'fedora', 'amazon', 'cbl-mariner']
+EXTRACT_MODES = ['stream', 'spool', 'cache', 'local']
+EXTRACT_PACKAGES = {
+    "deb-xz": 'ddeb-xz',
+    "deb-zst": 'ddeb-zst',
+    "rpm-xz": 'debug-rpm-xz',
+    "rpm-zst": 'debug-rpm-zst'
+}
+
+STAGES = ([f'listing-{distro}' for distro in DISTROS] +
+          [f'listing-{distro}-warm' for distro in DISTROS] +
+          [f'extract-{mode}-{package}' for mode in EXTRACT_MODES for package in EXTRACT_PACKAGES] +
+          ['isf', 'serve'])
+
+# ISFs served and how many times each is fetched, by SERVE_CLIENTS connections at once
+SERVE_FILES = 4
+SERVE_FETCHES = 8
+SERVE_CLIENTS = 4
+
+
+def make_distro(name, base_url):
+    """Build a distro object and point its URLs at the local mirror"""
+    if name == 'ubuntu':
+        distro = UbuntuBase('linux')
+        distro.kernel_url = f'{base_url}/ubuntu/security/'
+        distro.debug_url = f'{base_url}/ubuntu/ddebs/'
+    elif name == 'debian':
+        distro = DebianBase('linux')
+        distro.kernel_url = f'{base_url}/debian/'
+    elif name == 'fedora':
+        distro = FedoraBase('linux')
+        distro.base_url = f'{base_url}/fedora/linux/releases/'
+        distro.search_urls = [distro.base_url]
+    elif name == 'amazon':
+        distro = AmazonBase('2')
+        distro.kernel_url = f'{base_url}/amazon/core/mirror.list'
+        distro.debug_url = f'{base_url}/amazon/debuginfo/mirror.list'
+    elif name == 'cbl-mariner':
+        distro = CBLMariner('linux')
+        distro.base_url = f'{base_url}/cbl'
+    return distro
+
+
+def run_listing(config, distro_name, warm):
+    cache_dir = Path(config['work_dir'], 'listings', distro_name)
+    if not warm:
+        shutil.rmtree(cache_dir, ignore_errors = True)
+    listing_cache.configure(cache_dir = cache_dir)
+
+    distro = make_distro(distro_name, config['base_url'])
+    distro.get_kernel_list('all')
+    return {"items": len(distro.kernel_pairs)}
+
+
+def run_extract(config, mode, package):
+    fixture = EXTRACT_PACKAGES[package]
+    url = f"{config['base_url']}/{config['fixtures']['packages'][fixture]}"
+    if mode == 'local':
+        # Read in place from the fixture tree as if it were a local mirror
+        url = Path(config['fixtures']['www'], config['fixtures']['packages'][fixture]).resolve().as_uri()
+
+    download.configure(spool_dir = config['work_dir'], mode = 'spool' if mode == 'spool' else 'stream')
+    if mode == 'cache':
+        # Always a cold cache, a warm one only measures a local file read
+        cache_dir = Path(config['work_dir'], 'package_cache')
+        shutil.rmtree(cache_dir, ignore_errors = True)
+        package_cache.configure(cache_dir = cache_dir)
+
+    if package.startswith('deb'):
+        outfile = debfiles.process_deb(url, 'boot/vmlinux', config['fixtures']['uname'])
+    else:
+        outfile = rpmfiles.process_rpm(url, 'vmlinux')
+    if not outfile:
+        raise RuntimeError(f'vmlinux not extracted from {url}')
+
+    extracted = os.path.getsize(outfile)
+    os.remove(outfile)
+    return {"bytes": config['fixtures']['sizes'][fixture], "extracted": extracted}
+
+
+def run_isf(config):
+    work_dir = Path(config['work_dir'], 'isf')
+    shutil.rmtree(work_dir, ignore_errors = True)
+    work_dir.mkdir(parents = True)
+    system_map = work_dir / 'System.map'
+    vmlinux = work_dir / 'vmlinux'
+    system_map.write_bytes(b'')
+    vmlinux.write_bytes(b'')
+
+    os.environ['FAKE_DWARF2JSON_SIZE'] = str(config['isf_size'])
+    dwarf2json = Path(__file__).resolve().parent / 'fake_dwarf2json.py'
+    banner = symbol_maker.create_isf(system_map, vmlinux, 'benchmark', work_dir,
+                                     config.get('compress_threads'), dwarf2json, isf_format = 'xz')
+    if banner is None:
+        raise RuntimeError('No banner found in ISF output')
+
+    return {"bytes": config['isf_size'],
+            "compressed": (work_dir / 'benchmark.json.xz').stat().st_size}
+
+
+def run_serve(config):
+    """Fetch ISFs of isf_size bytes from isf_server over keep-alive connections, as Volatility would"""
+    root = Path(config['work_dir'], 'serve')
+    shutil.rmtree(root, ignore_errors = True)
+    index = BannerIndex(root)
+    block = os.urandom(1024 * 1024)
+    for number in range(SERVE_FILES):
+        kernel = f'5.4.0-{number}-generic'
+        isf_path = root / 'ubuntu' / kernel / f'{kernel}.json.xz'
+        isf_path.parent.mkdir(parents = True)
+        with open(isf_path, 'wb') as f:
+            for _ in range(config['isf_size'] // len(block)):
+                f.write(block)
+            f.write(block[:config['isf_size'] % len(block)])
+        index.add(isf_path, f'Linux version {kernel}\n\x00'.encode(), 'ubuntu', kernel)
+    index.close()
+
+    server, base_url = isf_server.serve(root, port = 0)
+    urls = [url for urls in transport.get(f'{base_url}/banners.json').json()['linux'].values() for url in urls]
+
+    def fetch(url):
+        with transport.get(url, stream = True) as r:
+            r.raise_for_status()
+            return sum(len(chunk) for chunk in r.iter_content(chunk_size = download.CHUNK_SIZE))
+
+    with ThreadPoolExecutor(max_workers = SERVE_CLIENTS) as executor:
+        fetched = sum(executor.map(fetch, urls * SERVE_FETCHES))
+    server.shutdown()
+    return {"bytes": fetched, "items": len(urls) * SERVE_FETCHES}
+
+
+def peak_rss():
+    """High water mark of this process in bytes. ru_maxrss also counts the parent's memory at fork
+    time on Linux, VmHWM is reset by exec so use it where there is one"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return max_rss(resource.getrusage(resource.RUSAGE_SELF))
+
+
+def run(config):
+    stage = config['stage']
+    if stage == 'isf':
+        return run_isf(config)
+    if stage == 'serve':
+        return run_serve(config)
+    if stage.startswith('listing-'):
+        name = stage[len('listing-'):]
+        warm = name.endswith('-warm')
+        return run_listing(config, name[:-len('-warm')] if warm else name, warm)
+    _, mode, package = stage.split('-', 2)
+    return run_extract(config, mode, package)
+
+
+if __name__ == '__main__':
+    config = json.loads(sys.argv[1])
+    logging.basicConfig(level = logging.DEBUG if config.get('verbose') else logging.WARNING, stream = sys.stderr)
+
+    start = time.perf_counter()
+    result = run(config)
+    result['wall'] = time.perf_counter() - start
+    result['rss'] = peak_rss()
+    # dwarf2json and any other tools this stage started, an upper bound as it includes this process at fork time
+    result['tool_rss'] = max_rss(resource.getrusage(resource.RUSAGE_CHILDREN))
+    print(json.dumps(result))
@@ -1,68 +1,65 @@
 import logging
-import re
 import gzip
-import requests
-from requests.api import request
 
-from parsers import rpmfiles
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urljoin
+from xml.etree import ElementTree
+
+from parsers import download, listing, rpmfiles
+from utils import listing_cache, mirrors, transport
 
 logger = logging.getLogger(__name__)
 
+REPO_NS = '{http://linux.duke.edu/metadata/common}'
+
 
 class AmazonBase:
     def __init__(self, branch):
         self.operating_system = 'amazonlinux'
         self.supported_base = ['2']
-        self.kernel_pattern = b'(/blobstore/.*?/kernel-([0-9].*?).rpm)'
-        self.debug_pattern = b'(/blobstore/.*?/kernel-debuginfo-([0-9].*?).rpm)'
+        self.kernel_package = 'kernel'
+        self.debug_package = 'kernel-debuginfo'
         self.kernel_pairs = {}
         
         if branch in self.supported_base:
-            self.base_url = 'http://amazonlinux.us-east-1.amazonaws.com'
             self.kernel_url = 'http://amazonlinux.us-east-1.amazonaws.com/2/core/latest/x86_64/mirror.list'
             self.debug_url = 'http://amazonlinux.us-east-1.amazonaws.com/2/core/latest/debuginfo/x86_64/mirror.list'
+            # Every region serves the same blobstore paths
+            self.mirror_urls = ['http://amazonlinux.us-east-1.amazonaws.com',
+                                'http://amazonlinux.us-west-2.amazonaws.com',
+                                'http://amazonlinux.eu-west-1.amazonaws.com']
+            mirrors.register(self.mirror_urls)
         else:
-            logger.error(f'Unsupported Target {branch}')
-            exit()
+            raise ValueError(f"Unsupported Target {branch}, expected one of {', '.join(self.supported_base)}")
 
 
     def get_kernel_list(self, kernel_filter):
-        """Parses the `kernel_url` for any matching kernel deb files"""
-        logger.info(f'Fetching list of kernels from {self.kernel_url}')
-
-        # We need to read the mirror address from the mirror.list
-        kernel_mirror = requests.get(self.kernel_url).text.rstrip('\n')
+        """Parses the repodata behind `kernel_url` and `debug_url` for matching kernel rpm files"""
+        logger.info(f'Fetching list of kernels from {self.kernel_url} and {self.debug_url}')
 
-        # Then Read the XML and uncompress it
-        kernel_xml_path = f'{kernel_mirror}/repodata/primary.xml.gz'
-        kernel_xml = requests.get(kernel_xml_path)
-        kernel_xml_data = gzip.decompress(kernel_xml.content)
+        # The core and debuginfo repos are independent so read them together
+        with ThreadPoolExecutor(max_workers = 2) as executor:
+            kernel_future = executor.submit(self.read_repodata, self.kernel_url, self.kernel_package)
+            debug_future = executor.submit(self.read_repodata, self.debug_url, self.debug_package)
+            kernel_list = kernel_future.result()
+            debug_list = debug_future.result()
 
-        # Now search for matching kernels
-        kernel_list = re.findall(self.kernel_pattern, kernel_xml_data)
+        for kernel_rpm, debug_rpm in listing.pair_packages(kernel_list, debug_list):
+            kernel_string = kernel_rpm.uname
 
-        # Repeat all the steps for debugs, we need to blobstore path
-        logger.info(f'Fetching list of debug kernels from {self.debug_url}')
-        debug_mirror = requests.get(self.debug_url).text.rstrip('\n')
-        debug_xml_path = f'{debug_mirror}/repodata/primary.xml.gz'
-        debug_xml = requests.get(debug_xml_path)
-        debug_xml_data = gzip.decompress(debug_xml.content)
-
-        debug_list = re.findall(self.debug_pattern, debug_xml_data)
-
-        for match in kernel_list:
-            kernel_rpm = match[0].decode()
-            kernel_string = match[1].decode()
-
-            for debug_match in debug_list:
-                if kernel_string == debug_match[1].decode():
-                    debug_rpm = debug_match[0].decode()
-                    break
+            if debug_rpm is None:
+                logger.warning(f'Unable to find matching debug rpm for {kernel_string}')
+                continue
 
             if kernel_filter == 'all' or kernel_string == kernel_filter:
                 self.kernel_pairs[kernel_string] = {
-                    "kernel_rpm": f'{self.base_url}{kernel_rpm}',
-                    "debug_rpm": f'{self.base_url}{debug_rpm}',
+                    "kernel_rpm": kernel_rpm.path,
+                    "debug_rpm": debug_rpm.path,
+                    "kernel_size": kernel_rpm.size,
+                    "debug_size": debug_rpm.size,
+                    "kernel_checksum": kernel_rpm.checksum,
+                    "debug_checksum": debug_rpm.checksum,
                     "valid": False,
                     "banner": '',
                     "isf_file": False
@@ -70,19 +67,61 @@ class AmazonBase:
             else:
                 logger.debug('Ignored by filter')
 
+    def read_repodata(self, mirror_list_url, package_name):
+        """Returns a KernelPackage for every `package_name` entry in a repo's primary.xml.gz, with the
+        full package URL as its path. The file is decompressed and parsed incrementally so memory use
+        does not grow with its size"""
 
+        # We need to read the mirror address from the mirror.list
+        mirror = listing_cache.get(mirror_list_url).text.rstrip('\n')
+        primary_xml = listing_cache.get(f'{mirror}/repodata/primary.xml.gz')
+        if primary_xml.status_code != 200:
+            raise IOError(f'Could not fetch repodata from {mirror}: {primary_xml.status_code}')
+
+        packages = []
+        with gzip.open(primary_xml.path) as f:
+            events = ElementTree.iterparse(f, events = ('start', 'end'))
+            _, root = next(events)
+            for event, element in events:
+                if event != 'end' or element.tag != f'{REPO_NS}package':
+                    continue
+
+                if element.findtext(f'{REPO_NS}name') == package_name:
+                    version = element.find(f'{REPO_NS}version')
+                    arch = element.findtext(f'{REPO_NS}arch')
+                    checksum = element.find(f'{REPO_NS}checksum')
+                    release = f"{version.get('ver')}-{version.get('rel')}"
+                    packages.append(listing.KernelPackage(
+                        f'{release}.{arch}',
+                        release,
+                        arch,
+                        '',
+                        # Locations are relative to the repo e.g. ../../../../../blobstore/<hash>/kernel-....rpm
+                        urljoin(f'{mirror}/', element.find(f'{REPO_NS}location').get('href')),
+                        int(element.find(f'{REPO_NS}size').get('package')),
+                        f"{checksum.get('type')}:{checksum.text}"))
+
+                # Drop parsed packages so the tree never holds more than one
+                root.clear()
+
+        logger.info(f'Found {len(packages)} {package_name} packages in {mirror}')
+        return packages
 
     def validate_links(self, kernel):
         """For each pair of RPM files make HEAD requests to confirm files are present"""
-        logger.info('Validating remote files exist')
+        logger.debug(f'Validating remote files exist for {kernel}')
         valid = False
         rpm_files = self.kernel_pairs[kernel]
 
-        deb_head = requests.head(rpm_files['kernel_rpm']).status_code
-        debug_head = requests.head(rpm_files['debug_rpm']).status_code
+        deb_response = transport.head(rpm_files['kernel_rpm'])
+        debug_response = transport.head(rpm_files['debug_rpm'])
+        deb_head = deb_response.status_code
+        debug_head = debug_response.status_code
 
         if deb_head == debug_head == 200:
             self.kernel_pairs[kernel]['valid'] = True
+            self.kernel_pairs[kernel]['kernel_size'] = transport.content_length(deb_response)
+            self.kernel_pairs[kernel]['debug_size'] = transport.content_length(debug_response)
             valid = True
         else:
             logger.warning(f'{kernel} Kernel Deb returned {deb_head}, Debug Deb Returned {debug_head}')
@@ -90,9 +129,13 @@ class AmazonBase:
         return valid
 
 
-    def extract_files(self, symbol_set):
+    def extract_files(self, symbol_set, *args):
         logger.info('Processing RPMS')
-        system_map = rpmfiles.process_rpm(symbol_set['kernel_rpm'], 'System.map')
-        vmlinux = rpmfiles.process_rpm(symbol_set['debug_rpm'], 'vmlinux')
+        # Repodata checksums let the package cache skip the HEAD request
+        system_map, vmlinux = download.fetch_pair(
+            partial(rpmfiles.process_rpm, symbol_set['kernel_rpm'], 'System.map',
+                    checksum = symbol_set.get('kernel_checksum')),
+            partial(rpmfiles.process_rpm, symbol_set['debug_rpm'], 'vmlinux',
+                    checksum = symbol_set.get('debug_checksum')))
 
         return system_map, vmlinux
@@ -1,10 +1,11 @@
 import logging
 import re
 import gzip
-import requests
-from requests.api import request
 
-from parsers import rpmfiles
+from functools import partial
+
+from parsers import download, rpmfiles
+from utils import listing_cache, transport
 
 logger = logging.getLogger(__name__)
 
@@ -19,8 +20,7 @@ class CBLMariner:
         if branch in self.supported_base:
             self.base_url = 'https://packages.microsoft.com/yumrepos'
         else:
-            logger.error(f'Unsupported Target {branch}')
-            exit()
+            raise ValueError(f"Unsupported Target {branch}, expected one of {', '.join(self.supported_base)}")
 
 
     def get_kernel_list(self, kernel_filter):
@@ -31,7 +31,7 @@ class CBLMariner:
         for folder in folders:
             url = f'{self.base_url}/cbl-mariner-2.0-{folder}-base-x86_64'
             logger.debug(f'Checking {url}')
-            page_data = requests.get(url)
+            page_data = listing_cache.get(url)
             # If its 200 its the correct page
             if page_data.status_code == 200:
                 rpm_data = re.findall(self.kernel_pattern, page_data.text)
@@ -53,15 +53,19 @@ class CBLMariner:
 
     def validate_links(self, kernel):
         """For each pair of RPM files make HEAD requests to confirm files are present"""
-        logger.info('Validating remote files exist')
+        logger.debug(f'Validating remote files exist for {kernel}')
         valid = False
         rpm_files = self.kernel_pairs[kernel]
 
-        kernel_head = requests.head(rpm_files['kernel_rpm']).status_code
-        debug_head = requests.head(rpm_files['debug_rpm']).status_code
+        kernel_response = transport.head(rpm_files['kernel_rpm'])
+        debug_response = transport.head(rpm_files['debug_rpm'])
+        kernel_head = kernel_response.status_code
+        debug_head = debug_response.status_code
 
         if kernel_head == debug_head == 200:
             self.kernel_pairs[kernel]['valid'] = True
+            self.kernel_pairs[kernel]['kernel_size'] = transport.content_length(kernel_response)
+            self.kernel_pairs[kernel]['debug_size'] = transport.content_length(debug_response)
             valid = True
         else:
             logger.warning(f'{kernel} Kernel RPM returned {kernel_head}, Debug RPM Returned {debug_head}')
@@ -69,10 +73,11 @@ class CBLMariner:
         return valid
 
 
-    def extract_files(self, symbol_set):
+    def extract_files(self, symbol_set, *args):
         logger.info('Processing RPMS')
         kernel = symbol_set['kernel']
-        system_map = rpmfiles.process_rpm(symbol_set['kernel_rpm'], 'System.map')
-        vmlinux = rpmfiles.process_rpm(symbol_set['debug_rpm'], f'vmlinux-{kernel}')
+        system_map, vmlinux = download.fetch_pair(
+            partial(rpmfiles.process_rpm, symbol_set['kernel_rpm'], 'System.map'),
+            partial(rpmfiles.process_rpm, symbol_set['debug_rpm'], f'vmlinux-{kernel}'))
 
         return system_map, vmlinux
@@ -1,8 +1,9 @@
 import logging
-import re
-import requests
 
-from parsers import debfiles
+from functools import partial
+
+from parsers import download, debfiles, listing
+from utils import listing_cache, mirrors, transport
 
 logger = logging.getLogger(__name__)
 
@@ -11,45 +12,37 @@ class DebianBase:
     def __init__(self, branch):
         self.operating_system = 'debian'
         self.supported_base = ['linux', 'linux-aws', 'linux-azure', 'linux-gcp']
-        self.search_pattern = '<a href="(linux-image-(.*?)_.*deb)">'
+        # Unsigned images and their -dbg symbols are both in the same pool directory
+        self.kernel_pattern = '<a href="(?P<path>linux-image-(?P<uname>[0-9][^_"]*?)(?:-unsigned)?(?<!-dbg)_(?P<version>[^_"]+)_(?P<arch>[^_."]+)\\.deb)">'
+        self.debug_pattern = '<a href="(?P<path>linux-image-(?P<uname>[0-9][^_"]*?)-dbg_(?P<version>[^_"]+)_(?P<arch>[^_."]+)\\.deb)">'
         self.kernel_pairs = {}
         
         if branch in self.supported_base:
             self.kernel_url = 'http://ftp.us.debian.org/debian/pool/main/l/linux/'
+            self.mirror_urls = ['http://ftp.us.debian.org/debian/',
+                                'http://deb.debian.org/debian/',
+                                'http://ftp.debian.org/debian/']
+            mirrors.register(self.mirror_urls)
         else:
-            logger.error(f'Unsupported Target {branch}')
-            exit()
+            raise ValueError(f"Unsupported Target {branch}, expected one of {', '.join(self.supported_base)}")
 
     def get_kernel_list(self, kernel_filter):
         """Parses the `kernel_url` for any matching kernel deb files"""
         logger.info(f'Fetching list of kernels from {self.kernel_url}')
-        kernel_list = requests.get(self.kernel_url)
-        kernel_debs = re.findall(self.search_pattern, kernel_list.text)
-
+        kernel_list = listing_cache.get(self.kernel_url)
+        kernel_debs = listing.parse_packages(self.kernel_pattern, kernel_list.text)
+        debug_debs = listing.parse_packages(self.debug_pattern, kernel_list.text)
 
         logger.info('Searching for Debian Packages')
-        for match in kernel_debs:
-
-            deb_path = match[0]
-            kernel_string = match[1].split('-unsigned')[0]
-
-            # Ignore some of the results to prevent duplicates
-            if any(x in kernel_string for x in ['-dbg']):
-                continue
+        for kernel_deb, debug_deb in listing.pair_packages(kernel_debs, debug_debs):
+            kernel_string = kernel_deb.uname
             logger.debug(f'Found: {kernel_string}')
 
-            # Find the matching debug symbols
-            debug_deb = None
-            for debug in kernel_debs:
-                if f'linux-image-{kernel_string}-dbg' in debug[0]:
-                    debug_deb = f'{self.kernel_url}{debug[0]}'
-                    break
-
             if debug_deb:
-                if kernel_filter == 'all' or match == kernel_filter:
+                if kernel_filter == 'all' or kernel_string == kernel_filter:
                     self.kernel_pairs[kernel_string] = {
-                        "kernel_deb": f'{self.kernel_url}{deb_path}',
-                        "debug_deb": debug_deb,
+                        "kernel_deb": f'{self.kernel_url}{kernel_deb.path}',
+                        "debug_deb": f'{self.kernel_url}{debug_deb.path}',
                         "valid": False,
                         "banner": '',
                         "isf_file": False
@@ -61,15 +54,19 @@ class DebianBase:
 
     def validate_links(self, kernel):
         """For each pair of deb files make HEAD requests to confirm files are present"""
-        logger.info('Validating remote files exist')
+        logger.debug(f'Validating remote files exist for {kernel}')
         valid = False
         deb_files = self.kernel_pairs[kernel]
 
-        deb_head = requests.head(deb_files['kernel_deb']).status_code
-        debug_head = requests.head(deb_files['debug_deb']).status_code
+        deb_response = transport.head(deb_files['kernel_deb'])
+        debug_response = transport.head(deb_files['debug_deb'])
+        deb_head = deb_response.status_code
+        debug_head = debug_response.status_code
 
         if deb_head == debug_head == 200:
             self.kernel_pairs[kernel]['valid'] = True
+            self.kernel_pairs[kernel]['kernel_size'] = transport.content_length(deb_response)
+            self.kernel_pairs[kernel]['debug_size'] = transport.content_length(debug_response)
             valid = True
         else:
             logger.warning(f'{kernel} Kernel Deb returned {deb_head}, Debug Deb Returned {debug_head}')
@@ -77,9 +74,10 @@ class DebianBase:
         return valid
 
 
-    def extract_files(self, symbol_set):
+    def extract_files(self, symbol_set, *args):
         logger.info('Processing Debs')
-        system_map = debfiles.process_deb(symbol_set['kernel_deb'], 'System.map')
-        vmlinux = debfiles.process_deb(symbol_set['debug_deb'], 'boot/vmlinux')
+        system_map, vmlinux = download.fetch_pair(
+            partial(debfiles.process_deb, symbol_set['kernel_deb'], 'System.map', args[0]),
+            partial(debfiles.process_deb, symbol_set['debug_deb'], 'boot/vmlinux', args[0]))
 
         return system_map, vmlinux
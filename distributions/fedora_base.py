@@ -1,8 +1,13 @@
+import json
 import logging
 import re
-import requests
+import time
 
-from parsers import rpmfiles
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from parsers import download, rpmfiles
+from utils import listing_cache, mirrors, transport
 
 logger = logging.getLogger(__name__)
 
@@ -18,98 +23,170 @@ class FedoraBase:
             self.base_url = 'http://ftp.pbone.net/mirror/download.fedora.redhat.com/pub/fedora/linux/releases/'
             self.kernel_url = 'http://ftp.us.debian.org/debian/pool/main/l/linux/'
             self.debug_url = 'http://ftp.pbone.net/mirror/download.fedora.redhat.com/pub/fedora/linux/releases/'
+            self.search_urls = [
+                'https://archives.fedoraproject.org/pub/archive/fedora/linux/releases/',
+                'https://archives.fedoraproject.org/pub/archive/fedora/linux/updates/',
+                'http://ftp.pbone.net/mirror/download.fedora.redhat.com/pub/fedora/linux/releases/',
+                'http://ftp.pbone.net/mirror/download.fedora.redhat.com/pub/fedora/linux/updates/'
+            ]
+            # The archive only holds end of life releases and pbone copies the live tree, so each is only
+            # interchangeable with the Fedora master that serves the same paths
+            self.mirror_sets = [['https://archives.fedoraproject.org/pub/archive/fedora/linux/',
+                                 'https://dl.fedoraproject.org/pub/archive/fedora/linux/'],
+                                ['http://ftp.pbone.net/mirror/download.fedora.redhat.com/pub/fedora/linux/',
+                                 'https://dl.fedoraproject.org/pub/fedora/linux/']]
+            for mirror_urls in self.mirror_sets:
+                mirrors.register(mirror_urls)
+            # There are 2 variations of path depending on version
+            self.path_variants = ['Everything/x86_64/', 'x86_64/']
+            self.crawl_jobs = 8
+            # Which variant each release uses is remembered between runs
+            self.layout_file = listing_cache.CACHE_DIR / 'fedora_layouts.json'
+            # Releases with no debug tree are checked again after a week
+            self.layout_recheck = 7 * 24 * 60 * 60
         else:
-            logger.error(f'Unsupported Target {branch}')
-            exit()
+            raise ValueError(f"Unsupported Target {branch}, expected one of {', '.join(self.supported_base)}")
 
 
     def get_kernel_list(self, kernel_filter):
-        """Parses the `kernel_url` for any matching kernel deb files"""
+        """Crawls the release trees in `search_urls` for matching kernel debuginfo rpm files"""
         logger.info(f'Fetching list of kernels from {self.base_url}')
 
-        search_urls = [
-            'https://archives.fedoraproject.org/pub/archive/fedora/linux/releases/',
-            'https://archives.fedoraproject.org/pub/archive/fedora/linux/updates/',
-            'http://ftp.pbone.net/mirror/download.fedora.redhat.com/pub/fedora/linux/releases/',
-            'http://ftp.pbone.net/mirror/download.fedora.redhat.com/pub/fedora/linux/updates/'
-
-        ]
-
-        # Check each Search Page for a list of releases
-        for base_url in search_urls:
-
-            pattern = '<a href=.*>([0-9]{1,2}/)</a>'
-
-            page_text = requests.get(base_url).text
-            pages_list = re.findall(pattern, page_text)
-            logger.info(f"Found {len(pages_list)} releases for {base_url}")
-
-            # For each Release
-            for release in pages_list:
-                # Dir strucutre changes in 25
-                if int(release[:-1]) < 25:
-                    sub_path = 'debug/'
-                elif 'linux/releases/' in base_url:
-                    sub_path = 'debug/tree/Packages/k/'
+        layouts = self.load_layouts()
+
+        with ThreadPoolExecutor(max_workers = self.crawl_jobs) as executor:
+            # Check each Search Page for a list of releases
+            release_pages = list(executor.map(self.get_releases, self.search_urls))
+
+            # Probe every release, and each path variant where the layout is not known yet
+            probes = []
+            for base_url, releases in zip(self.search_urls, release_pages):
+                for release in releases:
+                    release_url = f'{base_url}{release}'
+                    for variant in self.layout_variants(layouts, release_url):
+                        future = executor.submit(self.probe_release, base_url, release, variant)
+                        probes.append((release_url, variant, future))
+
+            found = {}
+            for release_url, variant, future in probes:
+                try:
+                    rpm_data = future.result()
+                except Exception as err:
+                    logger.warning(f'Could not check {release_url}{variant}: {err}')
+                    continue
+                if rpm_data is not None:
+                    found[release_url] = variant
+                    self.add_kernels(rpm_data, kernel_filter)
                 else:
-                    sub_path = 'debug/Packages/k/'
-
-                
-                # There are 2 variations of path depending on version
-                # # Check them both    
-                for debug_page in [
-                        f'{base_url}{release}Everything/x86_64/{sub_path}',
-                        f'{base_url}{release}x86_64/{sub_path}']:
-                    logger.debug(f'Checking {debug_page}')
-                    page_data = requests.get(debug_page)
-
-                    # If its 200 its the correct page
-                    if page_data.status_code == 200:
-                        rpm_data = re.findall(self.debug_pattern, page_data.text)
-                        for rpm_name, kernel_name in rpm_data:
-                            if 'common' in kernel_name:
-                                continue
-                            logger.debug(f'Found {kernel_name} on {debug_page}')
-                            debug_rpm = f'{debug_page}{rpm_name}'
-
-                            # Remove the debug name
-                            kernel_rpm = debug_rpm.replace('-debuginfo-', '-core-')
-
-                            # get the new path
-                            if '/tree/Packages/' in debug_rpm:
-                                kernel_rpm = kernel_rpm.replace('/debug/tree/Packages/', '/os/Packages/')
-                            elif 'Everything/' in debug_rpm:
-                                kernel_rpm = kernel_rpm.replace('/debug/', '/os/Packages/')
-                            else:
-                                kernel_rpm = kernel_rpm.replace('/debug/', '/')
-
-                            # I hate the lack of consistency!
-                            kernel_rpm.replace('/Packages/Packages/', '/Packages/')
-
-                            if kernel_filter == 'all' or kernel_name == kernel_filter:
-                                # Add to data set
-                                self.kernel_pairs[kernel_name] = {
-                                    "debug_rpm": debug_rpm,
-                                    "kernel_rpm": kernel_rpm,
-                                    "valid": False,
-                                    "banner": '',
-                                    "isf_file": False
-                                    }
-                            else:
-                                logger.debug('Ignored by filter')
+                    found.setdefault(release_url, None)
+
+        for release_url, variant in found.items():
+            layouts[release_url] = {"variant": variant, "checked": time.time()}
+        self.save_layouts(layouts)
+
+    def get_releases(self, base_url):
+        pattern = '<a href=.*>([0-9]{1,2}/)</a>'
+
+        page_text = listing_cache.get(base_url).text
+        pages_list = re.findall(pattern, page_text)
+        logger.info(f"Found {len(pages_list)} releases for {base_url}")
+        return pages_list
+
+    def layout_variants(self, layouts, release_url):
+        """Path variants to probe for a release, only the known one if we have seen it before"""
+        layout = layouts.get(release_url)
+        if layout:
+            if layout['variant'] is not None:
+                return [layout['variant']]
+            # Nothing was found last time, only look again once the recheck period is up
+            if time.time() - layout['checked'] < self.layout_recheck:
+                return []
+        return self.path_variants
+
+    def probe_release(self, base_url, release, variant):
+        """Fetch one candidate debug page, returns the (debug_page, matches) or None if it does not exist"""
+        # Dir strucutre changes in 25
+        if int(release[:-1]) < 25:
+            sub_path = 'debug/'
+        elif 'linux/releases/' in base_url:
+            sub_path = 'debug/tree/Packages/k/'
+        else:
+            sub_path = 'debug/Packages/k/'
+
+        debug_page = f'{base_url}{release}{variant}{sub_path}'
+        logger.debug(f'Checking {debug_page}')
+        page_data = listing_cache.get(debug_page)
+
+        # If its 200 its the correct page
+        if page_data.status_code != 200:
+            return None
+        return debug_page, re.findall(self.debug_pattern, page_data.text)
+
+    def add_kernels(self, rpm_data, kernel_filter):
+        debug_page, matches = rpm_data
+        for rpm_name, kernel_name in matches:
+            if 'common' in kernel_name:
+                continue
+            logger.debug(f'Found {kernel_name} on {debug_page}')
+            debug_rpm = f'{debug_page}{rpm_name}'
+
+            # Remove the debug name
+            kernel_rpm = debug_rpm.replace('-debuginfo-', '-core-')
+
+            # get the new path
+            if '/tree/Packages/' in debug_rpm:
+                kernel_rpm = kernel_rpm.replace('/debug/tree/Packages/', '/os/Packages/')
+            elif 'Everything/' in debug_rpm:
+                kernel_rpm = kernel_rpm.replace('/debug/', '/os/Packages/')
+            else:
+                kernel_rpm = kernel_rpm.replace('/debug/', '/')
+
+            # I hate the lack of consistency!
+            kernel_rpm.replace('/Packages/Packages/', '/Packages/')
+
+            if kernel_filter == 'all' or kernel_name == kernel_filter:
+                # The same kernel is on more than one mirror, keep the first in search order
+                if kernel_name in self.kernel_pairs:
+                    logger.debug(f'Ignoring duplicate {kernel_name} on {debug_page}')
+                    continue
+
+                # Add to data set
+                self.kernel_pairs[kernel_name] = {
+                    "debug_rpm": debug_rpm,
+                    "kernel_rpm": kernel_rpm,
+                    "valid": False,
+                    "banner": '',
+                    "isf_file": False
+                    }
+            else:
+                logger.debug('Ignored by filter')
+
+    def load_layouts(self):
+        try:
+            return json.loads(self.layout_file.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def save_layouts(self, layouts):
+        self.layout_file.parent.mkdir(parents = True, exist_ok = True)
+        self.layout_file.write_text(json.dumps(layouts, indent = 2))
 
 
     def validate_links(self, kernel):
         """For each pair of RPM files make HEAD requests to confirm files are present"""
-        logger.info('Validating remote files exist')
+        logger.debug(f'Validating remote files exist for {kernel}')
         valid = False
         rpm_files = self.kernel_pairs[kernel]
 
-        deb_head = requests.head(rpm_files['kernel_rpm']).status_code
-        debug_head = requests.head(rpm_files['debug_rpm']).status_code
+        deb_response = transport.head(rpm_files['kernel_rpm'])
+        debug_response = transport.head(rpm_files['debug_rpm'])
+        deb_head = deb_response.status_code
+        debug_head = debug_response.status_code
 
         if deb_head == debug_head == 200:
             self.kernel_pairs[kernel]['valid'] = True
+            self.kernel_pairs[kernel]['kernel_size'] = transport.content_length(deb_response)
+            self.kernel_pairs[kernel]['debug_size'] = transport.content_length(debug_response)
             valid = True
         else:
             logger.warning(f'{kernel} Kernel Deb returned {deb_head}, Debug Deb Returned {debug_head}')
@@ -117,10 +194,11 @@ class FedoraBase:
         return valid
 
 
-    def extract_files(self, symbol_set):
+    def extract_files(self, symbol_set, *args):
         logger.info('Processing RPMS')
-        system_map = rpmfiles.process_rpm(symbol_set['kernel_rpm'], 'System.map')
-        vmlinux = rpmfiles.process_rpm(symbol_set['debug_rpm'], 'vmlinux')
+        system_map, vmlinux = download.fetch_pair(
+            partial(rpmfiles.process_rpm, symbol_set['kernel_rpm'], 'System.map'),
+            partial(rpmfiles.process_rpm, symbol_set['debug_rpm'], 'vmlinux'))
 
         return system_map, vmlinux
 
@@ -1,8 +1,9 @@
 import logging
-import re
-import requests
 
-from parsers import debfiles
+from functools import partial
+
+from parsers import download, debfiles, listing
+from utils import listing_cache, mirrors, transport
 
 logger = logging.getLogger(__name__)
 
@@ -11,55 +12,41 @@ class UbuntuBase:
     def __init__(self, branch):
         self.operating_system = 'ubuntu'
         self.supported_base = ['linux', 'linux-aws', 'linux-azure', 'linux-gcp']
-        self.kernel_pattern = '<a href="(linux-modules-(.*)_(.*)_(.*.deb))">'
-        self.debug_pattern = '<a href="(linux-image-.*?.deb)">'
+        self.kernel_pattern = '<a href="(?P<path>linux-modules-(?P<uname>[0-9][^_"]*)_(?P<version>[^_"]+)_(?P<arch>[^_."]+)\\.deb)">'
+        self.debug_pattern = '<a href="(?P<path>linux-image-(?:unsigned-)?(?P<uname>[0-9][^_"]*)-dbgsym_(?P<version>[^_"]+)_(?P<arch>[^_."]+)\\.d?deb)">'
         self.kernel_pairs = {}
         
         if branch in self.supported_base:
             self.kernel_url = f'http://security.ubuntu.com/ubuntu/pool/main/l/{branch}/'
             self.debug_url = f'http://ddebs.ubuntu.com/ubuntu/pool/main/l/{branch}/'
+            # Security updates are copied to the main archive, ddebs has no mirrors
+            self.mirror_urls = ['http://security.ubuntu.com/ubuntu/',
+                                'http://archive.ubuntu.com/ubuntu/',
+                                'http://us.archive.ubuntu.com/ubuntu/']
+            mirrors.register(self.mirror_urls)
         else:
-            logger.error(f'Unsupported Target {branch}')
-            exit()
+            raise ValueError(f"Unsupported Target {branch}, expected one of {', '.join(self.supported_base)}")
 
     def get_kernel_list(self, kernel_filter):
         """Parses the `kernel_url` for any matching kernel deb files"""
         logger.info(f'Fetching list of kernels from {self.kernel_url}')
-        kernel_list = requests.get(self.kernel_url)
-        kernel_debs = re.findall(self.kernel_pattern, kernel_list.text)
+        kernel_list = listing_cache.get(self.kernel_url)
+        kernel_debs = listing.parse_packages(self.kernel_pattern, kernel_list.text)
 
         logger.info(f'Fetching list of debug kernels from {self.debug_url}')
-        debug_list = requests.get(self.debug_url)
-        debug_debs = re.findall(self.debug_pattern, debug_list.text)
+        debug_list = listing_cache.get(self.debug_url)
+        debug_debs = listing.parse_packages(self.debug_pattern, debug_list.text)
 
         logger.info('Searching for Debian Packages')
-        for match in kernel_debs:
-
-            deb_path = match[0]
-            uname_string = match[1]
-            version = match[2]
-            kernel_arch = match[3].replace('.deb', '')
-
-            # Ignore some of the results to prevent duplicates
-            if any(x in deb_path for x in ['-dbg', 'extra-']):
-                continue
+        for kernel_deb, debug_deb in listing.pair_packages(kernel_debs, debug_debs):
+            uname_string = kernel_deb.uname
             logger.debug(f'Found: {uname_string}')
 
-            # Find the matching debug 
-            debug_deb = None
-
-            for debug_path in debug_debs:
-                # Only match if uname and arch match
-                if all(x in debug_path for x in [uname_string, kernel_arch]):
-                    debug_deb = f'{self.debug_url}{debug_path}'
-                    break
-
             if debug_deb:
                 if kernel_filter == 'all' or kernel_filter == uname_string:
-                    #print(debug_deb, f'{self.kernel_url}{deb_path}')
                     self.kernel_pairs[uname_string] = {
-                        "kernel_deb": f'{self.kernel_url}{deb_path}',
-                        "debug_deb": debug_deb,
+                        "kernel_deb": f'{self.kernel_url}{kernel_deb.path}',
+                        "debug_deb": f'{self.debug_url}{debug_deb.path}',
                         "valid": False,
                         "banner": '',
                         "isf_file": False
@@ -71,15 +58,19 @@ class UbuntuBase:
 
     def validate_links(self, kernel):
         """For each pair of deb files make HEAD requests to confirm files are present"""
-        logger.info('Validating remote files exist')
+        logger.debug(f'Validating remote files exist for {kernel}')
         valid = False
         deb_files = self.kernel_pairs[kernel]
 
-        deb_head = requests.head(deb_files['kernel_deb']).status_code
-        debug_head = requests.head(deb_files['debug_deb']).status_code
+        deb_response = transport.head(deb_files['kernel_deb'])
+        debug_response = transport.head(deb_files['debug_deb'])
+        deb_head = deb_response.status_code
+        debug_head = debug_response.status_code
 
         if deb_head == debug_head == 200:
             self.kernel_pairs[kernel]['valid'] = True
+            self.kernel_pairs[kernel]['kernel_size'] = transport.content_length(deb_response)
+            self.kernel_pairs[kernel]['debug_size'] = transport.content_length(debug_response)
             valid = True
         else:
             logger.warning(f'{kernel} Kernel Deb returned {deb_head}, Debug Deb Returned {debug_head}')
@@ -89,7 +80,9 @@ class UbuntuBase:
 
     def extract_files(self, symbol_set, *args):
         logger.info(f'Processing Debs for kernel {args[0]}')
-        system_map = debfiles.process_deb(symbol_set['kernel_deb'], 'System.map', args[0])
-        vmlinux = debfiles.process_deb(symbol_set['debug_deb'], 'boot/vmlinux', args[0])
+        # Kernel and debug packages come from different hosts so fetch them together
+        system_map, vmlinux = download.fetch_pair(
+            partial(debfiles.process_deb, symbol_set['kernel_deb'], 'System.map', args[0]),
+            partial(debfiles.process_deb, symbol_set['debug_deb'], 'boot/vmlinux', args[0]))
 
         return system_map, vmlinux
@@ -0,0 +1,60 @@
+import argparse
+import json
+import logging
+
+from utils.banner_index import BannerIndex, SYMBOL_ROOT
+
+
+logger = logging.getLogger(__name__)
+
+
+def main(args):
+    index = BannerIndex(args.root)
+
+    if args.command == 'rebuild':
+        index.rebuild()
+
+    elif args.command == 'lookup':
+        matches = index.lookup(args.banner)
+        if not matches:
+            logger.warning('No ISF found for banner')
+        for match in matches:
+            print(json.dumps({key: value for key, value in match.items() if key != 'identifier'}))
+
+    elif args.command == 'duplicates':
+        for banner, paths in index.duplicates().items():
+            print(banner)
+            for path in paths:
+                print(f'    {path}')
+
+    index.close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Query or rebuild the banner index of a symbol_files tree")
+    parser.add_argument("-r",
+                        "--root",
+                        dest = 'root',
+                        default = str(SYMBOL_ROOT),
+                        help = "Root of the symbol_files tree",
+                        required = False)
+
+    parser.add_argument("-v",
+                        "--verbose",
+                        dest = 'verbose',
+                        action = 'store_true',
+                        help = "Verbose Debug logging",
+                        required = False)
+
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+    subparsers.add_parser('rebuild', help = "Rebuild the index from the ISF files on disk")
+    lookup_parser = subparsers.add_parser('lookup', help = "Find the ISF files for a banner")
+    lookup_parser.add_argument('banner', help = "Banner string e.g. from `banners.Banners`")
+    subparsers.add_parser('duplicates', help = "List banners produced by more than one ISF")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.INFO)
+
+    main(args)
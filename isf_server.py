@@ -0,0 +1,289 @@
+import argparse
+import base64
+import json
+import logging
+import mimetypes
+import os
+import re
+import sys
+import threading
+import time
+
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+from utils import zstd_dictionary
+from utils.banner_index import BannerIndex, SYMBOL_ROOT, normalise_banner
+
+
+logger = logging.getLogger(__name__)
+
+HOST = '127.0.0.1'
+PORT = 8000
+# The index files are checked for changes at most this often
+RELOAD_INTERVAL = 2
+RANGE_PATTERN = re.compile(r'bytes=(\d*)-(\d*)$')
+CONTENT_TYPES = {".xz": 'application/x-xz', ".zst": 'application/zstd', ".zdict": 'application/octet-stream'}
+
+
+class ISFCatalog:
+    """In memory copy of the banner index, reloaded when the SQLite file or its WAL changes"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.index = BannerIndex(self.root)
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.checked = 0
+        self.by_banner = {}
+        self.by_path = {}
+        self.reload()
+
+    def index_stamp(self):
+        stamp = []
+        for suffix in ('', '-wal'):
+            try:
+                stat = os.stat(f'{self.index.path}{suffix}')
+                stamp.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                stamp.append(None)
+        return stamp
+
+    def reload(self):
+        stamp = self.index_stamp()
+        entries = self.index.entries()
+        by_banner = {}
+        for entry in entries:
+            by_banner.setdefault(entry['banner'], []).append(entry)
+        with self.lock:
+            self.by_banner = by_banner
+            self.by_path = {entry['path']: entry for entry in entries}
+            self.stamp = stamp
+        logger.info(f'Loaded {len(entries)} ISF files from {self.index.path}')
+
+    def refresh(self):
+        """Pick up ISFs added since the last load, cheap enough to call on every request"""
+        now = time.monotonic()
+        if now - self.checked < RELOAD_INTERVAL:
+            return
+        self.checked = now
+        if self.index_stamp() != self.stamp:
+            self.reload()
+
+    def lookup(self, banner):
+        self.refresh()
+        with self.lock:
+            return list(self.by_banner.get(normalise_banner(banner), []))
+
+    def entry(self, path):
+        self.refresh()
+        with self.lock:
+            return self.by_path.get(path)
+
+    def listing(self, base_url):
+        """Volatility remote ISF format, base64 banner identifiers mapped to ISF URLs"""
+        self.refresh()
+        linux = {}
+        with self.lock:
+            entries = [entry for entries in self.by_banner.values() for entry in entries]
+        for entry in entries:
+            # Entries rebuilt from banner.txt lost the raw bytes, the kernel string ends with a newline and NUL
+            identifier = entry['identifier'] or f"{entry['banner']}\n\x00".encode()
+            key = base64.b64encode(identifier).decode()
+            linux.setdefault(key, []).append(f"{base_url}/symbols/{quote(entry['path'])}")
+        return {"version": 1, "linux": linux, "mac": {}, "windows": {}}
+
+
+class ISFHandler(BaseHTTPRequestHandler):
+    """GET/HEAD for /banners.json, /lookup?banner=, /symbols/<path> and /dictionaries/<name>"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'isf_server'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_HEAD(self):
+        self.handle_request(head = True)
+
+    def do_GET(self):
+        self.handle_request(head = False)
+
+    def handle_request(self, head):
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        catalog = self.server.catalog
+
+        if path == '/banners.json':
+            base_url = self.server.base_url or f"http://{self.headers.get('Host', '%s:%s' % self.server.server_address[:2])}"
+            self.send_json(catalog.listing(base_url), head)
+        elif path == '/lookup':
+            banner = parse_qs(url.query).get('banner', [''])[0]
+            matches = [{key: value for key, value in entry.items() if key != 'identifier'}
+                       for entry in catalog.lookup(banner)]
+            self.send_json(matches, head, 200 if matches else 404)
+        elif path.startswith('/symbols/'):
+            relative = path[len('/symbols/'):]
+            entry = catalog.entry(relative)
+            if entry is None:
+                self.send_error(404, 'ISF not in the index')
+                return
+            self.send_file(catalog.root / relative, head, entry)
+        elif path.startswith('/dictionaries/') and path.endswith('.zdict'):
+            name = path[len('/dictionaries/'):]
+            if '/' in name or name.startswith('.'):
+                self.send_error(404)
+                return
+            self.send_file(catalog.root / zstd_dictionary.DICT_DIR.name / name, head)
+        else:
+            self.send_error(404)
+
+    def send_json(self, data, head, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def send_file(self, path, head, entry=None):
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404, 'File not found')
+            return
+
+        with f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            # The indexed hash is only used while the file is unchanged
+            if entry and entry['size'] == size and entry['mtime'] == stat.st_mtime:
+                etag = f'"{entry["sha256"]}"'
+            else:
+                etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            start, end = 0, size - 1
+            match = RANGE_PATTERN.match(self.headers.get('Range', ''))
+            if_range = self.headers.get('If-Range')
+            if match and any(match.groups()) and (if_range is None or if_range == etag):
+                first, last = match.groups()
+                if first:
+                    start = int(first)
+                    end = min(int(last), size - 1) if last else size - 1
+                else:
+                    start = max(size - int(last), 0)
+                if start >= size or start > end:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            else:
+                self.send_response(200)
+
+            content_type = CONTENT_TYPES.get(path.suffix) or mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', formatdate(stat.st_mtime, usegmt = True))
+            self.end_headers()
+            # socket.sendfile rejects a count of 0, an empty file has nothing to send anyway
+            if head or end < start:
+                return
+
+            self.wfile.flush()
+            # socket.sendfile uses os.sendfile where it can, the file never passes through Python
+            self.connection.sendfile(f, offset = start, count = end - start + 1)
+
+
+class ISFServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, catalog, base_url=None):
+        super().__init__(address, ISFHandler)
+        self.catalog = catalog
+        self.base_url = base_url.rstrip('/') if base_url else None
+
+    def handle_error(self, request, client_address):
+        # Clients hang up part way through a body once they have what they need
+        if isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def serve(root=SYMBOL_ROOT, host=HOST, port=PORT, base_url=None):
+    """Start serving `root` on a background thread, returns the server and its base URL"""
+    server = ISFServer((host, port), ISFCatalog(root), base_url)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    url = f'http://{host}:{server.server_address[1]}'
+    logger.info(f'Serving {root} at {url}')
+    return server, url
+
+
+def main(args):
+    server = ISFServer((args.host, args.port), ISFCatalog(args.root), args.base_url)
+    logger.info(f'Serving {args.root} at http://{args.host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Serve a symbol_files tree over HTTP for Volatility and banner lookups")
+    parser.add_argument("-r",
+                        "--root",
+                        dest = 'root',
+                        default = str(SYMBOL_ROOT),
+                        help = "Root of the symbol_files tree",
+                        required = False)
+
+    parser.add_argument("--host",
+                        dest = 'host',
+                        default = HOST,
+                        help = "Address to listen on",
+                        required = False)
+
+    parser.add_argument("-p",
+                        "--port",
+                        dest = 'port',
+                        type = int,
+                        default = PORT,
+                        help = "Port to listen on, 0 picks a free one",
+                        required = False)
+
+    parser.add_argument("--base-url",
+                        dest = 'base_url',
+                        help = "URL clients reach this server at, used in banners.json. Defaults to the request's Host",
+                        required = False)
+
+    parser.add_argument("-v",
+                        "--verbose",
+                        dest = 'verbose',
+                        action = 'store_true',
+                        help = "Verbose Debug logging",
+                        required = False)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.INFO)
+
+    main(args)
@@ -0,0 +1,136 @@
+import argparse
+import json
+import logging
+import time
+
+from pathlib import Path
+
+import zstandard
+
+from utils import compression, zstd_dictionary
+from utils.banner_index import SYMBOL_ROOT
+
+
+logger = logging.getLogger(__name__)
+
+
+def isf_files(root, distro, suffix='.json.xz'):
+    """ISFs of `distro` under `root`, newest first"""
+    paths = [path for path in Path(root, distro).glob(f'*/*{suffix}')]
+    return sorted(paths, key = lambda path: path.stat().st_mtime, reverse = True)
+
+
+def timed_read(reader):
+    start = time.perf_counter()
+    with reader as f:
+        data = f.read()
+    return data, time.perf_counter() - start
+
+
+def measure(isf_path, dictionary, level):
+    """Sizes and decompression times of one .json.xz against zstd with and without the dictionary"""
+    data, xz_time = timed_read(zstd_dictionary.open_isf(isf_path))
+
+    plain = zstandard.ZstdCompressor(level = level, threads = -1).compress(data)
+    trained = zstandard.ZstdCompressor(level = level, dict_data = dictionary, threads = -1).compress(data)
+
+    decompressor = zstandard.ZstdDecompressor(dict_data = dictionary)
+    start = time.perf_counter()
+    decompressor.decompress(trained, max_output_size = len(data))
+    zst_time = time.perf_counter() - start
+
+    return {"path": str(isf_path),
+            "json": len(data),
+            "xz": isf_path.stat().st_size,
+            "zst": len(plain),
+            "zst_dict": len(trained),
+            "xz_seconds": round(xz_time, 3),
+            "zst_dict_seconds": round(zst_time, 3)}
+
+
+def main(args):
+    dict_dir = Path(args.root, zstd_dictionary.DICT_DIR.name)
+
+    if args.command == 'train':
+        sources = isf_files(args.root, args.distro)[:args.files]
+        if not sources:
+            logger.error(f'No .json.xz ISFs found under {Path(args.root, args.distro)}')
+            return
+        path, dictionary = zstd_dictionary.train(args.distro, sources, args.size * 1024, dict_dir)
+        print(json.dumps({"path": str(path), "dict_id": dictionary.dict_id(), "trained_on": len(sources)}))
+
+    elif args.command == 'measure':
+        dictionary_path, dictionary = zstd_dictionary.latest(args.distro, dict_dir)
+        if dictionary is None:
+            logger.error(f'No dictionary for {args.distro} in {dict_dir}, run train first')
+            return
+        # ISFs the dictionary was trained on would flatter it
+        trained_on = set(zstd_dictionary.read_info(dictionary_path).get('trained_on', []))
+        candidates = [path for path in isf_files(args.root, args.distro) if str(path) not in trained_on]
+        logger.info(f'Measuring {dictionary_path} on {min(len(candidates), args.files)} ISFs')
+
+        totals = dict.fromkeys(['json', 'xz', 'zst', 'zst_dict', 'xz_seconds', 'zst_dict_seconds'], 0)
+        for isf_path in candidates[:args.files]:
+            result = measure(isf_path, dictionary, args.level)
+            print(json.dumps(result))
+            for key in totals:
+                totals[key] += result[key]
+
+        if totals['zst_dict']:
+            print(json.dumps({"total": {key: round(value, 3) for key, value in totals.items()},
+                              "size_vs_xz": round(totals['zst_dict'] / totals['xz'], 3),
+                              "size_vs_zst": round(totals['zst_dict'] / totals['zst'], 3),
+                              "xz_mb_per_second": round(totals['json'] / totals['xz_seconds'] / 1024 ** 2, 1),
+                              "zst_dict_mb_per_second": round(totals['json'] / totals['zst_dict_seconds'] / 1024 ** 2, 1)}))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Train zstd dictionaries for ISF files and measure them against xz")
+    parser.add_argument("-r",
+                        "--root",
+                        dest = 'root',
+                        default = str(SYMBOL_ROOT),
+                        help = "Root of the symbol_files tree",
+                        required = False)
+
+    parser.add_argument("-d",
+                        "--distro",
+                        dest = 'distro',
+                        help = "Distribution directory under the root e.g. ubuntu",
+                        required = True)
+
+    parser.add_argument("-n",
+                        "--files",
+                        dest = 'files',
+                        type = int,
+                        default = 20,
+                        help = "Number of the newest ISFs to train on or measure",
+                        required = False)
+
+    parser.add_argument("-v",
+                        "--verbose",
+                        dest = 'verbose',
+                        action = 'store_true',
+                        help = "Verbose Debug logging",
+                        required = False)
+
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+    train_parser = subparsers.add_parser('train', help = "Train the next dictionary version from existing .json.xz ISFs")
+    train_parser.add_argument('--size',
+                              dest = 'size',
+                              type = int,
+                              default = zstd_dictionary.DICT_SIZE // 1024,
+                              help = "Dictionary size in KB")
+    measure_parser = subparsers.add_parser('measure', help = "Compare the latest dictionary against .json.xz on ISFs it was not trained on")
+    measure_parser.add_argument('--level',
+                                dest = 'level',
+                                type = int,
+                                default = compression.ZSTD_LEVEL,
+                                help = "zstd compression level")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.INFO)
+
+    main(args)
@@ -1,56 +1,70 @@
 import logging
-import requests
-import tempfile
 import tarfile
-from io import BytesIO
 
 from debian import debfile
 
+from parsers import download, ranged, streaming
+from utils import local_mirror, package_cache
+
 
 logger = logging.getLogger(__name__)
 
-def process_deb(deb_url, file_pattern, *args):
+def process_deb(deb_url, file_pattern, *args, cancel=None):
     """Takes a URL to a deb file retrieves it and extracts the required file
-    file, if found, is saved to a dir with `kernel_name`"""
+    file, if found, is saved to a dir with `kernel_name`.
+    Setting the `cancel` Event aborts the download"""
     logger.debug(f'Fetching Deb File: {deb_url}')
 
-    # We do this in memory to save DiskIO    
-    f = BytesIO()
+    if file_pattern == "System.map":
+        file_name = f"/boot/System.map-{args[0]}"
+    elif file_pattern == "boot/vmlinux":
+        file_name = f"/usr/lib/debug/boot/vmlinux-{args[0]}"
 
-    with requests.get(deb_url, stream=True) as r:
-        r.raise_for_status()
-        for chunk in r.iter_content(chunk_size=8192): 
-            # If you have chunk encoded response uncomment if
-            # and set chunk_size parameter to None.
-            #if chunk: 
-            f.write(chunk)
+    prefix = 'vmlinux' if 'vmlinux' in file_name else 'System.map'
 
-    # Go to start of file.
-    f.seek(0)
+    local = local_mirror.local_path(deb_url) is not None
+
+    if package_cache.enabled() and not local:
+        # Keep the whole package so a rebuild does not download it again
+        f = download.cached_url(deb_url, cancel)
+    elif download.MODE == 'stream' or local:
+        # Packages on a local mirror are always read in place, a spool or cache copy gains nothing
+        if download.RANGED:
+            # Multi block xz packages let us download only the blocks holding the file
+            try:
+                outfile_name = ranged.extract_deb(deb_url, file_name, prefix, cancel)
+            except ranged.FALLBACK_ERRORS as err:
+                logger.debug(f'Downloading all of {deb_url}, ranged read not possible: {err}')
+            else:
+                if not outfile_name:
+                    logger.error(f'{file_name} not found in {deb_url}')
+                return outfile_name
+
+        # Decompress as the package arrives and hang up once the file is written
+        with download.open_url(deb_url, cancel) as f:
+            outfile_name = streaming.extract_deb(f, file_name, prefix)
+        if not outfile_name:
+            logger.error(f'{file_name} not found in {deb_url}')
+        return outfile_name
+    else:
+        # Spool to disk so memory stays flat regardless of package size
+        f = download.spool_url(deb_url, cancel)
 
     logger.debug('Creating Deb Object')
     try:
         deb = debfile.DebFile(fileobj = f)
-        if file_pattern == "System.map":
-            file_name = f"/boot/System.map-{args[0]}"
-        elif file_pattern == "boot/vmlinux":
-            file_name = f"/usr/lib/debug/boot/vmlinux-{args[0]}"
         extracted = deb.data.get_file(file_name)
     except Exception as err:
         logger.exception(err)
-    
-    prefix = 'vmlinux' if 'vmlinux' in file_name else 'System.map'
+        f.close()
+        return None
 
-    with tempfile.NamedTemporaryFile(delete = False,
-                                         prefix = prefix) as outfile:
-    
-        logger.debug(f'Writing {file_name} to {outfile.name}')
-        outfile.write(extracted.read())
+    outfile_name = download.write_member(extracted, prefix, file_name)
 
-    # Close file handles
+    # Close file handles, this also removes a spooled package
     f.close()
 
-    return outfile.name
+    return outfile_name
     
     # logger.debug('Creating Deb Object')
     # try:
@@ -0,0 +1,302 @@
+import hashlib
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from utils import local_mirror, metrics, mirrors, package_cache, transport
+
+
+logger = logging.getLogger(__name__)
+
+# Scratch directory for spooled packages and extracted files, None uses the system temp dir
+SPOOL_DIR = None
+# Large reads keep the per chunk overhead low on 1Gb packages
+CHUNK_SIZE = 1024 * 1024
+# 'stream' extracts while the package downloads, 'spool' writes the whole package to disk first
+MODE = 'stream'
+MODES = ['stream', 'spool']
+# In stream mode try Range requests for only the part of a package holding the file first
+RANGED = True
+# Whole package downloads at least SEGMENT_MIN_SIZE are split into this many parallel Range requests
+SEGMENTS = 4
+SEGMENT_MIN_SIZE = 64 * 1024 * 1024
+
+
+class DownloadCancelled(Exception):
+    """Raised inside a download when a download it was paired with has failed"""
+
+
+class ChunkReader(io.RawIOBase):
+    """Read only file object over an iterator of byte chunks e.g. `Response.iter_content`"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+class FileReader(io.RawIOBase):
+    """Reads a local file straight into the caller's buffer, raising DownloadCancelled once `cancels` are set"""
+
+    def __init__(self, path, *cancels):
+        self._file = open(path, 'rb', buffering = 0)
+        self._cancels = [cancel for cancel in cancels if cancel is not None]
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self._file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if any(cancel.is_set() for cancel in self._cancels):
+            raise DownloadCancelled('Cancelled')
+        return self._file.readinto(b)
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def configure(spool_dir=None, chunk_size=None, mode=None, ranged=None, segments=None, segment_min_size=None):
+    """Override the spool directory, chunk size and download mode used for packages"""
+    global SPOOL_DIR, CHUNK_SIZE, MODE, RANGED, SEGMENTS, SEGMENT_MIN_SIZE
+    if spool_dir:
+        SPOOL_DIR = str(spool_dir)
+    if chunk_size:
+        CHUNK_SIZE = int(chunk_size)
+    if mode:
+        MODE = mode
+    if ranged is not None:
+        RANGED = ranged
+    if segments is not None:
+        SEGMENTS = max(1, int(segments))
+    if segment_min_size is not None:
+        SEGMENT_MIN_SIZE = int(segment_min_size)
+
+
+def check_cancel(chunks, *cancels):
+    """Pass chunks through, raising DownloadCancelled once any of the `cancels` Events is set"""
+    for chunk in chunks:
+        if any(cancel is not None and cancel.is_set() for cancel in cancels):
+            raise DownloadCancelled()
+        yield chunk
+
+
+def segment_plan(url):
+    """Returns (source, size, etag) if `url` is worth fetching in segments, else None"""
+    if SEGMENTS < 2:
+        return None
+    if mirrors.needs_probe(url):
+        transport.probe_mirrors(url)
+    source = mirrors.candidates(url)[0]
+    response = transport.head(source, allow_redirects = True, headers = {'Accept-Encoding': 'identity'})
+    size = transport.content_length(response)
+    if response.status_code != 200 or response.headers.get('Accept-Ranges') != 'bytes':
+        return None
+    if size is None or size < SEGMENT_MIN_SIZE:
+        return None
+    return response.url, size, transport.validator(response)
+
+
+def fetch_segments(f, source, size, etag, cancel=None):
+    """Fetch `source` as SEGMENTS parallel Range requests, each written at its own offset in `f`.
+    Every segment resumes and retries on its own, the first to fail for good stops the rest"""
+    segment_size = -(-size // SEGMENTS)
+    write_lock = threading.Lock()
+    stop = threading.Event()
+
+    def fetch_segment(start, end):
+        position = start
+        try:
+            chunks = transport.iter_range(source, start, end, CHUNK_SIZE, etag)
+            for chunk in check_cancel(chunks, cancel, stop):
+                with write_lock:
+                    f.seek(position)
+                    f.write(chunk)
+                position += len(chunk)
+        except Exception:
+            stop.set()
+            raise
+
+    logger.debug(f'Fetching {source} as {SEGMENTS} segments of {segment_size} bytes')
+    with ThreadPoolExecutor(max_workers = SEGMENTS) as executor:
+        futures = [executor.submit(metrics.run_in_context(fetch_segment), start, min(start + segment_size, size))
+                   for start in range(0, size, segment_size)]
+
+    errors = [future.exception() for future in futures if future.exception()]
+    # A segment stopped because another failed is not the interesting error
+    for error in errors:
+        if not isinstance(error, DownloadCancelled) or cancel is not None and cancel.is_set():
+            raise error
+
+
+def fetch_to(url, f, cancel=None):
+    """Write the body of `url` to `f`, in parallel segments where the package is large and the server
+    supports Range, else as a single stream. Returns True if it was fetched in segments"""
+    plan = segment_plan(url)
+    if plan is not None:
+        try:
+            fetch_segments(f, *plan, cancel)
+            f.seek(plan[1])
+            return True
+        except transport.RangeNotSatisfied as err:
+            logger.debug(f'Downloading {url} as a single stream: {err}')
+            f.seek(0)
+            f.truncate()
+
+    for chunk in check_cancel(transport.iter_content(url, CHUNK_SIZE), cancel):
+        f.write(chunk)
+    return False
+
+
+@contextmanager
+def open_url(url, cancel=None):
+    """Yields a sequential file object over the body of `url`.
+    The connection is closed on exit even if the body was not fully read.
+    A package on a local mirror is read in place"""
+    path = local_mirror.local_path(url)
+    if path is not None:
+        logger.debug(f'Reading {path}')
+        with io.BufferedReader(FileReader(path, cancel), CHUNK_SIZE) as f:
+            yield f
+        return
+
+    logger.debug(f'Streaming {url}')
+    chunks = transport.iter_content(url, CHUNK_SIZE)
+    try:
+        yield io.BufferedReader(ChunkReader(check_cancel(chunks, cancel)), CHUNK_SIZE)
+    finally:
+        chunks.close()
+
+
+def spool_url(url, cancel=None):
+    """Download `url` to an anonymous temp file in the spool dir.
+    Returns the open file positioned at the start, the file is removed when closed"""
+    logger.debug(f'Spooling {url} to {SPOOL_DIR or tempfile.gettempdir()}')
+
+    f = tempfile.TemporaryFile(dir = SPOOL_DIR, prefix = 'spool')
+    try:
+        fetch_to(url, f, cancel)
+    except Exception:
+        f.close()
+        raise
+
+    # Go to start of file.
+    f.seek(0)
+    return f
+
+
+def cached_url(url, cancel=None, checksum=None):
+    """Returns an open file for `url` from the package cache, downloading it into the cache on a miss.
+    Without a repository `checksum` the key is built from a HEAD request"""
+    if checksum:
+        key = package_cache.cache_key(url, checksum = checksum)
+    else:
+        response = transport.head(url, allow_redirects = True)
+        response.raise_for_status()
+        key = package_cache.cache_key(url,
+                                      etag = response.headers.get('ETag'),
+                                      length = transport.content_length(response))
+
+    def fill(f):
+        logger.debug(f'Downloading {url} into the package cache')
+        digest = None
+        if checksum:
+            algorithm, expected = checksum.split(':', 1)
+            if algorithm in hashlib.algorithms_available:
+                digest = hashlib.new(algorithm)
+
+        fetch_to(url, f, cancel)
+
+        if digest:
+            # Segments arrive out of order so hash the finished file
+            f.flush()
+            f.seek(0)
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+        if digest and digest.hexdigest() != expected:
+            raise IOError(f'Checksum mismatch for {url}')
+
+    return package_cache.open_entry(key, fill)
+
+
+def write_member(member, prefix, name):
+    """Copy an extracted archive member to a named temp file in chunks and return its path"""
+    with tempfile.NamedTemporaryFile(delete = False,
+                                     prefix = prefix,
+                                     dir = SPOOL_DIR) as outfile:
+
+        logger.debug(f'Writing {name} to {outfile.name}')
+        try:
+            shutil.copyfileobj(member, outfile, CHUNK_SIZE)
+            metrics.add('bytes_extracted', outfile.tell())
+        except Exception:
+            # Dont leave partial files behind when the stream breaks
+            outfile.close()
+            os.remove(outfile.name)
+            raise
+
+    return outfile.name
+
+
+def fetch_pair(*fetchers):
+    """Run fetch callables concurrently and return their file paths in order.
+    Each is called with a `cancel` Event. If any raises or returns None the others are
+    cancelled and any files they produced are removed, then the error is raised"""
+    cancel = threading.Event()
+
+    def run(fetch):
+        try:
+            result = fetch(cancel = cancel)
+        except Exception:
+            cancel.set()
+            raise
+        if not result:
+            cancel.set()
+        return result
+
+    with ThreadPoolExecutor(max_workers = len(fetchers)) as executor:
+        # Each thread gets a copy of the caller's context so its bytes count towards the caller's stage
+        futures = [executor.submit(metrics.run_in_context(run), fetch) for fetch in fetchers]
+
+    results = []
+    error = None
+    for future in futures:
+        try:
+            results.append(future.result())
+        except DownloadCancelled:
+            results.append(None)
+        except Exception as err:
+            results.append(None)
+            error = error or err
+
+    if error or not all(results):
+        for path in results:
+            if path and os.path.exists(path):
+                logger.debug(f'Removing {path} after paired download failed')
+                os.remove(path)
+        if error:
+            raise error
+        return tuple(None for _ in fetchers)
+
+    return tuple(results)
@@ -0,0 +1,48 @@
+import logging
+import re
+
+from collections import namedtuple
+
+
+logger = logging.getLogger(__name__)
+
+# A package from a repository listing reduced to the fields used to pair kernels with debug symbols.
+# Size and checksum are only known when the repository metadata provides them
+KernelPackage = namedtuple('KernelPackage',
+                           ['uname', 'version', 'arch', 'flavour', 'path', 'size', 'checksum'],
+                           defaults = [None, None])
+
+# 5.4.0-42-generic -> generic, 4.19.0-6-rt-amd64 -> rt-amd64
+FLAVOUR_PATTERN = re.compile(r'^[0-9.]+-[0-9.]+-(.+)$')
+
+
+def parse_packages(pattern, text):
+    """Yields a KernelPackage for every match of `pattern` in a listing.
+    The pattern must have `path`, `uname`, `version` and `arch` named groups"""
+    for match in re.finditer(pattern, text):
+        uname = match['uname']
+        flavour = FLAVOUR_PATTERN.match(uname)
+        yield KernelPackage(uname,
+                            match['version'],
+                            match['arch'],
+                            flavour.group(1) if flavour else '',
+                            match['path'])
+
+
+def pair_packages(kernels, debugs):
+    """Yields (kernel, debug) for each kernel package, debug is None if there is no match.
+    Debug packages are indexed by (uname, version, arch) so pairing is a dictionary lookup rather
+    than a scan of the debug listing. Only the exact version pairs, symbols from another build of
+    the same uname would not match the kernel"""
+    exact = {}
+    versions = {}
+    for debug in debugs:
+        exact.setdefault((debug.uname, debug.version, debug.arch), debug)
+        versions.setdefault((debug.uname, debug.arch), []).append(debug.version)
+
+    for kernel in kernels:
+        debug = exact.get((kernel.uname, kernel.version, kernel.arch))
+        if debug is None and (kernel.uname, kernel.arch) in versions:
+            logger.warning(f'{kernel.uname} {kernel.arch} has debug packages for '
+                           f"{', '.join(versions[kernel.uname, kernel.arch])} but not {kernel.version}")
+        yield kernel, debug
@@ -0,0 +1,302 @@
+import logging
+import lzma
+import struct
+import tarfile
+import zlib
+
+from parsers import download, streaming
+from utils import metrics, transport
+
+
+logger = logging.getLogger(__name__)
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+XZ_MAGIC = b'\xfd7zXZ\x00'
+XZ_HEADER_SIZE = 12
+XZ_FOOTER_SIZE = 12
+TAR_BLOCK = 512
+# Give up on ranged reads once the tar headers alone have cost this fraction of the member
+HEADER_BUDGET = 0.5
+
+
+class RangedUnsupported(Exception):
+    """The package can not be read with Range requests, download all of it instead"""
+
+
+# A full download is tried after any of these, it also covers layouts this module misreads
+FALLBACK_ERRORS = (RangedUnsupported, transport.RangeNotSatisfied, lzma.LZMAError, tarfile.HeaderError, EOFError)
+
+
+def read_varint(data, offset):
+    """xz multibyte integer, returns (value, next offset)"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def pad4(size):
+    return size + (-size % 4)
+
+
+class XZIndex:
+    """Block layout of a single stream .xz file, parsed from its footer and index"""
+
+    def __init__(self, header, footer, index, size):
+        if header[:6] != XZ_MAGIC or footer[10:] != b'YZ':
+            raise RangedUnsupported('Not an xz stream')
+        self.flags = header[6:8]
+        if footer[8:10] != self.flags:
+            raise RangedUnsupported('xz header and footer flags differ')
+
+        if index[0] != 0:
+            raise RangedUnsupported('Bad xz index indicator')
+        count, offset = read_varint(index, 1)
+
+        # (compressed offset, padded size, unpadded size, uncompressed offset, uncompressed size)
+        self.blocks = []
+        compressed = XZ_HEADER_SIZE
+        uncompressed = 0
+        for _ in range(count):
+            unpadded, offset = read_varint(index, offset)
+            block_size, offset = read_varint(index, offset)
+            self.blocks.append((compressed, pad4(unpadded), unpadded, uncompressed, block_size))
+            compressed += pad4(unpadded)
+            uncompressed += block_size
+
+        # Concatenated streams or stream padding would put the index somewhere else
+        if compressed + len(index) + XZ_FOOTER_SIZE != size:
+            raise RangedUnsupported('xz member is not a single stream')
+        self.uncompressed_size = uncompressed
+
+    def find(self, position):
+        """Index of the block holding uncompressed `position`"""
+        for number, block in enumerate(self.blocks):
+            if block[3] <= position < block[3] + block[4]:
+                return number
+        return None
+
+    def wrap(self, block):
+        """Stream header, index and footer that turn one raw block into a complete .xz stream"""
+        _, _, unpadded, _, size = block
+        header = XZ_MAGIC + self.flags + struct.pack('<I', zlib.crc32(self.flags))
+        index = b'\x00' + encode_varint(1) + encode_varint(unpadded) + encode_varint(size)
+        index += b'\x00' * (-len(index) % 4)
+        index += struct.pack('<I', zlib.crc32(index))
+        backward = struct.pack('<I', len(index) // 4 - 1)
+        footer = struct.pack('<I', zlib.crc32(backward + self.flags)) + backward + self.flags + b'YZ'
+        return header, index + footer
+
+
+class RangedXZReader:
+    """Forward only reader over the uncompressed data of a remote xz member. Seeking past the
+    end of the current block starts the next Range request at the block that holds the target,
+    the blocks in between are never downloaded"""
+
+    def __init__(self, url, member_offset, index, etag, cancel=None):
+        self.url = url
+        self.member_offset = member_offset
+        self.index = index
+        self.etag = etag
+        self.cancel = cancel
+        self.position = 0
+        self.block_end = 0
+        self.decoder = None
+        self.chunks = None
+        self.pending = b''
+        self.compressed_read = 0
+        self.decompressed = 0
+
+    def close(self):
+        if self.chunks is not None:
+            self.chunks.close()
+            self.chunks = None
+
+    def _start_block(self, number):
+        self.close()
+        block = self.index.blocks[number]
+        compressed, padded, _, uncompressed, size = block
+        start = self.member_offset + compressed
+        logger.debug(f'Reading xz block {number} of {len(self.index.blocks)} from {self.url}')
+
+        header, self.trailer = self.index.wrap(block)
+        self.decoder = lzma.LZMADecompressor(format = lzma.FORMAT_XZ)
+        self.chunks = download.check_cancel(
+            transport.iter_range(self.url, start, start + padded, download.CHUNK_SIZE, self.etag), self.cancel)
+        self.compressed_read += padded
+        self.position = uncompressed
+        self.block_end = uncompressed + size
+        self.pending = self.decoder.decompress(header)
+
+    def _fill(self):
+        """Decode more of the current block into `pending`, False at the end of the block"""
+        while not self.pending:
+            if self.decoder.eof:
+                return False
+            if self.decoder.needs_input:
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    self.pending = self.decoder.decompress(self.trailer)
+                    if not self.decoder.eof:
+                        raise lzma.LZMAError(f'Truncated xz block in {self.url}')
+                    return bool(self.pending)
+                self.pending = self.decoder.decompress(chunk, download.CHUNK_SIZE)
+            else:
+                self.pending = self.decoder.decompress(b'', download.CHUNK_SIZE)
+        return True
+
+    def seek(self, target):
+        """Move forward to uncompressed offset `target`"""
+        if target < self.position:
+            raise ValueError('RangedXZReader only seeks forward')
+        if self.decoder is None or target >= self.block_end:
+            number = self.index.find(target)
+            if number is None:
+                raise EOFError(f'Offset {target} is past the end of the xz data')
+            self._start_block(number)
+        while self.position < target:
+            if not self.pending and not self._fill():
+                raise EOFError(f'xz block ended before offset {target}')
+            step = min(len(self.pending), target - self.position)
+            self.pending = self.pending[step:]
+            self.position += step
+            self.decompressed += step
+
+    def read(self, size):
+        if self.decoder is None or self.position >= self.block_end:
+            if self.position >= self.index.uncompressed_size:
+                return b''
+            self.seek(self.position)
+        if not self.pending and not self._fill():
+            return b''
+        data = self.pending[:size]
+        self.pending = self.pending[len(data):]
+        self.position += len(data)
+        self.decompressed += len(data)
+        return data
+
+
+def fetch(url, start, end, etag):
+    return b''.join(transport.iter_range(url, start, end, download.CHUNK_SIZE, etag))
+
+
+def find_data_member(url, etag):
+    """Walk the ar headers with small Range requests, returns (offset, size) of the data.tar.xz member"""
+    if fetch(url, 0, len(AR_MAGIC), etag) != AR_MAGIC:
+        raise RangedUnsupported(f'{url} is not an ar archive')
+
+    offset = len(AR_MAGIC)
+    while True:
+        header = fetch(url, offset, offset + AR_HEADER_SIZE, etag)
+        name = header[:16].decode().strip().rstrip('/')
+        size = int(header[48:58].decode().strip())
+        if name.startswith('data.tar'):
+            if name != 'data.tar.xz':
+                raise RangedUnsupported(f'{name} has no block index')
+            return offset + AR_HEADER_SIZE, size
+        offset += AR_HEADER_SIZE + size + size % 2
+
+
+def read_index(url, offset, size, etag):
+    header = fetch(url, offset, offset + XZ_HEADER_SIZE, etag)
+    footer = fetch(url, offset + size - XZ_FOOTER_SIZE, offset + size, etag)
+    if footer[10:] != b'YZ':
+        raise RangedUnsupported('xz footer not found, the member may have stream padding')
+    index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+    index_start = offset + size - XZ_FOOTER_SIZE - index_size
+    index = fetch(url, index_start, index_start + index_size, etag)
+    return XZIndex(header, footer, index, size)
+
+
+def pax_headers(data):
+    """Parse pax extended header records, `<length> <key>=<value>\\n`"""
+    headers = {}
+    offset = 0
+    while offset < len(data):
+        length = int(data[offset:data.index(b' ', offset)])
+        record = data[offset:offset + length]
+        key, _, value = record[record.index(b' ') + 1:-1].partition(b'=')
+        headers[key.decode()] = value.decode('utf-8', errors = 'replace')
+        offset += length
+    return headers
+
+
+def find_tar_member(reader, file_name, budget):
+    """Walk the tar headers, seeking past member data, returns the size of `file_name` with the
+    reader positioned at its data or None if it is not in the archive"""
+    offset = 0
+    long_name = None
+    pax = {}
+    while True:
+        reader.seek(offset)
+        block = streaming.read_exact(reader, TAR_BLOCK)
+        if block == b'\x00' * TAR_BLOCK:
+            return None
+        info = tarfile.TarInfo.frombuf(block, tarfile.ENCODING, 'surrogateescape')
+        data_offset = offset + TAR_BLOCK
+        offset = data_offset + info.size + (-info.size % TAR_BLOCK)
+
+        if info.type in (tarfile.GNUTYPE_LONGNAME, tarfile.XHDTYPE):
+            data = streaming.read_exact(reader, info.size)
+            if info.type == tarfile.GNUTYPE_LONGNAME:
+                long_name = data.rstrip(b'\x00').decode('utf-8', errors = 'surrogateescape')
+            else:
+                pax = pax_headers(data)
+            continue
+
+        name = pax.get('path') or long_name or info.name
+        size = int(pax.get('size', info.size))
+        offset = data_offset + size + (-size % TAR_BLOCK)
+        long_name = None
+        pax = {}
+
+        if info.isreg() and streaming.normalise_name(name) == file_name:
+            reader.seek(data_offset)
+            return size
+
+        if reader.compressed_read > budget:
+            raise RangedUnsupported(f'{file_name} is too far into the archive for ranged reads to help')
+
+
+def extract_deb(url, file_name, prefix, cancel=None):
+    """Extract `file_name` from a remote deb by downloading only the xz blocks that hold the tar
+    headers before it and its contents. Raises RangedUnsupported if the package can not be read
+    this way, the caller should then download it in full"""
+    response = transport.head(url, allow_redirects = True)
+    response.raise_for_status()
+    if response.headers.get('Accept-Ranges') != 'bytes':
+        raise RangedUnsupported(f'{url} does not accept Range requests')
+    etag = transport.validator(response)
+
+    member_offset, member_size = find_data_member(url, etag)
+    index = read_index(url, member_offset, member_size, etag)
+    if len(index.blocks) < 2:
+        raise RangedUnsupported('Single block xz, every byte is needed to reach any file')
+
+    reader = RangedXZReader(url, member_offset, index, etag, cancel)
+    try:
+        size = find_tar_member(reader, file_name, member_size * HEADER_BUDGET)
+        if size is None:
+            return None
+        outfile_name = download.write_member(streaming.LimitedReader(reader, size), prefix, file_name)
+    finally:
+        reader.close()
+        metrics.add('bytes_decompressed', reader.decompressed)
+
+    logger.debug(f'Read {reader.compressed_read} of {member_size} bytes of {url} with Range requests')
+    return outfile_name
@@ -1,49 +1,49 @@
 import logging
-import requests
 import rpmfile
-import tempfile
 
-from io import BytesIO
+from parsers import download, streaming
+from utils import local_mirror, package_cache
 
 logger = logging.getLogger(__name__)
 
-def process_rpm(rpm_url, file_pattern):
+def process_rpm(rpm_url, file_pattern, cancel=None, checksum=None):
     """Takes a URL to an rmp file retrieves it and extracts the required file
-    file, if found, is saved to a tempdir"""
+    file, if found, is saved to a tempdir.
+    Setting the `cancel` Event aborts the download, a repository `checksum` is used as the cache key"""
     logger.debug(f'Fetching RPM File: {rpm_url}')
 
-    # We do this in memory to save DiskIO    
-    f = BytesIO()
-
-    with requests.get(rpm_url, stream=True) as r:
-        r.raise_for_status()
-        for chunk in r.iter_content(chunk_size=8192): 
-            # If you have chunk encoded response uncomment if
-            # and set chunk_size parameter to None.
-            #if chunk: 
-            f.write(chunk)
-
-    # Go to start of file.
-    f.seek(0)
-
-
-    rpm = rpmfile.RPMFile(fileobj = f)
-    member = None
-    extracted = None
-    for member in rpm.getmembers():
-        if file_pattern in member.name:
-            logger.debug(f"Extracting {member.name}")
-            extracted = rpm.extractfile(member)
-            break
-    if not extracted:
-        return None
-
-    prefix = 'vmlinux' if 'vmlinux' in member.name else 'System.map'
-
-    with tempfile.NamedTemporaryFile(delete = False,
-                                         prefix = prefix) as outfile:
-    
-        logger.debug(f'Writing {member.name} to {outfile.name}')
-        outfile.write(extracted.read())
-
-    return outfile.name
+    prefix = 'vmlinux' if 'vmlinux' in file_pattern else 'System.map'
+
+    local = local_mirror.local_path(rpm_url) is not None
+
+    if package_cache.enabled() and not local:
+        # Keep the whole package so a rebuild does not download it again
+        f = download.cached_url(rpm_url, cancel, checksum)
+    elif download.MODE == 'stream' or local:
+        # Packages on a local mirror are always read in place, a spool or cache copy gains nothing
+        # Decompress as the package arrives and hang up once the file is written
+        with download.open_url(rpm_url, cancel) as f:
+            outfile_name = streaming.extract_rpm(f, file_pattern, prefix)
+        if not outfile_name:
+            logger.error(f'{file_pattern} not found in {rpm_url}')
+        return outfile_name
+    else:
+        # Spool to disk so memory stays flat regardless of package size
+        f = download.spool_url(rpm_url, cancel)
+
+    # Closing the file also removes a spooled package, whether or not the rpm could be read
+    try:
+        rpm = rpmfile.RPMFile(fileobj = f)
+        member = None
+        extracted = None
+        for member in rpm.getmembers():
+            if file_pattern in member.name:
+                logger.debug(f"Extracting {member.name}")
+                extracted = rpm.extractfile(member)
+                break
+        if not extracted:
+            return None
+
+        return download.write_member(extracted, prefix, member.name)
+    finally:
+        f.close()
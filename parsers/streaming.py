@@ -0,0 +1,207 @@
+import bz2
+import gzip
+import io
+import logging
+import lzma
+import stat
+import struct
+import tarfile
+
+import zstandard
+
+from parsers import download
+from utils import metrics
+
+
+logger = logging.getLogger(__name__)
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER = struct.Struct('16s12s6s6s8s10s2s')
+RPM_LEAD_SIZE = 96
+RPM_HEADER = struct.Struct('>3sB4sii')
+CPIO_HEADER_SIZE = 110
+
+
+class LimitedReader(io.RawIOBase):
+    """Exposes the next `size` bytes of a stream as a file object"""
+
+    def __init__(self, fileobj, size):
+        self._fileobj = fileobj
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.remaining <= 0:
+            return 0
+        data = self._fileobj.read(min(len(b), self.remaining))
+        if not data:
+            raise EOFError('Stream ended before the end of the member')
+        b[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def drain(self):
+        """Discard anything the consumer did not read"""
+        skip(self._fileobj, self.remaining)
+        self.remaining = 0
+
+
+def read_exact(fileobj, size):
+    data = b''
+    while len(data) < size:
+        chunk = fileobj.read(size - len(data))
+        if not chunk:
+            raise EOFError(f'Expected {size} bytes, got {len(data)}')
+        data += chunk
+    return data
+
+
+def skip(fileobj, size):
+    """Move forward `size` bytes on a stream that may not be seekable"""
+    while size > 0:
+        data = fileobj.read(min(size, download.CHUNK_SIZE))
+        if not data:
+            raise EOFError('Stream ended while skipping')
+        size -= len(data)
+
+
+def decompressor(fileobj, name):
+    """Wrap `fileobj` with a streaming decompressor chosen by the member name"""
+    if name.endswith('.xz') or name.endswith('.lzma'):
+        return lzma.LZMAFile(fileobj)
+    if name.endswith('.gz'):
+        return gzip.GzipFile(fileobj = fileobj)
+    if name.endswith('.zst'):
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    if name.endswith('.bz2'):
+        return bz2.BZ2File(fileobj)
+    return fileobj
+
+
+def decompressed_size(reader):
+    """Bytes read out of a decompressor so far, None for readers that can not tell"""
+    try:
+        return reader.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def sniff_decompressor(fileobj):
+    """Wrap `fileobj` with a streaming decompressor chosen by its magic bytes"""
+    fileobj = io.BufferedReader(fileobj, download.CHUNK_SIZE)
+    magic = fileobj.peek(6)[:6]
+    if magic.startswith(b'\xfd7zXZ'):
+        return lzma.LZMAFile(fileobj)
+    if magic.startswith(b'\x1f\x8b'):
+        return gzip.GzipFile(fileobj = fileobj)
+    if magic.startswith(b'\x28\xb5\x2f\xfd'):
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    if magic.startswith(b'BZh'):
+        return bz2.BZ2File(fileobj)
+    # Legacy lzma_alone payloads have no magic
+    return lzma.LZMAFile(fileobj, format = lzma.FORMAT_ALONE)
+
+
+def iter_ar(fileobj):
+    """Yields (name, reader) for each member of an ar archive read sequentially"""
+    if read_exact(fileobj, len(AR_MAGIC)) != AR_MAGIC:
+        raise ValueError('Not an ar archive')
+
+    while True:
+        header = fileobj.read(AR_HEADER.size)
+        if not header:
+            return
+        if len(header) != AR_HEADER.size:
+            raise EOFError('Truncated ar member header')
+        name, _, _, _, _, size, fmag = AR_HEADER.unpack(header)
+        if fmag != b'`\n':
+            raise ValueError('Corrupt ar member header')
+        size = int(size)
+        member = LimitedReader(fileobj, size)
+
+        yield name.decode().rstrip().rstrip('/'), member
+
+        member.drain()
+        # Members are aligned to 2 bytes
+        skip(fileobj, size % 2)
+
+
+def iter_cpio(fileobj):
+    """Yields (name, mode, reader) for each member of a newc cpio archive read sequentially"""
+    while True:
+        header = read_exact(fileobj, CPIO_HEADER_SIZE)
+        if header[:6] not in (b'070701', b'070702'):
+            raise ValueError(f'Bad cpio magic {header[:6]}')
+        fields = [int(header[6 + i * 8:14 + i * 8], 16) for i in range(13)]
+        mode, file_size, name_size = fields[1], fields[6], fields[11]
+
+        name = read_exact(fileobj, name_size)[:-1].decode()
+        skip(fileobj, -(CPIO_HEADER_SIZE + name_size) % 4)
+        if name == 'TRAILER!!!':
+            return
+
+        member = LimitedReader(fileobj, file_size)
+
+        yield name, mode, member
+
+        member.drain()
+        skip(fileobj, -file_size % 4)
+
+
+def skip_rpm_headers(fileobj):
+    """Consume the rpm lead, signature and main header leaving the stream at the payload"""
+    read_exact(fileobj, RPM_LEAD_SIZE)
+    for padded in (True, False):
+        magic, _, _, index_count, store_size = RPM_HEADER.unpack(read_exact(fileobj, RPM_HEADER.size))
+        if magic != b'\x8e\xad\xe8':
+            raise ValueError('Bad rpm header magic')
+        size = index_count * 16 + store_size
+        skip(fileobj, size)
+        # Only the signature header is padded to 8 bytes
+        if padded:
+            skip(fileobj, -(RPM_HEADER.size + size) % 8)
+
+
+def normalise_name(name):
+    """Tar and cpio members are stored as ./path, compare them as /path"""
+    return '/' + name.removeprefix('./').lstrip('/')
+
+
+def extract_deb(fileobj, file_name, prefix):
+    """Stream a deb from `fileobj` and write `file_name` from its data archive to a temp file.
+    Reading stops as soon as the member has been written. Returns the path or None"""
+    for member_name, member in iter_ar(fileobj):
+        if not member_name.startswith('data.tar'):
+            continue
+
+        logger.debug(f'Streaming {member_name}')
+        data = decompressor(member, member_name)
+        try:
+            with tarfile.open(fileobj = data, mode = 'r|') as tar:
+                for tar_info in tar:
+                    if tar_info.isfile() and normalise_name(tar_info.name) == file_name:
+                        logger.debug(f'Extracting {tar_info.name}')
+                        return download.write_member(tar.extractfile(tar_info), prefix, file_name)
+        finally:
+            metrics.add('bytes_decompressed', decompressed_size(data))
+        return None
+    return None
+
+
+def extract_rpm(fileobj, file_pattern, prefix):
+    """Stream an rpm from `fileobj` and write the first member matching `file_pattern` to a temp file.
+    Reading stops as soon as the member has been written. Returns the path or None"""
+    skip_rpm_headers(fileobj)
+
+    payload = sniff_decompressor(fileobj)
+    try:
+        for name, mode, member in iter_cpio(payload):
+            # Hard linked files only carry data on their last entry
+            if file_pattern in name and stat.S_ISREG(mode) and member.remaining:
+                logger.debug(f'Extracting {name}')
+                return download.write_member(member, prefix, name)
+    finally:
+        metrics.add('bytes_decompressed', decompressed_size(payload))
+    return None
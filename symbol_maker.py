@@ -1,12 +1,12 @@
 import argparse
 import json
 import logging
-import lzma
 import os
 import subprocess
+import tempfile
+import time
 
 
-from base64 import b64decode
 from pathlib import Path
 
 from distributions.ubuntu_base import UbuntuBase
@@ -14,91 +14,340 @@ from distributions.debian_base import DebianBase
 from distributions.fedora_base import FedoraBase
 from distributions.amazon_base import AmazonBase
 from distributions.cbl_mariner_base import CBLMariner
+from parsers import download
+from utils import (admission, compression, listing_cache, local_mirror, manifest, metrics, mirrors, package_cache, planner,
+                   transport, validation, zstd_dictionary)
+from utils.banner_index import BannerIndex, normalise_banner
+from utils.pipeline import Pipeline
 
 
-def create_isf(system_map, vmlinux, kernel, output_path):
-    """Given a System.map and vmlinux file create the ISF and write to output path compressed"""
+logger = logging.getLogger(__name__)
+
+
+def create_isf(system_map, vmlinux, kernel, output_path, compress_threads=None, dwarf2json=None,
+               isf_format='xz', dictionary=None):
+    """Given a System.map and vmlinux file create the ISF and write to output path compressed.
+    dwarf2json output is piped straight into a parallel xz writer and scanned for the banner on the way,
+    so the JSON is never held in memory or written to disk uncompressed.
+    `dwarf2json` overrides the binary shipped next to this script. `isf_format` 'zst' writes a
+    .json.zst instead, compressed with the zstd `dictionary` if one is given"""
 
     banner_path = output_path / 'banner.txt'
-    isf_path = output_path / f'{kernel}.json.xz'
+    isf_path = output_path / compression.isf_name(kernel, isf_format)
+    partial_path = output_path / f'{isf_path.name}.partial'
 
-    root = Path(__file__).resolve().parent
-    if os.name == 'nt':
-        dwarf2json = Path(root, "dwarf2json.exe")
-    else:
-        dwarf2json = Path(root, "dwarf2json")
+    if dwarf2json is None:
+        root = Path(__file__).resolve().parent
+        if os.name == 'nt':
+            dwarf2json = Path(root, "dwarf2json.exe")
+        else:
+            dwarf2json = Path(root, "dwarf2json")
 
     dwarf_args = [dwarf2json, 'linux', '--system-map', system_map, '--elf', vmlinux]
     logger.debug(dwarf_args)
     logger.info(f'Creating ISF {isf_path}')
-    proc = subprocess.run(dwarf_args, capture_output = True)
 
-    logger.info('Reading Banner')
-    try:
-        json_data = json.loads(proc.stdout)
-        banner_encoded = json_data['symbols']['linux_banner']['constant_data']
-        banner_decoded = b64decode(banner_encoded).rstrip(b'\n\x00')
+    scanner = compression.BannerScanner()
+
+    with tempfile.TemporaryFile(dir = download.SPOOL_DIR) as stderr:
+        # Waits until there is memory for dwarf2json alongside the other conversions
+        with admission.get_gate().admit(os.path.getsize(vmlinux)) as ticket:
+            start = time.perf_counter()
+            proc = subprocess.Popen(dwarf_args, stdout = subprocess.PIPE, stderr = stderr)
+            ticket.pid = proc.pid
+            ticket.sample()
+            try:
+                with open(partial_path, 'wb') as f, compression.isf_writer(f, isf_format, compress_threads, dictionary) as writer:
+                    for chunk in iter(lambda: proc.stdout.read(download.CHUNK_SIZE), b''):
+                        # dwarf2json blocks on the pipe until the JSON is read, so it is still running here
+                        ticket.sample()
+                        scanner.feed(chunk)
+                        writer.write(chunk)
+                rusage = metrics.wait_process(proc)
+            except BaseException:
+                proc.kill()
+                proc.wait()
+                remove_files(partial_path)
+                raise
+            finally:
+                proc.stdout.close()
+            if ticket.peak is None and rusage is not None:
+                # No /proc, ru_maxrss is the only measure there is
+                ticket.peak = metrics.max_rss(rusage)
+            peak = ticket.peak
+            if proc.returncode != 0:
+                # A failed run says nothing about what a complete one needs
+                ticket.peak = None
+
+        # Compression runs alongside dwarf2json so this wall time covers both
+        metrics.set_value('dwarf2json_wall', time.perf_counter() - start)
+        if rusage is not None:
+            metrics.set_value('dwarf2json_cpu', rusage.ru_utime + rusage.ru_stime)
+        metrics.set_value('dwarf2json_max_rss', peak)
+
+        if proc.returncode != 0:
+            remove_files(partial_path)
+            stderr.seek(0)
+            raise RuntimeError(f'dwarf2json exited with {proc.returncode}: {stderr.read().decode(errors="replace").strip()}')
+
+    # Only a complete ISF gets the final name
+    os.replace(partial_path, isf_path)
+    logger.debug(f'Compressed {writer.bytes_in} bytes to {writer.bytes_out}')
+    metrics.add('bytes_json', writer.bytes_in)
+    metrics.add('bytes_compressed', writer.bytes_out)
+    metrics.set_value('compression_ratio', writer.bytes_in / writer.bytes_out)
+    metrics.set_value('compress_time', writer.compress_time)
 
+    logger.info('Reading Banner')
+    if scanner.banner is not None:
+        banner_decoded = scanner.banner.rstrip(b'\n\x00')
         banner_path.write_text(banner_decoded.decode())
         logger.debug(f'Found banner: {banner_decoded}')
-
-    except Exception as err:
-        logger.error(f'Could not process banner: {err}')
-
-    logger.debug('Writing compressed isf file')
-
-    with lzma.open(isf_path, 'w') as f:
-        f.write(proc.stdout)
+    else:
+        logger.error('Could not process banner: linux_banner not found in dwarf2json output')
 
     logger.info(f'ISF created at {isf_path}')
+    return scanner.banner
 
 
-def main(target_distro, kernel_filter, branch):
+def remove_files(*paths):
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
 
-    if target_distro == 'ubuntu':
-        distro = UbuntuBase(branch)
-    elif target_distro == 'debian':
-        distro = DebianBase(branch)
-    elif target_distro == 'fedora':
-        distro = FedoraBase(branch)
-    elif target_distro == 'amazon':
-        distro = AmazonBase(branch)
-    elif target_distro == "cbl-mariner":
-        distro = CBLMariner(branch)
 
-    distro.get_kernel_list(kernel_filter)
+def fetch_stage(job):
+    """Download the System.map and vmlinux for a kernel"""
+    distro = job['distro']
+    kernel = job['kernel']
+    system_map = None
+    vmlinux = None
 
-    logger.info(f'Found {len(distro.kernel_pairs)} symbol sets')
+    logger.info(f'Processing Files for {kernel}')
 
-    for kernel, symbol_set in distro.kernel_pairs.items():
-        system_map = None
-        vmlinux = None
-        output_path = Path('symbol_files', distro.operating_system, kernel)
-        isf_path = output_path / f'{kernel}.json.xz'
-        if isf_path.exists():
-            logger.warning(f'ISF already exists at {isf_path}')
-            continue
+    with metrics.stage('download', distro.operating_system, kernel) as record:
+        try:
+            system_map, vmlinux = distro.extract_files(job['symbol_set'], kernel)
+        except Exception as err:
+            logger.error(f'Could not extract files: {err}')
+            reason = err
         else:
-            isf_path.parent.mkdir(parents=True, exist_ok=True)    
+            reason = 'System.map or vmlinux not found in packages'
 
-        valid = distro.validate_links(kernel)
-        if valid:
-            logger.info(f'Processing Files for {kernel}')
+        if system_map and vmlinux:
+            job['system_map'] = system_map
+            job['vmlinux'] = vmlinux
+            return job
 
-            try:
-                system_map, vmlinux = distro.extract_files(symbol_set, kernel)
-            except Exception as err:
-                logger.error(f'Could not extract files: {err}')
+        record['status'] = 'failed'
 
-        if system_map and vmlinux:
+    remove_files(system_map, vmlinux)
+    job['manifest'].failed(kernel, job['symbol_set'], f'download: {reason}')
+    return None
+
+
+def isf_stage(job):
+    """Convert the extracted files to a compressed ISF, the inputs are removed either way"""
+    try:
+        with metrics.stage('isf', job['distro'].operating_system, job['kernel']) as record:
             try:
-                create_isf(system_map, vmlinux, kernel, output_path)
+                start = time.monotonic()
+                job['banner'] = create_isf(job['system_map'], job['vmlinux'], job['kernel'], job['output_path'],
+                                           job['compress_threads'], job['dwarf2json'],
+                                           isf_format = job['isf_format'],
+                                           dictionary = job['dictionary'])
+                job['isf_seconds'] = time.monotonic() - start
             except Exception as err:
                 logger.error(f'Could not create ISF File: {err}')
+                record['status'] = 'failed'
+                job['manifest'].failed(job['kernel'], job['symbol_set'], f'isf: {err}')
+                return None
+
+        if job['banner'] is not None:
+            job['index'].add(job['output_path'] / compression.isf_name(job['kernel'], job['isf_format']),
+                             job['banner'],
+                             job['distro'].operating_system,
+                             job['kernel'])
+    except Exception as err:
+        logger.error(f'Could not index ISF File: {err}')
+    finally:
+        logger.info("Cleanup Temp Files")
+        remove_files(job['system_map'], job['vmlinux'])
+
+    banner = job['banner'] and normalise_banner(job['banner'])
+    job['manifest'].done(job['kernel'], job['symbol_set'], banner, job['isf_seconds'])
+    return job
+
+
+DISTROS = {
+    "ubuntu": UbuntuBase,
+    "debian": DebianBase,
+    "fedora": FedoraBase,
+    "amazon": AmazonBase,
+    "cbl-mariner": CBLMariner
+}
+
+# Every distro and branch `-d all` covers
+ALL_TARGETS = [('ubuntu', 'linux'),
+               ('ubuntu', 'linux-aws'),
+               ('ubuntu', 'linux-azure'),
+               ('ubuntu', 'linux-gcp'),
+               ('debian', 'linux'),
+               ('fedora', 'linux'),
+               ('amazon', '2'),
+               ('cbl-mariner', 'linux')]
+
+
+def check_targets(targets):
+    """Raise ValueError for the first (distro, kernel, branch) with an unknown distro or unsupported branch,
+    so a bad target stops a batch before any of it runs"""
+    for target_distro, _, branch in targets:
+        if target_distro not in DISTROS:
+            raise ValueError(f"Unknown distro {target_distro}, expected one of {', '.join(DISTROS)}")
+        try:
+            DISTROS[target_distro](branch)
+        except ValueError as err:
+            raise ValueError(f'{target_distro}: {err}') from None
+
+
+def load_job_file(job_file, kernel_filter=None):
+    """Read a batch job file, a JSON list of {"distro": ..., "branch": ..., "kernel": ...}.
+    branch defaults to linux and kernel to `kernel_filter` or all. Returns [(distro, kernel, branch)]"""
+    with open(job_file) as f:
+        jobs = json.load(f)
+
+    if not isinstance(jobs, list) or not all(isinstance(job, dict) for job in jobs):
+        raise ValueError('expected a JSON list of objects, e.g. [{"distro": "ubuntu", "branch": "linux-aws"}]')
+    targets = [(job.get('distro'), job.get('kernel') or kernel_filter or 'all', job.get('branch', 'linux'))
+               for job in jobs]
+    check_targets(targets)
+    return targets
+
+
+def prepare(target_distro, kernel_filter, branch, queued, validate_jobs=validation.JOBS, retry_failed=False,
+            plan=False):
+    """List and validate one distro and branch. Kernels already in `queued` from an earlier target,
+    by name or by package URLs, are left out and the rest added to it. With `plan` the manifest is
+    only read, missing links are not recorded. Returns (distro, run manifest, valid kernels)"""
+    distro = DISTROS[target_distro](branch)
+
+    with metrics.stage('listing', distro.operating_system):
+        distro.get_kernel_list(kernel_filter)
+
+    logger.info(f'Found {len(distro.kernel_pairs)} symbol sets for {target_distro} {branch}')
+
+    run_manifest = manifest.RunManifest(distro.operating_system, branch, retry_failed)
+
+    pending = []
+    shared = 0
+    for kernel in distro.kernel_pairs:
+        # Branches that list the same pool only need their packages fetched once
+        keys = [(distro.operating_system, kernel), tuple(planner.package_urls(distro.kernel_pairs[kernel]))]
+        if any(key in queued for key in keys):
+            shared += 1
+            continue
+        output_path = Path('symbol_files', distro.operating_system, kernel)
+        existing = [output_path / compression.isf_name(kernel, isf_format) for isf_format in compression.SUFFIXES]
+        existing = [isf_path for isf_path in existing if isf_path.exists()]
+        if existing:
+            logger.warning(f'ISF already exists at {existing[0]}')
+            continue
+        # Kernels that failed recently are left until their backoff runs out
+        if not run_manifest.eligible(kernel):
+            continue
+        queued.update(keys)
+        pending.append(kernel)
+
+    if shared:
+        logger.info(f'{shared} kernels are already queued from another branch')
+    logger.info(f'{len(pending)} kernels to process, {len(distro.kernel_pairs) - len(pending)} skipped')
+
+    def on_invalid(kernel, symbol_set):
+        # A plan is a dry run, it must not push the next real attempt back
+        if not plan:
+            run_manifest.failed(kernel, symbol_set, 'links missing', status = manifest.INVALID)
+
+    # Check every remaining pair up front so dead links never reach the pipeline
+    with metrics.stage('validate', distro.operating_system):
+        valid_kernels = validation.validate_pairs(distro, pending, validate_jobs, on_invalid = on_invalid)
+    return distro, run_manifest, valid_kernels
+
+
+def main(targets, download_jobs=1, isf_jobs=1, compress_threads=None, validate_jobs=validation.JOBS,
+         retry_failed=False, dwarf2json=None, plan=False, order='listing', max_download=None, max_disk=None,
+         max_time=None, isf_format=compression.FORMAT):
+    """Build ISFs for every (distro, kernel filter, branch) in `targets`. All of them share one
+    pipeline, so the download and ISF jobs, the budgets and the per host limits apply to the whole batch"""
+
+    index = BannerIndex()
+    queued = set()
+    work = {}
+    estimates = []
+    for target_distro, kernel_filter, branch in targets:
+        try:
+            distro, run_manifest, valid_kernels = prepare(target_distro, kernel_filter, branch, queued,
+                                                          validate_jobs, retry_failed, plan)
+        except Exception as err:
+            logger.error(f'Could not list {target_distro} {branch}: {err}')
+            continue
+        for kernel in valid_kernels:
+            work[distro.operating_system, kernel] = (distro, run_manifest)
+        # Sizes from the HEAD requests or repodata decide what fits the budgets and in which order it runs
+        estimates.extend(planner.estimate(distro, valid_kernels, run_manifest, index))
+
+    selected, skipped = planner.select(planner.order(estimates, order), download_jobs, isf_jobs,
+                                       max_download, max_disk, max_time)
+    if plan:
+        planner.report(selected, skipped, download_jobs, isf_jobs)
+        index.close()
+        return
+    if skipped:
+        logger.info(f'{len(skipped)} kernels are over budget and left for a later run')
+
+    dictionaries = {}
+    if isf_format == 'zst':
+        for operating_system in {item.distro for item in selected}:
+            dictionary_path, dictionaries[operating_system] = zstd_dictionary.latest(operating_system)
+            if dictionary_path is None:
+                logger.warning(f'No zstd dictionary trained for {operating_system}, see isf_zstd.py train')
+            else:
+                logger.info(f'Compressing {operating_system} with zstd dictionary {dictionary_path}')
+
+    # Downloads and ISF creation each get their own workers
+    # so the network and CPU are both kept busy on large runs
+    pipeline = Pipeline([
+        ('download', fetch_stage, download_jobs),
+        ('isf', isf_stage, isf_jobs)
+    ])
+
+    start = time.monotonic()
+    for number, item in enumerate(selected):
+        # Submitting blocks while the downloads are busy, so this tracks real progress
+        if max_time is not None and time.monotonic() - start > max_time:
+            logger.warning(f'Time budget used up, {len(selected) - number} kernels left for a later run')
+            break
+        kernel = item.kernel
+        distro, run_manifest = work[item.distro, kernel]
+        output_path = Path('symbol_files', distro.operating_system, kernel)
+        output_path.mkdir(parents=True, exist_ok=True)
+
+        pipeline.submit({
+            "distro": distro,
+            "kernel": kernel,
+            "symbol_set": distro.kernel_pairs[kernel],
+            "output_path": output_path,
+            "compress_threads": compress_threads,
+            "dwarf2json": dwarf2json,
+            "isf_format": isf_format,
+            "dictionary": dictionaries.get(distro.operating_system),
+            "index": index,
+            "manifest": run_manifest
+            })
+
+    pipeline.join()
+    index.close()
+    mirrors.save()
 
-            logger.info("Cleanup Temp Files")
-            os.remove(system_map)
-            os.remove(vmlinux)
 
 if __name__ == '__main__':
 
@@ -106,15 +355,15 @@ if __name__ == '__main__':
     parser.add_argument("-d",
                         "--distro",
                         dest = 'distro',
-                        help = "Target Distribution",
-                        choices = ['ubuntu', 'debian', 'fedora', 'amazon', 'cbl-mariner'],
-                        required = True)
+                        help = "Target Distribution, 'all' runs every distribution and cloud branch in one batch",
+                        choices = list(DISTROS) + ['all'],
+                        required = False)
                         
     parser.add_argument("-k",
                         "--kernel",
                         dest = 'kernel',
                         help = "Target Kernel release or 'all'\n The output of `uname -r`",
-                        required = True)
+                        required = False)
 
     parser.add_argument("-b",
                         "--branch",
@@ -123,6 +372,244 @@ if __name__ == '__main__':
                         help = "Target Kernel branch e.g. linux-aws",
                         required = False)
 
+    parser.add_argument("--job-file",
+                        dest = 'job_file',
+                        help = "JSON list of {\"distro\", \"branch\", \"kernel\"} targets to run as one batch instead of -d and -b",
+                        required = False)
+
+    parser.add_argument("--spool-dir",
+                        dest = 'spool_dir',
+                        help = "Scratch directory for downloaded packages, defaults to the system temp dir",
+                        required = False)
+
+    parser.add_argument("--download-mode",
+                        dest = 'download_mode',
+                        default = 'stream',
+                        choices = download.MODES,
+                        help = "Extract while downloading (stream) or download the whole package first (spool)",
+                        required = False)
+
+    parser.add_argument("--no-ranged",
+                        dest = 'ranged',
+                        action = 'store_false',
+                        help = "Always download whole packages, never only the xz blocks holding the files",
+                        required = False)
+
+    parser.add_argument("--segments",
+                        dest = 'segments',
+                        type = int,
+                        default = download.SEGMENTS,
+                        help = "Parallel Range requests per package when spooling or caching, 1 disables segmented downloads",
+                        required = False)
+
+    parser.add_argument("--segment-min-size",
+                        dest = 'segment_min_size',
+                        type = float,
+                        default = download.SEGMENT_MIN_SIZE / 1024 ** 2,
+                        help = "Only packages of at least this many MB are downloaded in segments",
+                        required = False)
+
+    parser.add_argument("--package-cache",
+                        dest = 'package_cache',
+                        help = "Keep downloaded packages in this directory and reuse them on later runs",
+                        required = False)
+
+    parser.add_argument("--package-cache-size",
+                        dest = 'package_cache_size',
+                        type = float,
+                        default = package_cache.MAX_SIZE / 1024 ** 3,
+                        help = "Maximum size of the package cache in GB, least recently used packages are removed first",
+                        required = False)
+
+    parser.add_argument("--listing-cache",
+                        dest = 'listing_cache',
+                        default = str(listing_cache.CACHE_DIR),
+                        help = "Directory used to cache repository listings and metadata",
+                        required = False)
+
+    parser.add_argument("--listing-ttl",
+                        dest = 'listing_ttl',
+                        type = int,
+                        default = listing_cache.TTL,
+                        help = "Seconds to use a cached listing without revalidating it, 0 always revalidates",
+                        required = False)
+
+    parser.add_argument("--mirror-root",
+                        dest = 'mirror_root',
+                        help = "Local copy of the repositories laid out as <root>/<host>/<path>, read in place instead of over HTTP",
+                        required = False)
+
+    parser.add_argument("--no-mirrors",
+                        dest = 'mirrors',
+                        action = 'store_false',
+                        help = "Only download from each distribution's default host",
+                        required = False)
+
+    parser.add_argument("--mirror-stats",
+                        dest = 'mirror_stats',
+                        default = str(mirrors.STATS_FILE),
+                        help = "File used to keep mirror throughput and error rates between runs",
+                        required = False)
+
+    parser.add_argument("--download-jobs",
+                        dest = 'download_jobs',
+                        type = int,
+                        default = 2,
+                        help = "Number of kernels to download and extract at once",
+                        required = False)
+
+    parser.add_argument("--host-jobs",
+                        dest = 'host_jobs',
+                        type = int,
+                        help = "Most package transfers to run against one host at once, across all download jobs and segments",
+                        required = False)
+
+    parser.add_argument("--isf-jobs",
+                        dest = 'isf_jobs',
+                        type = int,
+                        default = 1,
+                        help = "Number of dwarf2json processes to run at once",
+                        required = False)
+
+    parser.add_argument("--compress-threads",
+                        dest = 'compress_threads',
+                        type = int,
+                        default = compression.THREADS,
+                        help = "Number of xz compression threads per ISF file",
+                        required = False)
+
+    parser.add_argument("--memory-budget",
+                        dest = 'memory_budget',
+                        type = float,
+                        help = "GB the running dwarf2json processes may use together, defaults to total memory less the headroom",
+                        required = False)
+
+    parser.add_argument("--memory-headroom",
+                        dest = 'memory_headroom',
+                        type = float,
+                        default = admission.HEADROOM / 1024 ** 3,
+                        help = "GB of available memory to leave free when starting dwarf2json",
+                        required = False)
+
+    parser.add_argument("--memory-history",
+                        dest = 'memory_history',
+                        default = str(admission.HISTORY_FILE),
+                        help = "File of measured dwarf2json peak memory used to estimate later runs",
+                        required = False)
+
+    parser.add_argument("--isf-format",
+                        dest = 'isf_format',
+                        choices = list(compression.SUFFIXES),
+                        default = compression.FORMAT,
+                        help = "Write ISFs as .json.xz or as .json.zst with the distribution's trained zstd dictionary",
+                        required = False)
+
+    parser.add_argument("--zstd-level",
+                        dest = 'zstd_level',
+                        type = int,
+                        default = compression.ZSTD_LEVEL,
+                        help = "zstd compression level for --isf-format zst",
+                        required = False)
+
+    parser.add_argument("--validate-jobs",
+                        dest = 'validate_jobs',
+                        type = int,
+                        default = validation.JOBS,
+                        help = "Number of link validation requests to run at once",
+                        required = False)
+
+    parser.add_argument("--timeout",
+                        dest = 'timeout',
+                        type = float,
+                        default = transport.READ_TIMEOUT,
+                        help = "Seconds to wait for data from a server before retrying",
+                        required = False)
+
+    parser.add_argument("--retries",
+                        dest = 'retries',
+                        type = int,
+                        default = transport.RETRIES,
+                        help = "Number of times to retry or resume a failed request",
+                        required = False)
+
+    parser.add_argument("--metrics",
+                        dest = 'metrics',
+                        help = "Append per kernel, per stage timings and byte counts to this JSON lines file",
+                        required = False)
+
+    parser.add_argument("--metrics-prom",
+                        dest = 'metrics_prom',
+                        help = "Write running totals to this file for the Prometheus node_exporter textfile collector",
+                        required = False)
+
+    parser.add_argument("--profile",
+                        dest = 'profile',
+                        nargs = '+',
+                        choices = ['listing', 'validate', 'download', 'isf'],
+                        help = "Run these stages under cProfile, one kernel at a time is profiled",
+                        required = False)
+
+    parser.add_argument("--profile-dir",
+                        dest = 'profile_dir',
+                        default = str(metrics.PROFILE_DIR),
+                        help = "Directory for the cProfile and tracemalloc output",
+                        required = False)
+
+    parser.add_argument("--tracemalloc",
+                        dest = 'tracemalloc',
+                        action = 'store_true',
+                        help = "Also record Python memory allocations in profiled stages",
+                        required = False)
+
+    parser.add_argument("--plan",
+                        dest = 'plan',
+                        action = 'store_true',
+                        help = "List what would be downloaded and built with size and time estimates, then exit",
+                        required = False)
+
+    parser.add_argument("--order",
+                        dest = 'order',
+                        choices = planner.POLICIES,
+                        default = 'listing',
+                        help = "Order kernels are built in, newest version or smallest download first",
+                        required = False)
+
+    parser.add_argument("--max-download",
+                        dest = 'max_download',
+                        type = float,
+                        help = "Only start kernels whose packages fit in this many GB of downloads",
+                        required = False)
+
+    parser.add_argument("--max-disk",
+                        dest = 'max_disk',
+                        type = float,
+                        help = "Only start kernels whose ISFs fit in this many GB",
+                        required = False)
+
+    parser.add_argument("--max-time",
+                        dest = 'max_time',
+                        type = float,
+                        help = "Only plan kernels expected to finish within this many hours and stop starting new ones after it",
+                        required = False)
+
+    parser.add_argument("--dwarf2json",
+                        dest = 'dwarf2json',
+                        help = "Path to the dwarf2json binary, defaults to the one next to this script",
+                        required = False)
+
+    parser.add_argument("--retry-failed",
+                        dest = 'retry_failed',
+                        action = 'store_true',
+                        help = "Retry kernels that failed on earlier runs without waiting for their backoff",
+                        required = False)
+
+    parser.add_argument("--retry-backoff",
+                        dest = 'retry_backoff',
+                        type = float,
+                        default = manifest.BACKOFF / 3600,
+                        help = "Hours to wait before retrying a failed kernel, doubled with each failed attempt",
+                        required = False)
+
     parser.add_argument("-v",
                         "--verbose",
                         dest = 'verbose',
@@ -133,6 +620,23 @@ if __name__ == '__main__':
     parser.set_defaults(verbose=False)
     args = parser.parse_args()
 
+    if args.job_file:
+        try:
+            targets = load_job_file(args.job_file, args.kernel)
+        except (OSError, ValueError, TypeError) as err:
+            parser.error(f'Could not read job file {args.job_file}: {err}')
+    elif args.distro and args.kernel:
+        if args.distro == 'all':
+            targets = [(distro, args.kernel, branch) for distro, branch in ALL_TARGETS]
+        else:
+            targets = [(args.distro, args.kernel, args.branch)]
+        try:
+            check_targets(targets)
+        except ValueError as err:
+            parser.error(str(err))
+    else:
+        parser.error('-d and -k are required unless a --job-file is given')
+
     if args.verbose:
         log_level = logging.DEBUG
     else:
@@ -142,4 +646,38 @@ if __name__ == '__main__':
     logger = logging.getLogger(__name__)
     logger.info('Started')
 
-    main(args.distro, args.kernel, args.branch)
+    download.configure(spool_dir = args.spool_dir,
+                       mode = args.download_mode,
+                       ranged = args.ranged,
+                       segments = args.segments,
+                       segment_min_size = args.segment_min_size * 1024 ** 2)
+    compression.configure(zstd_level = args.zstd_level)
+    transport.configure(read_timeout = args.timeout, retries = args.retries, host_jobs = args.host_jobs)
+    listing_cache.configure(cache_dir = args.listing_cache, ttl = args.listing_ttl)
+    local_mirror.configure(mirror_root = args.mirror_root)
+    mirrors.configure(stats_file = args.mirror_stats, enabled = args.mirrors)
+    package_cache.configure(cache_dir = args.package_cache,
+                            max_size = args.package_cache_size * 1024 ** 3)
+    admission.configure(budget = args.memory_budget * 1024 ** 3 if args.memory_budget else None,
+                        headroom = args.memory_headroom * 1024 ** 3,
+                        history_file = args.memory_history)
+    manifest.configure(backoff = args.retry_backoff * 3600)
+    metrics.configure(metrics_file = args.metrics,
+                      prom_file = args.metrics_prom,
+                      profile_stages = args.profile,
+                      profile_dir = args.profile_dir,
+                      trace_memory = args.tracemalloc)
+
+    main(targets,
+         download_jobs = args.download_jobs,
+         isf_jobs = args.isf_jobs,
+         compress_threads = args.compress_threads,
+         validate_jobs = args.validate_jobs,
+         retry_failed = args.retry_failed,
+         dwarf2json = args.dwarf2json,
+         plan = args.plan,
+         order = args.order,
+         max_download = args.max_download * 1024 ** 3 if args.max_download is not None else None,
+         max_disk = args.max_disk * 1024 ** 3 if args.max_disk is not None else None,
+         max_time = args.max_time * 3600 if args.max_time is not None else None,
+         isf_format = args.isf_format)
@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+
+from utils import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Total bytes the running dwarf2json processes may use, None allows all of MemTotal less HEADROOM
+BUDGET = None
+# Memory left for the rest of the system, downloads and xz compression
+HEADROOM = 1024 ** 3
+HISTORY_FILE = Path.home() / '.cache' / 'volatility_symbols' / 'dwarf2json_memory.json'
+# Peak RSS as a multiple of the vmlinux size, used until there is some history
+DEFAULT_RATIO = 6.0
+# Estimates use the largest recent ratio plus a margin
+HISTORY_SIZE = 50
+MARGIN = 1.1
+# How often waiting jobs look at MemAvailable again
+POLL_INTERVAL = 5
+
+
+def configure(budget=None, headroom=None, history_file=None):
+    global BUDGET, HEADROOM, HISTORY_FILE
+    if budget is not None:
+        BUDGET = int(budget)
+    if headroom is not None:
+        HEADROOM = int(headroom)
+    if history_file is not None:
+        HISTORY_FILE = Path(history_file)
+
+
+def meminfo(field):
+    """A /proc/meminfo value in bytes, None where there is no /proc"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def process_status(pid, field):
+    """A /proc/<pid>/status memory value in bytes, 0 once the process has exited or where there is no /proc"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def process_rss(pid):
+    return process_status(pid, 'VmRSS')
+
+
+def process_peak(pid):
+    """High water mark of `pid` itself. ru_maxrss from wait4 also counts the parent's memory at fork time"""
+    return process_status(pid, 'VmHWM')
+
+
+class Ticket:
+    """A dwarf2json run that has been admitted, the caller sets `pid` and calls `sample` while it runs"""
+
+    def __init__(self, estimate, vmlinux_size):
+        self.estimate = estimate
+        self.vmlinux_size = vmlinux_size
+        self.pid = None
+        self.peak = None
+
+    def sample(self):
+        """Raise `peak` to the high water mark of `pid`, which can only be read while it is running"""
+        self.peak = max(self.peak or 0, process_peak(self.pid)) or None
+
+    def growth(self):
+        """How much more this run is expected to take than it has now"""
+        if self.pid is None:
+            return self.estimate
+        return max(0, self.estimate - process_rss(self.pid))
+
+
+class MemoryGate:
+    """Admits dwarf2json runs in order while their estimated peaks fit in the budget and in
+    MemAvailable. A run bigger than the whole budget waits until it can run alone rather than
+    failing, and the runs behind it wait too so it is not starved by smaller ones"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.running = []
+        self.waiting = []
+        self.history_lock = threading.Lock()
+        self.ratios = self.load()
+
+    def load(self):
+        try:
+            return json.loads(HISTORY_FILE.read_text())['ratios'][-HISTORY_SIZE:]
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError, KeyError) as err:
+            logger.warning(f'Ignoring unreadable memory history {HISTORY_FILE}: {err}')
+            return []
+
+    def save(self):
+        HISTORY_FILE.parent.mkdir(parents = True, exist_ok = True)
+        fd, tmp_path = tempfile.mkstemp(dir = HISTORY_FILE.parent, prefix = '.memory-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({"ratios": self.ratios}, f)
+        os.replace(tmp_path, HISTORY_FILE)
+
+    def estimate(self, vmlinux_size):
+        with self.history_lock:
+            ratio = max(self.ratios) * MARGIN if self.ratios else DEFAULT_RATIO
+        return int(vmlinux_size * ratio)
+
+    def budget(self):
+        if BUDGET is not None:
+            return BUDGET
+        total = meminfo('MemTotal')
+        return None if total is None else total - HEADROOM
+
+    def fits(self, estimate):
+        if not self.running:
+            # Always let one run go, however big, so the batch keeps moving
+            return True
+        budget = self.budget()
+        if budget is not None and sum(ticket.estimate for ticket in self.running) + estimate > budget:
+            return False
+        available = meminfo('MemAvailable')
+        if available is not None:
+            # Running jobs have not all reached their peak yet
+            growth = sum(ticket.growth() for ticket in self.running)
+            if estimate + growth > available - HEADROOM:
+                return False
+        return True
+
+    @contextmanager
+    def admit(self, vmlinux_size):
+        """Block until a run for a vmlinux of `vmlinux_size` bytes fits, yields its Ticket"""
+        ticket = Ticket(self.estimate(vmlinux_size), vmlinux_size)
+        budget = self.budget()
+        if budget is not None and ticket.estimate > budget:
+            logger.warning(f'dwarf2json is expected to need {ticket.estimate / 1024 ** 3:.1f}GB, '
+                           f'more than the {budget / 1024 ** 3:.1f}GB budget, it will run on its own')
+
+        start = time.monotonic()
+        with self.condition:
+            self.waiting.append(ticket)
+            try:
+                while self.waiting[0] is not ticket or not self.fits(ticket.estimate):
+                    self.condition.wait(POLL_INTERVAL)
+            finally:
+                self.waiting.remove(ticket)
+                self.condition.notify_all()
+            self.running.append(ticket)
+        waited = time.monotonic() - start
+        metrics.set_value('memory_estimate', ticket.estimate)
+        metrics.set_value('memory_wait', waited)
+        if waited > 1:
+            logger.info(f'Waited {waited:.0f}s for {ticket.estimate / 1024 ** 3:.1f}GB to run dwarf2json')
+
+        try:
+            yield ticket
+        finally:
+            with self.condition:
+                self.running.remove(ticket)
+                self.condition.notify_all()
+            if ticket.peak:
+                self.record(ticket)
+
+    def record(self, ticket):
+        """Keep the measured peak so later estimates follow the kernels actually seen"""
+        if not ticket.vmlinux_size:
+            return
+        ratio = ticket.peak / ticket.vmlinux_size
+        logger.debug(f'dwarf2json peaked at {ticket.peak / 1024 ** 2:.0f}MB, estimated '
+                     f'{ticket.estimate / 1024 ** 2:.0f}MB')
+        with self.history_lock:
+            self.ratios = (self.ratios + [ratio])[-HISTORY_SIZE:]
+            try:
+                self.save()
+            except OSError as err:
+                logger.warning(f'Could not save memory history: {err}')
+
+
+_gate = None
+_gate_lock = threading.Lock()
+
+
+def get_gate():
+    """The process wide gate, shared by every ISF worker"""
+    global _gate
+    with _gate_lock:
+        if _gate is None:
+            _gate = MemoryGate()
+        return _gate
@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import lzma
+import sqlite3
+import threading
+
+from pathlib import Path
+
+import zstandard
+
+from utils import compression, zstd_dictionary
+
+
+logger = logging.getLogger(__name__)
+
+SYMBOL_ROOT = Path('symbol_files')
+INDEX_NAME = 'banners.sqlite'
+ISF_SUFFIXES = list(compression.SUFFIXES.values())
+CHUNK_SIZE = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS isf (
+    path TEXT PRIMARY KEY,
+    banner TEXT NOT NULL,
+    identifier BLOB,
+    distro TEXT NOT NULL,
+    kernel TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS isf_banner ON isf (banner);
+"""
+
+
+def normalise_banner(banner):
+    """Banners are stored and looked up without the trailing newline and NUL of the kernel string"""
+    if isinstance(banner, bytes):
+        banner = banner.rstrip(b'\n\x00').decode(errors = 'replace')
+    return banner.rstrip('\n\x00 ')
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_isf_banner(isf_path, dict_dir=None):
+    """Scan a compressed ISF for its raw linux_banner, falls back to the banner.txt next to it"""
+    scanner = compression.BannerScanner()
+    try:
+        with zstd_dictionary.open_isf(isf_path, dict_dir) as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                scanner.feed(chunk)
+                if scanner.banner is not None:
+                    return scanner.banner
+    except (OSError, lzma.LZMAError, zstandard.ZstdError) as err:
+        logger.warning(f'Could not read {isf_path}: {err}')
+
+    # banner.txt is already stripped so the raw identifier is unknown
+    banner_path = isf_path.parent / 'banner.txt'
+    if banner_path.exists():
+        return banner_path.read_text()
+    return None
+
+
+class BannerIndex:
+    """SQLite index mapping banner -> distro, kernel, ISF path, size and hash for a symbol_files tree"""
+
+    def __init__(self, root=SYMBOL_ROOT, path=None):
+        self.root = Path(root)
+        self.path = Path(path) if path else self.root / INDEX_NAME
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread = False)
+        self.conn.row_factory = sqlite3.Row
+        # WAL lets readers keep querying while a build is adding ISFs
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _row(self, isf_path, banner, distro, kernel):
+        isf_path = Path(isf_path)
+        stat = isf_path.stat()
+        return (isf_path.relative_to(self.root).as_posix(),
+                normalise_banner(banner),
+                banner if isinstance(banner, bytes) else None,
+                distro,
+                kernel,
+                stat.st_size,
+                file_sha256(isf_path),
+                stat.st_mtime)
+
+    def add(self, isf_path, banner, distro, kernel):
+        """Record a newly written ISF, each add is its own transaction"""
+        row = self._row(isf_path, banner, distro, kernel)
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO isf VALUES (?, ?, ?, ?, ?, ?, ?, ?)', row)
+        logger.debug(f'Indexed {row[0]}')
+
+    def lookup(self, banner):
+        """Returns every ISF whose banner matches exactly"""
+        with self.lock:
+            rows = self.conn.execute('SELECT * FROM isf WHERE banner = ?', (normalise_banner(banner),)).fetchall()
+        return [dict(row) for row in rows]
+
+    def duplicates(self):
+        """Returns {banner: [paths]} for banners produced by more than one ISF"""
+        with self.lock:
+            rows = self.conn.execute('''SELECT banner, path FROM isf WHERE banner IN
+                                        (SELECT banner FROM isf GROUP BY banner HAVING COUNT(*) > 1)
+                                        ORDER BY banner, path''').fetchall()
+        duplicates = {}
+        for row in rows:
+            duplicates.setdefault(row['banner'], []).append(row['path'])
+        return duplicates
+
+    def entries(self):
+        with self.lock:
+            return [dict(row) for row in self.conn.execute('SELECT * FROM isf ORDER BY path')]
+
+    def rebuild(self):
+        """Replace the index with the ISFs found under `root`, in a single transaction"""
+        rows = []
+        for isf_path in sorted(self.root.glob('*/*/*')):
+            if not any(isf_path.name.endswith(suffix) for suffix in ISF_SUFFIXES):
+                continue
+            distro, kernel = isf_path.parent.parent.name, isf_path.parent.name
+            banner = read_isf_banner(isf_path, self.root / zstd_dictionary.DICT_DIR.name)
+            if banner is None:
+                logger.warning(f'No banner found for {isf_path}')
+                continue
+            rows.append(self._row(isf_path, banner, distro, kernel))
+
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM isf')
+            self.conn.executemany('INSERT OR REPLACE INTO isf VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+        logger.info(f'Indexed {len(rows)} ISF files under {self.root}')
+        return len(rows)
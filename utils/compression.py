@@ -0,0 +1,195 @@
+import logging
+import lzma
+import os
+import re
+import time
+
+from base64 import b64decode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import zstandard
+
+
+logger = logging.getLogger(__name__)
+
+# Uncompressed bytes per xz stream, larger blocks compress better but hold more memory per thread
+BLOCK_SIZE = 16 * 1024 * 1024
+THREADS = min(4, os.cpu_count() or 1)
+PRESET = 6
+ZSTD_LEVEL = 19
+
+# Output format of new ISF files and their suffixes
+FORMAT = 'xz'
+SUFFIXES = {"xz": '.json.xz', "zst": '.json.zst'}
+
+BANNER_MARKER = b'"linux_banner"'
+BANNER_PATTERN = re.compile(rb'"linux_banner"\s*:\s*\{.*?"constant_data"\s*:\s*"([A-Za-z0-9+/=]*)"', re.S)
+# How far past the marker the constant_data is allowed to be
+BANNER_WINDOW = 64 * 1024
+
+
+def configure(isf_format=None, zstd_level=None):
+    global FORMAT, ZSTD_LEVEL
+    if isf_format is not None:
+        FORMAT = isf_format
+    if zstd_level is not None:
+        ZSTD_LEVEL = zstd_level
+
+
+class ParallelXZWriter:
+    """File like writer that splits the input into BLOCK_SIZE blocks and compresses them on a
+    thread pool. Each block is written as its own xz stream, concatenated streams are a valid
+    .xz file that `lzma.open` and `xz -d` read as one. At most two blocks per thread are held
+    in memory so the footprint stays flat however much is written"""
+
+    def __init__(self, fileobj, threads=None, block_size=BLOCK_SIZE, preset=PRESET):
+        self.fileobj = fileobj
+        self.threads = max(1, threads or THREADS)
+        self.block_size = block_size
+        self.preset = preset
+        self.executor = ThreadPoolExecutor(max_workers = self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Summed across threads, so it can be more than the wall time
+        self.compress_time = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _compress(self, block):
+        start = time.perf_counter()
+        compressed = lzma.compress(block, format = lzma.FORMAT_XZ, preset = self.preset)
+        return compressed, time.perf_counter() - start
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(self._compress, block))
+        while len(self.pending) >= self.threads * 2:
+            self._write_next()
+
+    def _write_next(self):
+        compressed, elapsed = self.pending.popleft().result()
+        self.compress_time += elapsed
+        self.fileobj.write(compressed)
+        self.bytes_out += len(compressed)
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_in += len(data)
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        """Compress what is left and wait for every block to be written in order"""
+        if self.buffer or not self.bytes_in:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self._write_next()
+        self.executor.shutdown()
+
+    def abort(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown()
+
+
+class ZstdWriter:
+    """File like writer producing a zstd frame, optionally with a shared dictionary, compressed
+    on `threads` worker threads inside libzstd. Same counters as ParallelXZWriter"""
+
+    def __init__(self, fileobj, threads=None, dictionary=None, level=None):
+        self.fileobj = fileobj
+        self.start = fileobj.tell()
+        compressor = zstandard.ZstdCompressor(level = level or ZSTD_LEVEL,
+                                              dict_data = dictionary,
+                                              threads = max(1, threads or THREADS),
+                                              write_checksum = True)
+        self.writer = compressor.stream_writer(fileobj, closefd = False)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Time spent handing data to libzstd, which includes waiting on its workers
+        self.compress_time = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+    def write(self, data):
+        start = time.perf_counter()
+        self.writer.write(data)
+        self.compress_time += time.perf_counter() - start
+        self.bytes_in += len(data)
+        return len(data)
+
+    def close(self):
+        start = time.perf_counter()
+        self.writer.close()
+        self.compress_time += time.perf_counter() - start
+        self.bytes_out = self.fileobj.tell() - self.start
+
+
+def isf_name(kernel, isf_format=None):
+    return f'{kernel}{SUFFIXES[isf_format or FORMAT]}'
+
+
+def isf_writer(fileobj, isf_format=None, threads=None, dictionary=None):
+    """Compressing writer for an ISF in `isf_format`, the dictionary only applies to zst"""
+    if (isf_format or FORMAT) == 'zst':
+        return ZstdWriter(fileobj, threads, dictionary)
+    return ParallelXZWriter(fileobj, threads)
+
+
+class BannerScanner:
+    """Picks the linux_banner constant out of dwarf2json output as it streams past,
+    without holding or parsing the whole JSON document"""
+
+    def __init__(self):
+        self.banner = None
+        self._tail = b''
+        self._window = None
+
+    def feed(self, chunk):
+        if self.banner is not None:
+            return
+
+        if self._window is None:
+            data = self._tail + chunk
+            index = data.find(BANNER_MARKER)
+            if index < 0:
+                # Keep enough to catch a marker split across chunks
+                self._tail = data[-len(BANNER_MARKER):]
+                return
+            self._window = data[index:]
+        else:
+            self._window += chunk
+
+        while True:
+            match = BANNER_PATTERN.match(self._window)
+            if match:
+                self.banner = b64decode(match.group(1))
+                return
+            if len(self._window) <= BANNER_WINDOW:
+                return
+            logger.debug('linux_banner found without constant_data, continuing search')
+            # A later linux_banner key may already be in the window, possibly with only part of its value
+            index = self._window.find(BANNER_MARKER, 1)
+            if index < 0:
+                self._tail = self._window[-len(BANNER_MARKER):]
+                self._window = None
+                return
+            self._window = self._window[index:]
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from pathlib import Path
+
+from utils import local_mirror, transport
+
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = Path.home() / '.cache' / 'volatility_symbols' / 'listings'
+# Seconds a cached page is used without asking the server, 0 always revalidates
+TTL = 0
+CHUNK_SIZE = 1024 * 1024
+
+
+class CachedResponse:
+    """The parts of a requests Response the distributions use, backed by a file on disk"""
+
+    def __init__(self, url, status_code, path=None):
+        self.url = url
+        self.status_code = status_code
+        self.path = path
+
+    @property
+    def content(self):
+        if self.path is None:
+            return b''
+        return self.path.read_bytes()
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors = 'replace')
+
+    def open(self):
+        """Open the cached body for streaming reads"""
+        return open(self.path, 'rb')
+
+
+def configure(cache_dir=None, ttl=None):
+    global CACHE_DIR, TTL
+    if cache_dir:
+        CACHE_DIR = Path(cache_dir)
+    if ttl is not None:
+        TTL = ttl
+
+
+def _write_atomic(path, write):
+    with tempfile.NamedTemporaryFile(dir = path.parent, prefix = '.tmp', delete = False) as tmp:
+        try:
+            write(tmp)
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+    os.replace(tmp.name, path)
+
+
+def get(url, ttl=None):
+    """GET `url` through the on disk cache. Cached pages are revalidated with
+    If-None-Match/If-Modified-Since and only downloaded again if they changed.
+    Pages on a local mirror are read straight from disk"""
+    path = local_mirror.local_path(url)
+    if path is not None:
+        return local_mirror.LocalResponse(url, path)
+
+    ttl = TTL if ttl is None else ttl
+    CACHE_DIR.mkdir(parents = True, exist_ok = True)
+
+    key = hashlib.sha256(url.encode()).hexdigest()
+    body_path = CACHE_DIR / key
+    meta_path = CACHE_DIR / f'{key}.json'
+
+    meta = None
+    if body_path.exists() and meta_path.exists():
+        try:
+            meta = json.loads(meta_path.read_text())
+        except ValueError:
+            meta = None
+
+    headers = {}
+    if meta:
+        if ttl and time.time() - meta['fetched'] < ttl:
+            logger.debug(f'Using cached {url}')
+            return CachedResponse(url, 200, body_path)
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    with transport.get(url, headers = headers, stream = True) as r:
+        if r.status_code == 304 and meta:
+            logger.debug(f'{url} not modified')
+            meta['fetched'] = time.time()
+        elif r.status_code == 200:
+            logger.debug(f'Caching {url}')
+
+            def write_body(f):
+                for chunk in r.iter_content(chunk_size = CHUNK_SIZE):
+                    f.write(chunk)
+
+            _write_atomic(body_path, write_body)
+            meta = {
+                "url": url,
+                "etag": r.headers.get('ETag'),
+                "last_modified": r.headers.get('Last-Modified'),
+                "fetched": time.time()
+            }
+        else:
+            # Errors are not cached, the caller decides what a 404 means
+            return CachedResponse(url, r.status_code)
+
+    _write_atomic(meta_path, lambda f: f.write(json.dumps(meta).encode()))
+    return CachedResponse(url, 200, body_path)
@@ -0,0 +1,117 @@
+import html
+import io
+import logging
+import os
+
+from email.utils import formatdate
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+from utils import mirrors
+
+
+logger = logging.getLogger(__name__)
+
+# Directory holding a copy of the repositories as <root>/<host>/<path>, None reads everything over HTTP
+MIRROR_ROOT = None
+
+
+def configure(mirror_root=None):
+    global MIRROR_ROOT
+    if mirror_root is not None:
+        MIRROR_ROOT = Path(mirror_root)
+
+
+def enabled():
+    return MIRROR_ROOT is not None
+
+
+def _map(url):
+    parts = urlsplit(url)
+    return Path(MIRROR_ROOT, parts.hostname or '', unquote(parts.path).lstrip('/'))
+
+
+def local_path(url):
+    """Where `url` is on disk, for file:// URLs and any http(s) URL once a mirror root is set.
+    None means it has to be fetched over the network"""
+    if url.startswith('file://'):
+        return Path(unquote(urlsplit(url).path))
+    if MIRROR_ROOT is None or not url.startswith(('http://', 'https://')):
+        return None
+
+    path = _map(url)
+    if not path.exists():
+        # The local copy may have been taken from another mirror of the same host
+        mirror_set, prefix = mirrors.find(url)
+        if mirror_set is not None:
+            for other in mirror_set.prefixes:
+                candidate = _map(f'{other}{url[len(prefix):]}')
+                if candidate.exists():
+                    return candidate
+    return path
+
+
+def listing(path):
+    """Autoindex style page for a directory, with the <a href="..."> links the distributions parse"""
+    names = sorted(f'{entry.name}/' if entry.is_dir() else entry.name for entry in os.scandir(path))
+    links = '\n'.join(f'<a href="{html.escape(name)}">{html.escape(name)}</a>' for name in names)
+    return f'<html><body><pre>\n{links}\n</pre></body></html>\n'.encode()
+
+
+def iter_file(path, start, end, chunk_size):
+    """Yields bytes `start` up to `end` of a local file"""
+    with open(path, 'rb', buffering = 0) as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                raise EOFError(f'{path} ended before byte {end}')
+            remaining -= len(chunk)
+            yield chunk
+
+
+class LocalResponse:
+    """The parts of a requests Response used for HEAD requests and listings, for a file or directory on disk"""
+
+    def __init__(self, url, path):
+        self.url = url
+        self.path = path
+        self.headers = {}
+        self.body = None
+        try:
+            stat = path.stat()
+        except OSError:
+            self.status_code = 404
+            return
+
+        self.status_code = 200
+        if path.is_dir():
+            self.body = listing(path)
+            self.headers['Content-Length'] = str(len(self.body))
+        else:
+            self.headers['Content-Length'] = str(stat.st_size)
+            self.headers['Accept-Ranges'] = 'bytes'
+        self.headers['ETag'] = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        self.headers['Last-Modified'] = formatdate(stat.st_mtime, usegmt = True)
+
+    def raise_for_status(self):
+        if self.status_code != 200:
+            raise FileNotFoundError(f'{self.path} not found for {self.url}')
+
+    @property
+    def content(self):
+        if self.status_code != 200:
+            return b''
+        if self.body is not None:
+            return self.body
+        return self.path.read_bytes()
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors = 'replace')
+
+    def open(self):
+        if self.body is not None:
+            return io.BytesIO(self.body)
+        return open(self.path, 'rb')
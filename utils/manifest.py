@@ -0,0 +1,96 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_DIR = Path('symbol_files', '.manifests')
+# A failed kernel is skipped for BACKOFF seconds, doubling with each attempt up to MAX_BACKOFF
+BACKOFF = 24 * 60 * 60
+MAX_BACKOFF = 30 * 24 * 60 * 60
+
+DONE = 'done'
+INVALID = 'invalid'
+FAILED = 'failed'
+
+# Fields copied from kernel_pairs so a manifest shows what was tried
+PAIR_FIELDS = ['kernel_deb', 'debug_deb', 'kernel_rpm', 'debug_rpm', 'kernel', 'kernel_size', 'debug_size']
+
+
+def configure(manifest_dir=None, backoff=None, max_backoff=None):
+    global MANIFEST_DIR, BACKOFF, MAX_BACKOFF
+    if manifest_dir is not None:
+        MANIFEST_DIR = Path(manifest_dir)
+    if backoff is not None:
+        BACKOFF = backoff
+    if max_backoff is not None:
+        MAX_BACKOFF = max_backoff
+
+
+class RunManifest:
+    """Per distro/branch record of every kernel attempted, its status, failure reason and attempt count.
+    Saved after every change so an interrupted run keeps what it learned"""
+
+    def __init__(self, distro, branch, retry_failed=False):
+        self.path = MANIFEST_DIR / f'{distro}-{branch}.json'
+        self.retry_failed = retry_failed
+        self.lock = threading.Lock()
+        self.kernels = self.load()
+
+    def load(self):
+        try:
+            return json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as err:
+            logger.warning(f'Ignoring unreadable manifest {self.path}: {err}')
+            return {}
+
+    def save(self):
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        fd, tmp_path = tempfile.mkstemp(dir = self.path.parent, prefix = '.manifest-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.kernels, f, indent = 2, sort_keys = True)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def eligible(self, kernel):
+        """True if the kernel is new, or a failure whose backoff has run out"""
+        entry = self.kernels.get(kernel)
+        if entry is None or entry['status'] == DONE:
+            return True
+        if self.retry_failed:
+            return True
+        if time.time() >= entry['retry_after']:
+            return True
+        logger.debug(f"Skipping {kernel}, {entry['status']} after {entry['attempts']} attempts: {entry['reason']}")
+        return False
+
+    def _update(self, kernel, symbol_set, **fields):
+        with self.lock:
+            entry = self.kernels.setdefault(kernel, {"attempts": 0})
+            entry.update({field: symbol_set[field] for field in PAIR_FIELDS if symbol_set.get(field) is not None})
+            entry.update(fields)
+            entry['updated'] = time.time()
+            self.save()
+
+    def done(self, kernel, symbol_set, banner=None, isf_seconds=None):
+        self._update(kernel, symbol_set, status = DONE, reason = None, retry_after = 0,
+                     banner = banner, isf_seconds = isf_seconds)
+
+    def failed(self, kernel, symbol_set, reason, status=FAILED):
+        """Record a failed attempt and push the next one back exponentially"""
+        attempts = self.kernels.get(kernel, {}).get('attempts', 0) + 1
+        backoff = min(BACKOFF * 2 ** (attempts - 1), MAX_BACKOFF)
+        self._update(kernel, symbol_set, status = status, reason = str(reason), attempts = attempts,
+                     retry_after = time.time() + backoff)
+        logger.debug(f'{kernel} {status} ({reason}), next attempt in {backoff / 3600:.0f} hours')
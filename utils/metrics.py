@@ -0,0 +1,198 @@
+import contextvars
+import cProfile
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+# JSON lines file with one record per kernel and stage, None disables it
+METRICS_FILE = None
+# Prometheus textfile collector output, None disables it
+PROM_FILE = None
+# Stages to run under cProfile, profiles are written to PROFILE_DIR as <kernel>-<stage>.prof
+PROFILE_STAGES = set()
+PROFILE_DIR = Path('profiles')
+TRACEMALLOC = False
+PROM_PREFIX = 'volatility_symbols'
+
+# The record of the stage running in this context, download threads inherit it through fetch_pair
+current = contextvars.ContextVar('metrics_stage', default = None)
+
+lock = threading.Lock()
+profile_lock = threading.Lock()
+totals = {}
+
+
+def configure(metrics_file=None, prom_file=None, profile_stages=None, profile_dir=None, trace_memory=None):
+    global METRICS_FILE, PROM_FILE, PROFILE_STAGES, PROFILE_DIR, TRACEMALLOC
+    if metrics_file is not None:
+        METRICS_FILE = Path(metrics_file)
+    if prom_file is not None:
+        PROM_FILE = Path(prom_file)
+    if profile_stages is not None:
+        PROFILE_STAGES = set(profile_stages)
+    if profile_dir is not None:
+        PROFILE_DIR = Path(profile_dir)
+    if trace_memory is not None:
+        TRACEMALLOC = trace_memory
+
+
+def enabled():
+    return METRICS_FILE is not None or PROM_FILE is not None
+
+
+def add(name, value):
+    """Add to a counter of the current stage, does nothing outside a stage"""
+    record = current.get()
+    if record is not None and value is not None:
+        with lock:
+            record[name] = record.get(name, 0) + value
+
+
+def set_value(name, value):
+    """Set a value on the current stage e.g. a peak or a ratio"""
+    record = current.get()
+    if record is not None and value is not None:
+        record[name] = value
+
+
+def run_in_context(func):
+    """Wrap `func` so it runs with a copy of the caller's context, for use with thread pools"""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
+
+
+@contextmanager
+def stage(name, distro=None, kernel=None):
+    """Time a stage and collect the counters added while it runs. The record is yielded so the
+    caller can set `status`, it is written out when the stage ends"""
+    record = {"stage": name, "distro": distro, "kernel": kernel, "status": 'ok'}
+    token = current.set(record)
+    profiler = start_profile(name)
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    try:
+        yield record
+    except BaseException:
+        record['status'] = 'error'
+        raise
+    finally:
+        record['wall'] = time.perf_counter() - start_wall
+        # Only this thread, helper threads and child processes are not included
+        record['cpu'] = time.thread_time() - start_cpu
+        if 'bytes_downloaded' in record and record['wall']:
+            record['download_rate'] = record['bytes_downloaded'] / record['wall']
+        stop_profile(profiler, record)
+        current.reset(token)
+        emit(record)
+
+
+def start_profile(name):
+    if name not in PROFILE_STAGES:
+        return None
+    # Only one cProfile can be active at a time, concurrent kernels are left unprofiled
+    if not profile_lock.acquire(blocking = False):
+        logger.debug(f'Profiler busy, not profiling this {name} stage')
+        return None
+    if TRACEMALLOC and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if TRACEMALLOC:
+        tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profile(profiler, record):
+    if profiler is None:
+        return
+    profiler.disable()
+    try:
+        PROFILE_DIR.mkdir(parents = True, exist_ok = True)
+        path = PROFILE_DIR / f"{record['kernel'] or 'all'}-{record['stage']}.prof"
+        profiler.dump_stats(path)
+        record['profile'] = str(path)
+        if TRACEMALLOC:
+            record['tracemalloc_peak'] = tracemalloc.get_traced_memory()[1]
+            snapshot = tracemalloc.take_snapshot()
+            top = snapshot.statistics('lineno')[:25]
+            path.with_suffix('.tracemalloc.txt').write_text('\n'.join(str(line) for line in top) + '\n')
+    finally:
+        profile_lock.release()
+
+
+def emit(record):
+    record['time'] = time.time()
+    if not enabled():
+        return
+    with lock:
+        if METRICS_FILE is not None:
+            METRICS_FILE.parent.mkdir(parents = True, exist_ok = True)
+            with open(METRICS_FILE, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        if PROM_FILE is not None:
+            update_totals(record)
+            write_prom()
+
+
+def update_totals(record):
+    labels = (('stage', record['stage']),)
+    status_labels = labels + (('status', record['status']),)
+    totals[('stage_runs_total', status_labels)] = totals.get(('stage_runs_total', status_labels), 0) + 1
+    totals[('stage_seconds_total', labels)] = totals.get(('stage_seconds_total', labels), 0) + record['wall']
+    totals[('stage_cpu_seconds_total', labels)] = totals.get(('stage_cpu_seconds_total', labels), 0) + record['cpu']
+    for name, value in record.items():
+        if name.startswith('bytes_'):
+            key = ('bytes_total', labels + (('kind', name[len('bytes_'):]),))
+            totals[key] = totals.get(key, 0) + value
+    if 'dwarf2json_max_rss' in record:
+        key = ('dwarf2json_max_rss_bytes', ())
+        totals[key] = max(totals.get(key, 0), record['dwarf2json_max_rss'])
+    totals[('last_update_timestamp_seconds', ())] = record['time']
+
+
+def write_prom():
+    """Rewrite the textfile, it is replaced atomically so the collector never reads half of it"""
+    lines = []
+    previous = None
+    for (name, labels), value in sorted(totals.items()):
+        if name != previous:
+            lines.append(f"# TYPE {PROM_PREFIX}_{name} {'counter' if name.endswith('_total') else 'gauge'}")
+            previous = name
+        label_text = ','.join(f'{key}="{label}"' for key, label in labels)
+        label_text = f'{{{label_text}}}' if label_text else ''
+        lines.append(f'{PROM_PREFIX}_{name}{label_text} {value}')
+
+    PROM_FILE.parent.mkdir(parents = True, exist_ok = True)
+    fd, tmp_path = tempfile.mkstemp(dir = PROM_FILE.parent, prefix = '.metrics-')
+    with os.fdopen(fd, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, PROM_FILE)
+
+
+def wait_process(proc):
+    """Wait for a Popen and return its resource usage where the platform reports it, else None.
+    On Linux ru_maxrss includes the parent's memory at fork time, so peaks are read from /proc while it runs"""
+    if not hasattr(os, 'wait4'):
+        proc.wait()
+        return None
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+
+def max_rss(rusage):
+    """ru_maxrss in bytes, it is KiB on Linux and bytes on macOS"""
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss
+    return rusage.ru_maxrss * 1024
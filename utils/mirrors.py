@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+STATS_FILE = Path.home() / '.cache' / 'volatility_symbols' / 'mirrors.json'
+ENABLED = True
+# Weight of the newest sample in the moving averages
+ALPHA = 0.3
+# A mirror that failed this recently is only used when the others are worse still
+ERROR_COOLDOWN = 10 * 60
+# Mirrors are probed again once their newest sample is older than this
+PROBE_INTERVAL = 24 * 60 * 60
+# Transfers smaller than this are mostly latency and are not counted towards throughput
+MIN_SAMPLE = 1024 * 1024
+
+lock = threading.Lock()
+mirror_sets = []
+stats = None
+last_save = 0
+
+
+def configure(stats_file=None, enabled=None):
+    global STATS_FILE, ENABLED
+    if stats_file is not None:
+        STATS_FILE = Path(stats_file)
+    if enabled is not None:
+        ENABLED = enabled
+
+
+class MirrorSet:
+    """URL prefixes that serve the same files under the same relative paths"""
+
+    def __init__(self, prefixes):
+        self.prefixes = list(prefixes)
+        self.probe_lock = threading.Lock()
+        self.probed = False
+
+    def match(self, url):
+        """The prefix `url` starts with, or None"""
+        for prefix in self.prefixes:
+            if url.startswith(prefix):
+                return prefix
+        return None
+
+
+def register(prefixes):
+    """Declare `prefixes` as mirrors of each other, the first is the distribution's default"""
+    with lock:
+        for mirror_set in mirror_sets:
+            if mirror_set.prefixes == list(prefixes):
+                return mirror_set
+        mirror_set = MirrorSet(prefixes)
+        mirror_sets.append(mirror_set)
+        return mirror_set
+
+
+def load():
+    global stats
+    if stats is None:
+        try:
+            stats = json.loads(STATS_FILE.read_text())
+        except FileNotFoundError:
+            stats = {}
+        except (OSError, ValueError) as err:
+            logger.warning(f'Ignoring unreadable mirror stats {STATS_FILE}: {err}')
+            stats = {}
+    return stats
+
+
+def save():
+    global last_save
+    with lock:
+        if stats is None:
+            return
+        data = json.dumps(stats, indent = 2, sort_keys = True)
+        last_save = time.time()
+    STATS_FILE.parent.mkdir(parents = True, exist_ok = True)
+    fd, tmp_path = tempfile.mkstemp(dir = STATS_FILE.parent, prefix = '.mirrors-')
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, STATS_FILE)
+
+
+def score(prefix, now):
+    """Throughput discounted by the error rate, mirrors without samples come first so they get measured"""
+    entry = load().get(prefix)
+    if entry is None or entry.get('rate') is None:
+        return float('inf')
+    value = entry['rate'] * (1 - entry['errors'])
+    if now - entry.get('last_error', 0) < ERROR_COOLDOWN:
+        value *= 0.1
+    return value
+
+
+def find(url):
+    """The MirrorSet and matching prefix for `url`, or (None, None)"""
+    if ENABLED:
+        for mirror_set in mirror_sets:
+            prefix = mirror_set.match(url)
+            if prefix:
+                return mirror_set, prefix
+    return None, None
+
+
+def candidates(url):
+    """`url` rewritten onto each mirror of its set, best first. Just [url] for hosts without mirrors"""
+    mirror_set, prefix = find(url)
+    if mirror_set is None:
+        return [url]
+    path = url[len(prefix):]
+    now = time.time()
+    with lock:
+        ranked = sorted(mirror_set.prefixes, key = lambda mirror: score(mirror, now), reverse = True)
+    return [f'{mirror}{path}' for mirror in ranked]
+
+
+def expected_rate(url):
+    """Best measured throughput in bytes/s among the mirrors of `url`, None if there are no samples"""
+    mirror_set, _ = find(url)
+    if mirror_set is None:
+        return None
+    with lock:
+        entries = load()
+        rates = [entries[prefix]['rate'] for prefix in mirror_set.prefixes
+                 if entries.get(prefix, {}).get('rate') is not None]
+    return max(rates) if rates else None
+
+
+def needs_probe(url):
+    """True the first time a set is used in a run if any of its mirrors has no recent sample"""
+    mirror_set, _ = find(url)
+    if mirror_set is None or mirror_set.probed:
+        return False
+    now = time.time()
+    with lock:
+        entries = load()
+        return any(now - entries.get(prefix, {}).get('updated', 0) > PROBE_INTERVAL
+                   for prefix in mirror_set.prefixes)
+
+
+def _update(url, rate=None, error=False):
+    mirror_set, prefix = find(url)
+    if mirror_set is None:
+        return
+    with lock:
+        entry = load().setdefault(prefix, {"rate": None, "errors": 0, "samples": 0})
+        if rate is not None:
+            entry['rate'] = rate if entry['rate'] is None else ALPHA * rate + (1 - ALPHA) * entry['rate']
+        entry['errors'] = ALPHA * (1 if error else 0) + (1 - ALPHA) * entry['errors']
+        entry['samples'] += 1
+        entry['updated'] = time.time()
+        if error:
+            entry['last_error'] = entry['updated']
+        due = entry['updated'] - last_save > 30
+    # Keep what was learned even if the run is killed
+    if due:
+        save()
+
+
+def record(url, size, seconds):
+    """A transfer from `url` finished or was handed to another mirror after `size` bytes"""
+    if size >= MIN_SAMPLE and seconds > 0:
+        _update(url, rate = size / seconds)
+    elif size:
+        _update(url)
+
+
+def record_error(url):
+    _update(url, error = True)
+    logger.debug(f'Recorded an error for the mirror of {url}')
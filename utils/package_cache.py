@@ -0,0 +1,128 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, only threads in this process are coordinated
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+# Cache is disabled unless a directory is configured
+CACHE_DIR = None
+MAX_SIZE = 20 * 1024 ** 3
+
+_locks = {}
+_locks_guard = threading.Lock()
+
+
+def configure(cache_dir=None, max_size=None):
+    """Enable the package cache in `cache_dir` holding at most `max_size` bytes"""
+    global CACHE_DIR, MAX_SIZE
+    if cache_dir:
+        CACHE_DIR = Path(cache_dir)
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    if max_size:
+        MAX_SIZE = int(max_size)
+
+
+def enabled():
+    return CACHE_DIR is not None
+
+
+def cache_key(url, etag=None, length=None, checksum=None):
+    """A repository checksum identifies the content on its own, otherwise use the url and its validators"""
+    if checksum:
+        material = checksum
+    else:
+        material = f'{url}\n{etag or ""}\n{length or ""}'
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+def entry_path(key):
+    return CACHE_DIR / key[:2] / key
+
+
+@contextmanager
+def _locked(name):
+    """Serialise access to `name` across threads and, where supported, processes"""
+    with _locks_guard:
+        thread_lock = _locks.setdefault(name, threading.Lock())
+
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(CACHE_DIR / f'.{name}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def open_entry(key, fill):
+    """Returns an open file for the cache entry `key`. On a miss `fill(fileobj)` is called to
+    write the content, only one worker fills a given key and the others wait for it.
+    The file is returned open so eviction by another worker cannot pull it out from under us"""
+    path = entry_path(key)
+
+    with _locked(key[:16]):
+        if path.exists():
+            logger.debug(f'Package cache hit {key}')
+            # mtime is the LRU clock
+            os.utime(path)
+            return open(path, 'rb')
+
+        logger.debug(f'Package cache miss {key}')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write next to the entry and rename so readers never see a partial file
+        with tempfile.NamedTemporaryFile(dir = path.parent, prefix = '.tmp', delete = False) as tmp:
+            try:
+                fill(tmp)
+            except BaseException:
+                tmp.close()
+                os.remove(tmp.name)
+                raise
+        os.replace(tmp.name, path)
+        f = open(path, 'rb')
+
+    evict()
+    return f
+
+
+def evict():
+    """Remove the least recently used entries until the cache fits in MAX_SIZE"""
+    with _locked('evict'):
+        entries = []
+        total = 0
+        for path in CACHE_DIR.glob('*/*'):
+            if path.name.startswith('.'):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= MAX_SIZE:
+                break
+            try:
+                path.unlink()
+            except OSError as err:
+                # Windows refuses to remove files that are open
+                logger.debug(f'Could not evict {path}: {err}')
+                continue
+            logger.debug(f'Evicted {path} from package cache')
+            total -= size
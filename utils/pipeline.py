@@ -0,0 +1,62 @@
+import logging
+import queue
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# Sentinel telling a stage worker to exit
+STOP = object()
+
+
+class Pipeline:
+    """Runs jobs through a sequence of stages, each stage has its own pool of worker threads.
+
+    `stages` is a list of (name, func, workers). Each func takes a job and returns the job
+    for the next stage, or None to drop it. Every stage queue holds at most `workers` jobs so
+    a fast stage blocks rather than piling up temp files in front of a slow one.
+    Exceptions are logged and only drop the job that raised."""
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize = max(1, workers)) for _, _, workers in stages]
+        self.threads = []
+
+        for index, (name, _, workers) in enumerate(stages):
+            stage_threads = []
+            for worker in range(max(1, workers)):
+                thread = threading.Thread(target = self._worker,
+                                          args = (index,),
+                                          name = f'{name}-{worker}',
+                                          daemon = True)
+                thread.start()
+                stage_threads.append(thread)
+            self.threads.append(stage_threads)
+
+    def _worker(self, index):
+        name, func, _ = self.stages[index]
+        while True:
+            job = self.queues[index].get()
+            if job is STOP:
+                return
+
+            try:
+                result = func(job)
+            except Exception as err:
+                logger.exception(f'Stage {name} failed: {err}')
+                result = None
+
+            if result is not None and index + 1 < len(self.stages):
+                self.queues[index + 1].put(result)
+
+    def submit(self, job):
+        """Queue a job for the first stage, blocks while that stage is full"""
+        self.queues[0].put(job)
+
+    def join(self):
+        """Wait for every submitted job to pass through all stages and stop the workers"""
+        for stage_queue, stage_threads in zip(self.queues, self.threads):
+            for _ in stage_threads:
+                stage_queue.put(STOP)
+            for thread in stage_threads:
+                thread.join()
@@ -0,0 +1,130 @@
+import logging
+import re
+import shutil
+
+from collections import namedtuple
+from statistics import median
+
+from utils import mirrors
+
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ['listing', 'newest', 'smallest']
+# Used for hosts with no throughput samples yet
+DEFAULT_RATE = 5 * 1024 * 1024
+# Used until the manifest has ISF timings and the index has ISF sizes for the distro
+ISF_SECONDS = 120
+ISF_SIZE = 40 * 1024 * 1024
+
+# download_bytes is the size of both packages, an upper bound where ranged reads skip most of a deb
+KernelEstimate = namedtuple('KernelEstimate', ['kernel', 'download_bytes', 'download_seconds', 'isf_seconds',
+                                               'disk_bytes', 'sized', 'distro'], defaults = [None])
+
+
+def version_key(kernel):
+    """Natural sort key, 5.15.0-91-generic sorts after 5.15.0-9-generic"""
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', kernel)]
+
+
+def package_urls(symbol_set):
+    return [symbol_set[field] for field in ('kernel_deb', 'debug_deb', 'kernel_rpm', 'debug_rpm') if symbol_set.get(field)]
+
+
+def estimate(distro, kernels, run_manifest, index):
+    """Download size and time, ISF time and ISF disk use for each kernel. Sizes come from the
+    validation HEAD requests or repodata, rates from the mirror statistics and ISF time and size
+    from earlier runs of the same distro"""
+    history = [entry['isf_seconds'] for entry in run_manifest.kernels.values() if entry.get('isf_seconds')]
+    isf_seconds = median(history) if history else ISF_SECONDS
+    sizes = [entry['size'] for entry in index.entries() if entry['distro'] == distro.operating_system]
+    isf_size = median(sizes) if sizes else ISF_SIZE
+
+    estimates = []
+    for kernel in kernels:
+        symbol_set = distro.kernel_pairs[kernel]
+        known = [symbol_set.get('kernel_size'), symbol_set.get('debug_size')]
+        download_bytes = sum(size for size in known if size)
+        seconds = 0
+        for url, size in zip(package_urls(symbol_set), known):
+            seconds += (size or 0) / (mirrors.expected_rate(url) or DEFAULT_RATE)
+        estimates.append(KernelEstimate(kernel, download_bytes, seconds, isf_seconds, isf_size, all(known),
+                                        distro.operating_system))
+
+    # Kernels without a Content-Length are assumed to be typical of the rest
+    sized = [item for item in estimates if item.sized]
+    if sized and len(sized) < len(estimates):
+        typical_bytes = median(item.download_bytes for item in sized)
+        typical_seconds = median(item.download_seconds for item in sized)
+        estimates = [item if item.sized else item._replace(download_bytes = max(item.download_bytes, typical_bytes),
+                                                             download_seconds = max(item.download_seconds, typical_seconds))
+                     for item in estimates]
+    return estimates
+
+
+def order(estimates, policy):
+    if policy == 'newest':
+        return sorted(estimates, key = lambda item: version_key(item.kernel), reverse = True)
+    if policy == 'smallest':
+        return sorted(estimates, key = lambda item: item.download_bytes)
+    return list(estimates)
+
+
+def elapsed(download_seconds, isf_seconds, download_jobs, isf_jobs):
+    """Downloads and ISF creation overlap in the pipeline, whichever side is slower sets the pace"""
+    return max(download_seconds / max(1, download_jobs), isf_seconds / max(1, isf_jobs))
+
+
+def select(estimates, download_jobs=1, isf_jobs=1, max_bytes=None, max_disk=None, max_seconds=None):
+    """Take kernels in order while they fit every budget, a kernel that does not fit is skipped and
+    smaller ones after it are still considered. Returns (selected, [(estimate, reason)])"""
+    selected = []
+    skipped = []
+    total_bytes = total_disk = download_seconds = isf_seconds = 0
+    for item in estimates:
+        reason = None
+        if max_bytes is not None and total_bytes + item.download_bytes > max_bytes:
+            reason = 'download budget'
+        elif max_disk is not None and total_disk + item.disk_bytes > max_disk:
+            reason = 'disk budget'
+        elif max_seconds is not None and elapsed(download_seconds + item.download_seconds,
+                                                 isf_seconds + item.isf_seconds,
+                                                 download_jobs, isf_jobs) > max_seconds:
+            reason = 'time budget'
+
+        if reason:
+            skipped.append((item, reason))
+            continue
+        selected.append(item)
+        total_bytes += item.download_bytes
+        total_disk += item.disk_bytes
+        download_seconds += item.download_seconds
+        isf_seconds += item.isf_seconds
+    return selected, skipped
+
+
+def report(selected, skipped, download_jobs=1, isf_jobs=1, output_root='symbol_files'):
+    """Print the plan, one line per kernel then the totals"""
+    mb = 1024 * 1024
+    print(f"{'distro':<14}{'kernel':<48}{'download MB':>12}{'download s':>12}{'isf s':>8}{'disk MB':>10}  plan")
+    for item in selected:
+        print(f"{item.distro or '':<14}{item.kernel:<48}{item.download_bytes / mb:>12.1f}{item.download_seconds:>12.0f}"
+              f"{item.isf_seconds:>8.0f}{item.disk_bytes / mb:>10.1f}  {'run' if item.sized else 'run, size estimated'}")
+    for item, reason in skipped:
+        print(f"{item.distro or '':<14}{item.kernel:<48}{item.download_bytes / mb:>12.1f}{item.download_seconds:>12.0f}"
+              f"{item.isf_seconds:>8.0f}{item.disk_bytes / mb:>10.1f}  skip, {reason}")
+
+    total_bytes = sum(item.download_bytes for item in selected)
+    total_disk = sum(item.disk_bytes for item in selected)
+    seconds = elapsed(sum(item.download_seconds for item in selected),
+                      sum(item.isf_seconds for item in selected),
+                      download_jobs, isf_jobs)
+    print(f'{len(selected)} kernels to build, {len(skipped)} over budget')
+    print(f'Download {total_bytes / 1024 ** 3:.2f}GB, ISF output {total_disk / 1024 ** 3:.2f}GB, '
+          f'about {seconds / 3600:.1f} hours with {download_jobs} download and {isf_jobs} ISF jobs')
+    try:
+        free = shutil.disk_usage(output_root).free
+    except OSError:
+        return
+    if total_disk > free:
+        logger.warning(f'The ISFs need {total_disk / 1024 ** 3:.1f}GB, only {free / 1024 ** 3:.1f}GB is free')
@@ -0,0 +1,331 @@
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlsplit
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils import local_mirror, metrics, mirrors
+
+
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+# Retries apply to connection errors, 429 and 5xx responses and mid body failures
+RETRIES = 5
+BACKOFF_FACTOR = 1
+# Connections kept alive per host, should cover the number of concurrent downloads
+POOL_SIZE = 16
+# Package transfers open at once to any one host, None leaves the download jobs as the only limit
+HOST_JOBS = None
+
+# With a mirror to fall back on, a transfer slower than STALL_RATE bytes/s over STALL_WINDOW seconds is moved
+STALL_WINDOW = 20
+STALL_RATE = 32 * 1024
+# Bytes fetched from each mirror to rank them
+PROBE_SIZE = 1024 * 1024
+
+RETRY_STATUS = [429, 500, 502, 503, 504]
+RESUMABLE_ERRORS = (requests.ConnectionError,
+                    requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError)
+
+_session = None
+_session_lock = threading.Lock()
+_host_slots = {}
+
+
+class TimeoutSession(requests.Session):
+    """Session that applies the configured timeouts to every request"""
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+        return super().request(method, url, **kwargs)
+
+
+def configure(connect_timeout=None, read_timeout=None, retries=None, backoff_factor=None, pool_size=None,
+              host_jobs=None):
+    """Override the transport settings, the shared session is rebuilt on next use"""
+    global CONNECT_TIMEOUT, READ_TIMEOUT, RETRIES, BACKOFF_FACTOR, POOL_SIZE, HOST_JOBS, _session
+    if connect_timeout is not None:
+        CONNECT_TIMEOUT = connect_timeout
+    if read_timeout is not None:
+        READ_TIMEOUT = read_timeout
+    if retries is not None:
+        RETRIES = retries
+    if backoff_factor is not None:
+        BACKOFF_FACTOR = backoff_factor
+    if pool_size is not None:
+        POOL_SIZE = pool_size
+    if host_jobs is not None:
+        HOST_JOBS = host_jobs
+
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _host_slots.clear()
+
+
+def get_session():
+    """Returns the shared keep-alive session, creating it on first use"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total = RETRIES,
+                          backoff_factor = BACKOFF_FACTOR,
+                          status_forcelist = RETRY_STATUS,
+                          allowed_methods = ['HEAD', 'GET'],
+                          raise_on_status = False)
+            adapter = HTTPAdapter(pool_connections = POOL_SIZE,
+                                  pool_maxsize = POOL_SIZE,
+                                  max_retries = retry)
+            session = TimeoutSession()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+@contextmanager
+def _hold(slot):
+    start = time.monotonic()
+    with slot:
+        metrics.add('host_wait', time.monotonic() - start)
+        yield
+
+
+def host_slot(url):
+    """Held for the length of a package transfer from the host of `url`, at most HOST_JOBS
+    transfers run against one host however many kernels or segments are downloading"""
+    if not HOST_JOBS:
+        return nullcontext()
+    host = urlsplit(url).hostname
+    with _session_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = _host_slots[host] = threading.BoundedSemaphore(HOST_JOBS)
+    return _hold(slot)
+
+
+def get(url, **kwargs):
+    return get_session().get(url, **kwargs)
+
+
+def head(url, **kwargs):
+    path = local_mirror.local_path(url)
+    if path is not None:
+        return local_mirror.LocalResponse(url, path)
+    return get_session().head(url, **kwargs)
+
+
+class RangeNotSatisfied(IOError):
+    """The server ignored a Range request or the file changed since the first one"""
+
+
+def validator(response):
+    """ETag or Last-Modified of a response, what If-Range compares against"""
+    return response.headers.get('ETag') or response.headers.get('Last-Modified')
+
+
+def iter_range(url, start, end, chunk_size, if_range=None):
+    """Yields bytes `start` up to `end` of `url` in chunks, resuming from the last byte received if
+    the connection drops. `if_range` makes the server send the whole file instead of the range if
+    it no longer matches, which is raised as RangeNotSatisfied"""
+    path = local_mirror.local_path(url)
+    if path is not None:
+        yield from local_mirror.iter_file(path, start, end, chunk_size)
+        return
+
+    offset = start
+    attempt = 0
+
+    while offset < end:
+        headers = {'Accept-Encoding': 'identity', 'Range': f'bytes={offset}-{end - 1}'}
+        if if_range:
+            headers['If-Range'] = if_range
+
+        with host_slot(url), get(url, stream = True, headers = headers) as r:
+            r.raise_for_status()
+            if r.status_code != 206 or not r.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+                raise RangeNotSatisfied(f'{url} returned {r.status_code} for bytes {offset}-{end - 1}')
+
+            try:
+                for chunk in r.iter_content(chunk_size = chunk_size):
+                    metrics.add('bytes_downloaded', len(chunk))
+                    chunk = chunk[:end - offset]
+                    offset += len(chunk)
+                    yield chunk
+                    if offset >= end:
+                        return
+                raise IOError(f'{url} ended at {offset} before byte {end}')
+
+            except RESUMABLE_ERRORS as err:
+                attempt += 1
+                if attempt > RETRIES:
+                    raise
+                delay = BACKOFF_FACTOR * 2 ** (attempt - 1)
+                logger.warning(f'Range request to {url} failed at {offset}, resuming in {delay}s: {err}')
+                time.sleep(delay)
+
+
+def content_length(response):
+    """Returns the Content-Length of a response as an int or None if it was not sent"""
+    length = response.headers.get('Content-Length')
+    return int(length) if length and length.isdigit() else None
+
+
+def total_size(response, offset):
+    """Full size of the file behind a response, from Content-Range on a 206"""
+    content_range = response.headers.get('Content-Range', '')
+    if response.status_code == 206 and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else None
+    return content_length(response)
+
+
+class StalledTransfer(IOError):
+    """A transfer slowed to below STALL_RATE while another mirror could take over"""
+
+
+class StallMonitor:
+
+    def __init__(self):
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+
+    def update(self, size):
+        self.window_bytes += size
+        elapsed = time.monotonic() - self.window_start
+        if elapsed >= STALL_WINDOW:
+            rate = self.window_bytes / elapsed
+            if rate < STALL_RATE:
+                raise StalledTransfer(f'Transfer slowed to {rate / 1024:.0f}KB/s')
+            self.window_start = time.monotonic()
+            self.window_bytes = 0
+
+
+def probe_mirrors(url):
+    """Time a PROBE_SIZE Range request for `url` against every mirror of its host, once per run"""
+    mirror_set, _ = mirrors.find(url)
+    with mirror_set.probe_lock:
+        if mirror_set.probed:
+            return
+        mirror_set.probed = True
+
+        def probe(source):
+            start = time.monotonic()
+            try:
+                with get(source, stream = True, timeout = (CONNECT_TIMEOUT, CONNECT_TIMEOUT),
+                         headers = {'Accept-Encoding': 'identity', 'Range': f'bytes=0-{PROBE_SIZE - 1}'}) as r:
+                    if r.status_code == 404:
+                        return
+                    r.raise_for_status()
+                    size = sum(len(chunk) for chunk in r.iter_content(chunk_size = PROBE_SIZE))
+                mirrors.record(source, size, time.monotonic() - start)
+            except requests.RequestException as err:
+                logger.debug(f'Probe of {source} failed: {err}')
+                mirrors.record_error(source)
+
+        sources = mirrors.candidates(url)
+        logger.debug(f'Probing {len(sources)} mirrors with {url}')
+        with ThreadPoolExecutor(max_workers = len(sources)) as executor:
+            list(executor.map(probe, sources))
+
+
+def iter_content(url, chunk_size):
+    """Yields the body of `url` in chunks. If the connection drops part way through
+    the download is resumed with a Range request from the last byte received.
+    Where the host has mirrors the best one is used, and a failed or stalled transfer
+    carries on from the next mirror"""
+    if mirrors.needs_probe(url):
+        probe_mirrors(url)
+    sources = mirrors.candidates(url)
+    source_index = 0
+    offset = 0
+    attempt = 0
+    validator = None
+    validated_source = None
+    total = None
+
+    while True:
+        source = sources[source_index]
+        # Byte offsets only line up if the body is not content encoded
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+
+        start = time.monotonic()
+        received = 0
+        body_started = False
+        try:
+            with host_slot(source), get(source, stream = True, headers = headers) as r:
+                if r.status_code == 404 and source_index + 1 < len(sources):
+                    logger.debug(f'{source} not found, trying the next mirror')
+                    source_index += 1
+                    continue
+                r.raise_for_status()
+
+                current = r.headers.get('ETag') or r.headers.get('Last-Modified')
+                size = total_size(r, offset)
+                to_skip = 0
+                if offset:
+                    # Mirrors have their own ETags, only the size can be compared between them
+                    if total and size and size != total:
+                        raise IOError(f'{source} is {size} bytes, expected {total}')
+                    if source == validated_source and validator and current and current != validator:
+                        raise IOError(f'{url} changed while resuming the download')
+                    if r.status_code != 206:
+                        # Server ignored the Range, discard what we already have
+                        logger.debug(f'{source} does not support Range, skipping {offset} bytes')
+                        to_skip = offset
+                validator = current
+                validated_source = source
+                total = total or size
+
+                # Slow transfers are only abandoned if there is somewhere else to go
+                monitor = StallMonitor() if len(sources) > 1 else None
+                body_started = True
+                for chunk in r.iter_content(chunk_size = chunk_size):
+                    metrics.add('bytes_downloaded', len(chunk))
+                    received += len(chunk)
+                    if monitor:
+                        monitor.update(len(chunk))
+                    if to_skip:
+                        if len(chunk) <= to_skip:
+                            to_skip -= len(chunk)
+                            continue
+                        chunk = chunk[to_skip:]
+                        to_skip = 0
+                    offset += len(chunk)
+                    yield chunk
+                mirrors.record(source, received, time.monotonic() - start)
+                return
+
+        except (requests.HTTPError, *RESUMABLE_ERRORS, StalledTransfer) as err:
+            if len(sources) < 2 and not body_started:
+                # urllib3 has already retried the request itself
+                raise
+            if isinstance(err, requests.HTTPError) and (err.response is None or err.response.status_code < 500):
+                raise
+            mirrors.record(source, received, time.monotonic() - start)
+            mirrors.record_error(source)
+            attempt += 1
+            if attempt > RETRIES:
+                raise
+            if len(sources) > 1:
+                source_index = (source_index + 1) % len(sources)
+                logger.warning(f'Download of {url} failed after {offset} bytes, resuming from {sources[source_index]}: {err}')
+                # Only wait once every mirror has had a go
+                if attempt % len(sources):
+                    continue
+            delay = BACKOFF_FACTOR * 2 ** (attempt - 1)
+            logger.warning(f'Download of {url} failed after {offset} bytes, resuming in {delay}s: {err}')
+            time.sleep(delay)
@@ -0,0 +1,40 @@
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+# HEAD requests in flight at once
+JOBS = 16
+
+
+def validate_pairs(distro, kernels, jobs=JOBS, on_invalid=None):
+    """Run `distro.validate_links` for every kernel with at most `jobs` requests in flight.
+    Kernels that fail validation are removed from `distro.kernel_pairs`, the valid ones are returned.
+    `on_invalid(kernel, symbol_set)` is called for pairs the server reported missing, not for request errors"""
+
+    def validate(kernel):
+        try:
+            return distro.validate_links(kernel)
+        except Exception as err:
+            logger.warning(f'Could not validate {kernel}: {err}')
+            return None
+
+    kernels = list(kernels)
+    logger.info(f'Validating {len(kernels)} kernels')
+
+    with ThreadPoolExecutor(max_workers = max(1, jobs)) as executor:
+        results = list(executor.map(validate, kernels))
+
+    valid_kernels = []
+    for kernel, valid in zip(kernels, results):
+        if valid:
+            valid_kernels.append(kernel)
+        else:
+            symbol_set = distro.kernel_pairs.pop(kernel)
+            if valid is False and on_invalid is not None:
+                on_invalid(kernel, symbol_set)
+
+    logger.info(f'{len(valid_kernels)} of {len(kernels)} kernels have valid links')
+    return valid_kernels
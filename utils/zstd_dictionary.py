@@ -0,0 +1,146 @@
+import json
+import logging
+import lzma
+import os
+import re
+import tempfile
+import threading
+import time
+
+from pathlib import Path
+
+import zstandard
+
+
+logger = logging.getLogger(__name__)
+
+DICT_DIR = Path('symbol_files', '.dictionaries')
+# zstd gains little from dictionaries much over a few hundred KB
+DICT_SIZE = 512 * 1024
+# ISF JSON is cut into pieces of this size to train on, about what a dictionary can cover
+SAMPLE_SIZE = 128 * 1024
+# Training time grows with the sample data, 100x the dictionary size is plenty
+SAMPLE_BUDGET = 100
+# Fixed fastcover segment and d-mer sizes, letting zstd search for them takes minutes
+TRAIN_K = 1024
+TRAIN_D = 8
+# Largest possible zstd frame header, enough to read the dictionary id
+FRAME_HEADER_SIZE = 18
+
+DICT_PATTERN = re.compile(r'^(?P<distro>.+)\.v(?P<version>\d+)\.zdict$')
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def configure(dict_dir=None):
+    global DICT_DIR
+    if dict_dir is not None:
+        DICT_DIR = Path(dict_dir)
+
+
+def dictionary_paths(distro, dict_dir=None):
+    """Every dictionary version for `distro`, oldest first"""
+    paths = []
+    for path in Path(dict_dir or DICT_DIR).glob(f'{distro}.v*.zdict'):
+        match = DICT_PATTERN.match(path.name)
+        if match and match.group('distro') == distro:
+            paths.append((int(match.group('version')), path))
+    return [path for _, path in sorted(paths)]
+
+
+def load(path):
+    path = Path(path)
+    with _cache_lock:
+        if path not in _cache:
+            _cache[path] = zstandard.ZstdCompressionDict(path.read_bytes())
+        return _cache[path]
+
+
+def latest(distro, dict_dir=None):
+    """(path, dictionary) of the newest version for `distro`, (None, None) if none has been trained"""
+    paths = dictionary_paths(distro, dict_dir)
+    if not paths:
+        return None, None
+    return paths[-1], load(paths[-1])
+
+
+def find(dict_id, dict_dir=None):
+    """The dictionary with `dict_id`, which zstd writes into every frame compressed with it"""
+    for path in Path(dict_dir or DICT_DIR).glob('*.zdict'):
+        dictionary = load(path)
+        if dictionary.dict_id() == dict_id:
+            return dictionary
+    return None
+
+
+def open_isf(isf_path, dict_dir=None):
+    """Binary reader over the JSON of a .json.xz or .json.zst ISF"""
+    isf_path = Path(isf_path)
+    if isf_path.name.endswith('.zst'):
+        with open(isf_path, 'rb') as f:
+            dict_id = zstandard.get_frame_parameters(f.read(FRAME_HEADER_SIZE)).dict_id
+        dictionary = None
+        if dict_id:
+            dictionary = find(dict_id, dict_dir or isf_path.parent.parent.parent / DICT_DIR.name)
+            if dictionary is None:
+                raise zstandard.ZstdError(f'{isf_path} needs zstd dictionary {dict_id} which was not found')
+        return zstandard.ZstdDecompressor(dict_data = dictionary).stream_reader(open(isf_path, 'rb'), closefd = True)
+    return lzma.open(isf_path)
+
+
+def info_path(path):
+    """The JSON next to each dictionary recording what it was trained on"""
+    return Path(path).with_suffix('.json')
+
+
+def read_info(path):
+    try:
+        return json.loads(info_path(path).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir = path.parent, prefix = '.zdict-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def samples(isf_paths, budget):
+    """Evenly spaced SAMPLE_SIZE pieces of each ISF, `budget` bytes in total"""
+    per_file = max(1, budget // SAMPLE_SIZE // max(1, len(isf_paths)))
+    pieces = []
+    for isf_path in isf_paths:
+        with open_isf(isf_path) as f:
+            data = f.read()
+        step = max(SAMPLE_SIZE, len(data) // per_file)
+        pieces.extend(data[offset:offset + SAMPLE_SIZE] for offset in range(0, len(data), step))
+        logger.debug(f'Sampled {isf_path}')
+    return pieces
+
+
+def train(distro, isf_paths, dict_size=DICT_SIZE, dict_dir=None):
+    """Train a dictionary on `isf_paths` and store it as the next version for `distro`"""
+    dict_dir = Path(dict_dir or DICT_DIR)
+    pieces = samples(isf_paths, dict_size * SAMPLE_BUDGET)
+    logger.info(f'Training a {dict_size // 1024}KB dictionary on {len(pieces)} samples from {len(isf_paths)} ISFs')
+    dictionary = zstandard.train_dictionary(dict_size, pieces, k = TRAIN_K, d = TRAIN_D, threads = -1)
+
+    existing = dictionary_paths(distro, dict_dir)
+    version = int(DICT_PATTERN.match(existing[-1].name).group('version')) + 1 if existing else 1
+    path = dict_dir / f'{distro}.v{version}.zdict'
+
+    info = {"distro": distro,
+            "version": version,
+            "dict_id": dictionary.dict_id(),
+            "size": len(dictionary),
+            "created": time.time(),
+            "trained_on": [str(isf_path) for isf_path in isf_paths]}
+
+    dict_dir.mkdir(parents = True, exist_ok = True)
+    write_atomic(info_path(path), json.dumps(info, indent = 2).encode())
+    write_atomic(path, dictionary.as_bytes())
+    logger.info(f'Wrote {path} with id {dictionary.dict_id()}')
+    return path, dictionary